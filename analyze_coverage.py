@@ -4,58 +4,123 @@
 
 import numpy as np
 import argparse
-import sys,math
-import matplotlib.pyplot as plt
+import sys,os,math,json,glob
+import multiprocessing
+
+from scroogeclasses import BinaryCoverageFile,is_binary_coverage_file,is_coverage_summary_file,read_coverage_summary,FastaIndex,available_cpus
+from scroogebedgraph import BedGraphCoverageFile,is_bedgraph_coverage_file,text_to_bedgraph,binary_to_bedgraph,bedgraph_to_text
 
 class coverageclass():
     
     def __init__(self,fname):
 	try:
-	    fp = open(fname)
+	    binary = is_binary_coverage_file(fname)
+	    summary = is_coverage_summary_file(fname)
+	    bedgraph = is_bedgraph_coverage_file(fname)
 	except:
 	    raise IOError
-	self.__coverage = np.zeros((1,3))
 	self.__contignames = []
 	self.__currenthistolength = 1000
 	self.__histo = np.zeros(self.__currenthistolength)
-	self.__s = 0
-	self.__n = 0
-	self.__s2 = 0
-	self.__contigname = ""
-	first = True
-	for line in fp.readlines():
-	    if line[0] == "#":
-		self.__contigname = line.split()[1]
-	    elif line.strip() == "":
-		if first:
-		    self.__coverage[0,0] = self.__n
-		    self.__coverage[0,1] = self.__s/self.__n
-		    self.__coverage[0,2] = self.__s2/self.__n
-		    first = False
+	if binary:
+	    self.read_binary(fname)
+	elif summary:
+	    self.read_summary(fname)
+	elif bedgraph:
+	    self.read_bedgraph(fname)
+	else:
+	    self.read_text(fname)
+
+    def read_binary(self,fname):
+	# depth is memory-mapped, only one contig at a time is in memory
+	covfile = BinaryCoverageFile(fname)
+	self.__coverage = np.zeros((len(covfile),3))
+	self.__contignames = list(covfile.get_names())
+	for i,(name,c) in enumerate(covfile):
+	    c = np.asarray(c,dtype=np.int64)
+	    n = len(c)
+	    self.__coverage[i,0] = n
+	    self.__coverage[i,1] = float(np.sum(c))/n
+	    self.__coverage[i,2] = float(np.dot(c,c))/n
+	    self.add_histo_array(np.bincount(c))
+
+    def read_summary(self,fname):
+	# only moments of every contig and the histogram over all contigs are stored
+	summary = read_coverage_summary(fname)
+	self.__contignames = [scg["name"] for scg in summary["scgs"]]
+	rows = [(scg["length"],float(scg["sum"])/max(scg["length"],1),float(scg["sum2"])/max(scg["length"],1)) for scg in summary["scgs"]]
+	self.__coverage = np.array(rows,dtype=np.float64).reshape((-1,3))
+	self.add_histo_array(np.array(summary["histogram"],dtype=np.float64))
+
+    def read_bedgraph(self,fname):
+	# moments and histogram straight from the runs, bases are never expanded
+	covfile = BedGraphCoverageFile(fname)
+	lengths = covfile.get_lengths()
+	self.__coverage = np.zeros((len(covfile),3))
+	self.__contignames = list(covfile.get_names())
+	for i,(name,starts,ends,depths) in enumerate(covfile):
+	    runs = ends - starts
+	    n = max(lengths[i],1)
+	    self.__coverage[i,0] = lengths[i]
+	    self.__coverage[i,1] = float(np.dot(runs,depths))/n
+	    self.__coverage[i,2] = float(np.dot(runs,depths*depths))/n
+	    h = np.bincount(depths,weights = runs,minlength = 1)
+	    h[0] += lengths[i] - np.sum(runs)
+	    self.add_histo_array(h)
+	covfile.close()
+
+    def read_text(self,fname,chunksize = 1<<22):
+	# read blocks of about 'chunksize' bytes, convert depths of a whole
+	# block at once and reduce per contig with bincount
+	fp = open(fname)
+	rows = []
+	name = ""
+	n,s,s2 = 0,0.,0.
+	while True:
+	    lines = fp.readlines(chunksize)
+	    if len(lines) == 0:
+		break
+	    data = []
+	    closed = []
+	    for line in lines:
+		if line[0] == "#":
+		    name = line.split()[1]
+		elif line.strip() == "":
+		    closed.append((len(data),name))
 		else:
-		    self.__coverage = np.concatenate((self.__coverage,np.reshape(np.array((self.__n,self.__s/self.__n,self.__s2/self.__n)),(1,3))),axis=0)
-		self.__contignames.append(self.__contigname)
-		self.__n = 0
-		self.__s = 0
-		self.__s2 = 0
-	    else:
-		v = line.split()
-		self.__n  += 1
-		self.__s  += float(v[1])
-		self.__s2 += float(v[1])**2
-		self.add_histo(int(v[1]))
+		    data.append(line)
+	    depth = np.array([line.split(None,2)[1] for line in data],dtype=np.int64)
+	    self.add_histo_array(np.bincount(depth))
+	    # segment k holds the lines before the k-th contig end in this block
+	    bounds = np.array([0] + [c[0] for c in closed] + [len(data)])
+	    segments = np.repeat(np.arange(len(bounds)-1),np.diff(bounds))
+	    segn = np.diff(bounds)
+	    segs = np.bincount(segments,weights = depth,minlength = len(segn))
+	    segs2 = np.bincount(segments,weights = depth.astype(np.float64)**2,minlength = len(segn))
+	    for k,(i,cname) in enumerate(closed):
+		n,s,s2 = n + segn[k],s + segs[k],s2 + segs2[k]
+		rows.append((n,s/n,s2/n))
+		self.__contignames.append(cname)
+		n,s,s2 = 0,0.,0.
+	    n,s,s2 = n + segn[-1],s + segs[-1],s2 + segs2[-1]
 	fp.close()
-	
-		
+	self.__coverage = np.array(rows,dtype=np.float64).reshape((-1,3))
+
     def add_histo(self,n):
 	if n >= self.__currenthistolength:
 	    self.__histo = np.concatenate((self.__histo,np.zeros(n - self.__currenthistolength + 1)))
 	    self.__currenthistolength = len(self.__histo)
 	self.__histo[n] += 1
-	    
+
+    def add_histo_array(self,h):
+	if len(h) > self.__currenthistolength:
+	    self.__histo = np.concatenate((self.__histo,np.zeros(len(h) - self.__currenthistolength)))
+	    self.__currenthistolength = len(self.__histo)
+	self.__histo[:len(h)] += h
+
     def __iter__(self):
 	for i in range(len(self.__coverage)):
-	    yield self.__contigname[i],self.__coverage[i]
+	    yield self.__contignames[i],self.__coverage[i]
 
 
     def get_coverage(self):
@@ -65,25 +130,38 @@ class coverageclass():
     def get_histo(self):
 	return self.__histo
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("-c","--coveragefile")
-    args = parser.parse_args()
-
-    cov = coverageclass(args.coveragefile)
-
+def get_statistics(cov):
+    """ mean depth over all bases and over contigs, with standard deviations """
     c = cov.get_coverage()
-    n = cov.get_contignames()
     h = cov.get_histo()
     x = np.arange(len(h))
-
-
     cov1h = np.dot(x,h)/np.sum(h)
     cov2h = np.dot(x*x,h)/np.sum(h)
     con_mean   = np.mean(c[:,1])
     con_stddev = np.sqrt(len(c[:,1]) * np.sum(c[:,2]) - np.sum(c[:,1])**2)/np.sqrt(len(c[:,1])**2-len(c[:,1]))
-    print "mean coverage (average over all matched sequences): %8.2lf ± %8.2lf"%(cov1h,np.sqrt(cov2h - cov1h**2))
-    print "mean coverage (average over contigs)              : %8.2lf ± %8.2lf"%(con_mean,con_stddev)
+    return {"mean":float(cov1h),"stddev":float(np.sqrt(cov2h - cov1h**2)),
+	    "contigmean":float(con_mean),"contigstddev":float(con_stddev)}
+
+def print_text(cov,stats):
+    print "mean coverage (average over all matched sequences): %8.2lf ± %8.2lf"%(stats["mean"],stats["stddev"])
+    print "mean coverage (average over contigs)              : %8.2lf ± %8.2lf"%(stats["contigmean"],stats["contigstddev"])
+
+def print_json(cov,stats):
+    contigs = [{"name":name,"length":int(row[0]),"mean":row[1],"stddev":math.sqrt(max(0.,row[2] - row[1]**2))} for name,row in cov]
+    stats = dict(stats,contigs = contigs,histogram = [int(v) for v in np.trim_zeros(cov.get_histo(),'b')])
+    json.dump(stats,sys.stdout,indent = 1)
+    print
+
+def plot(cov,plotfile = None):
+    # matplotlib is only needed here, text and JSON output work without it
+    import matplotlib
+    if plotfile != None:
+	# no display needed to write the plots to a file
+	matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    c = cov.get_coverage()
+    h = cov.get_histo()
+    x = np.arange(len(h))
 
     fig = plt.figure()
     
@@ -107,7 +185,249 @@ def main():
     nc1.set_xlabel('contig length')
     nc1.set_ylabel('contig mean coverage')
     
-    plt.show()
+    if plotfile != None:
+	fig.savefig(plotfile)
+    else:
+	plt.show()
+
+
+
+# ***************************************************************** #
+# **         aggregate of many samples: statistics of all        ** #
+# **         contigs in a columnar store (NumPy .npz), samples   ** #
+# **         are only parsed again if their file changed         ** #
+# ***************************************************************** #
+STATISTICS = ["mean","stddev","contigmean","contigstddev"]
+
+def sample_stamp(fname):
+    st = os.stat(fname)
+    return [st.st_size,st.st_mtime]
+
+def load_sample(fname):
+    """ contig names, rows (length, mean, mean square), histogram and
+    statistics of one coverage file, runs in worker processes """
+    cov = coverageclass(fname)
+    stats = get_statistics(cov)
+    return cov.get_contignames(),cov.get_coverage(),np.trim_zeros(cov.get_histo(),'b'),[stats[s] for s in STATISTICS]
+
+class CoverageStore():
+    """ per-contig rows of all samples in flat columns, contig names are
+    kept once in a name table; histograms are concatenated with offsets """
+
+    def __init__(self,fname = None):
+	self.__samples = []
+	self.__stamps = {}
+	self.__data = {}
+	if fname != None and os.path.exists(fname):
+	    self.load(fname)
+
+    def __len__(self):
+	return len(self.__samples)
+
+    def load(self,fname):
+	store = np.load(fname)
+	contignames = list(store["contignames"])
+	offsets = store["histoffsets"]
+	for i,sample in enumerate(store["samples"]):
+	    rows = store["rowsample"] == i
+	    self.add(sample,list(store["stamps"][i]),[contignames[j] for j in store["rowcontig"][rows]],
+		     store["rows"][rows],store["histograms"][offsets[i]:offsets[i+1]],list(store["stats"][i]))
+	store.close()
+
+    def save(self,fname):
+	contignames = sorted(set([name for sample in self.__samples for name in self.__data[sample][0]]))
+	contigindex = dict([(name,j) for j,name in enumerate(contignames)])
+	histograms = [self.__data[sample][2] for sample in self.__samples]
+	offsets = np.zeros(len(self.__samples)+1,dtype=np.int64)
+	offsets[1:] = np.cumsum([len(h) for h in histograms])
+	columns = {"samples":np.array(self.__samples),
+		   "stamps":np.array([self.__stamps[sample] for sample in self.__samples],dtype=np.float64).reshape((-1,2)),
+		   "stats":np.array([self.__data[sample][3] for sample in self.__samples],dtype=np.float64).reshape((-1,len(STATISTICS))),
+		   "contignames":np.array(contignames),
+		   "rowsample":np.concatenate([np.zeros(len(self.__data[sample][0]),dtype=np.int32) + i for i,sample in enumerate(self.__samples)] + [np.zeros(0,dtype=np.int32)]),
+		   "rowcontig":np.array([contigindex[name] for sample in self.__samples for name in self.__data[sample][0]],dtype=np.int32),
+		   "rows":np.concatenate([self.__data[sample][1] for sample in self.__samples] + [np.zeros((0,3))]),
+		   "histoffsets":offsets,
+		   "histograms":np.concatenate(histograms + [np.zeros(0)])}
+	# written under a temporary name, a store is never left half written
+	partial = os.path.join(os.path.dirname(fname),".part." + os.path.basename(fname))
+	f = open(partial,"wb")
+	np.savez_compressed(f,**columns)
+	f.close()
+	os.rename(partial,fname)
+
+    def add(self,sample,stamp,contignames,rows,histogram,stats):
+	if not self.__data.has_key(sample):
+	    self.__samples.append(sample)
+	self.__stamps[sample] = list(stamp)
+	self.__data[sample] = (list(contignames),np.asarray(rows,dtype=np.float64).reshape((-1,3)),np.asarray(histogram,dtype=np.float64),list(stats))
+
+    def is_current(self,sample,stamp):
+	""" sample is stored and its file did not change since """
+	return self.__stamps.get(sample) == list(stamp)
+
+    def get_samples(self):
+	return self.__samples
+
+    def get_contignames(self,sample):
+	return self.__data[sample][0]
+    def get_coverage(self,sample):
+	return self.__data[sample][1]
+    def get_histo(self,sample):
+	return self.__data[sample][2]
+    def get_statistics(self,sample):
+	return dict(zip(STATISTICS,self.__data[sample][3]))
+
+    def get_contig(self,name):
+	""" (sample,row) of every sample with this contig """
+	return [(sample,self.__data[sample][1][self.__data[sample][0].index(name)]) for sample in self.__samples if name in self.__data[sample][0]]
+
+def aggregate(fnames,storefile,processes = 1):
+    """ statistics of all coverage files, unchanged samples are taken
+    from the store, the others are loaded in a process pool """
+    store = CoverageStore(storefile)
+    # a glob pattern may match the store itself
+    samples = [os.path.abspath(f) for f in fnames if os.path.abspath(f) != os.path.abspath(storefile)]
+    stamps = [sample_stamp(f) for f in samples]
+    todo = [(sample,stamp) for sample,stamp in zip(samples,stamps) if not store.is_current(sample,stamp)]
+    if len(todo) > 0:
+	if processes > 1 and len(todo) > 1:
+	    pool = multiprocessing.Pool(min(processes,len(todo)))
+	    try:
+		results = pool.map(load_sample,[sample for sample,stamp in todo])
+	    finally:
+		pool.close()
+		pool.join()
+	else:
+	    results = [load_sample(sample) for sample,stamp in todo]
+	for (sample,stamp),result in zip(todo,results):
+	    store.add(sample,stamp,*result)
+	store.save(storefile)
+    return store,samples,len(todo)
+
+def print_aggregate_text(store,samples):
+    print "#sample\tcontigs\tbases\tmean\tstddev\tcontigmean\tcontigstddev"
+    for sample in samples:
+	stats = store.get_statistics(sample)
+	c = store.get_coverage(sample)
+	print "%s\t%d\t%d\t%.4lf\t%.4lf\t%.4lf\t%.4lf"%(sample,len(c),np.sum(c[:,0]),stats["mean"],stats["stddev"],stats["contigmean"],stats["contigstddev"])
+
+def print_aggregate_json(store,samples):
+    result = []
+    for sample in samples:
+	c = store.get_coverage(sample)
+	result.append(dict(store.get_statistics(sample),sample = sample,contigs = len(c),bases = int(np.sum(c[:,0]))))
+    json.dump(result,sys.stdout,indent = 1)
+    print
+
+def plot_aggregate(store,samples,plotfile):
+    """ coverage of all samples and spread of contig means, always written to a file """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    stats = [store.get_statistics(sample) for sample in samples]
+    x = np.arange(len(samples))
+
+    fig = plt.figure(figsize = (max(8,0.15*len(samples)),8))
+
+    ps1 = fig.add_subplot(2,1,1)
+    ps1.errorbar(x,[s["mean"] for s in stats],yerr = [s["stddev"] for s in stats],fmt = 'o')
+    ps1.set_xlim(-1,len(samples))
+    ps1.set_ylabel('mean coverage')
+
+    ps2 = fig.add_subplot(2,1,2)
+    ps2.boxplot([store.get_coverage(sample)[:,1]/max(s["contigmean"],1e-10) for sample,s in zip(samples,stats)],positions = x)
+    ps2.set_xlim(-1,len(samples))
+    ps2.set_yscale('log')
+    ps2.set_xlabel('sample')
+    ps2.set_ylabel('contig mean / sample mean')
+
+    fig.savefig(plotfile)
+
+def convert(fname,outfile,sequencefile = None):
+    """ text or binary coverage to bgzipped bedGraph (index in 'outfile.tbi'), bedGraph to text """
+    if is_bedgraph_coverage_file(fname):
+	sequences = None
+	if sequencefile != None:
+	    sequences = FastaIndex(sequencefile)
+	bedgraph_to_text(fname,outfile,sequences)
+    elif is_binary_coverage_file(fname):
+	binary_to_bedgraph(fname,outfile)
+    elif is_coverage_summary_file(fname):
+	raise ValueError("summary files have no per-base coverage to convert")
+    else:
+	text_to_bedgraph(fname,outfile)
+
+def print_region(fname,region):
+    """ runs of equal depth in 'name[:start-end]' of a bedGraph file, via its index """
+    covfile = BedGraphCoverageFile(fname)
+    name,start,end = region,0,None
+    if ":" in region:
+	name,interval = region.rsplit(":",1)
+	start,end = [int(x) for x in interval.replace(",","").split("-")]
+    for s,e,d in zip(*covfile.get_runs(name,start,end)):
+	print "%s\t%d\t%d\t%d"%(name,s,e,d)
+    covfile.close()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c","--coveragefile",nargs="+",
+			help="coverage file, several files (or glob patterns) in aggregate mode")
+    parser.add_argument("-f","--format",choices=["plot","text","json"],default="plot",
+			help="'plot': print statistics and show plots, 'text' or 'json':\nonly print statistics, without loading matplotlib\n(default: plot)")
+    parser.add_argument("-o","--plotfile",default=None,
+			help="write plots to this file instead of showing them,\nno display needed (default: show plots, in aggregate\nmode the name of the store with extension .png)")
+    parser.add_argument("-A","--aggregate",default=None,
+			help="aggregate mode: statistics of all coverage files in this\nstore (.npz), unchanged samples are read from it")
+    parser.add_argument("-p","--processes",type=int,default=available_cpus(),
+			help="aggregate mode: load coverage files in this many\nprocesses (default: processors available, respecting CPU\naffinity and cgroup limits)")
+    parser.add_argument("-x","--convert",default=None,
+			help="convert the coverage file and exit: text or binary to\nbgzipped bedGraph (with index OUTFILE.tbi), bedGraph\nto text")
+    parser.add_argument("-s","--sequences",default=None,
+			help="FASTA file of SCGs for bases in converted text files\n(default: N)")
+    parser.add_argument("-r","--region",default=None,
+			help="print runs of equal depth in region 'name[:start-end]'\n(0-based, end exclusive) of a bedGraph file and exit")
+    args = parser.parse_args()
+
+    fnames = [f for pattern in args.coveragefile or [] for f in (sorted(glob.glob(pattern)) or [pattern])]
+    if len(fnames) == 0:
+	parser.error("need coverage file")
+
+    if args.aggregate != None:
+	store,samples,loaded = aggregate(fnames,args.aggregate,args.processes)
+	print >> sys.stderr,"%d samples, %d loaded, %d from store '%s'"%(len(samples),loaded,len(samples) - loaded,args.aggregate)
+	if args.format == "json":
+	    print_aggregate_json(store,samples)
+	else:
+	    print_aggregate_text(store,samples)
+	if args.format == "plot":
+	    plot_aggregate(store,samples,args.plotfile or os.path.splitext(args.aggregate)[0] + ".png")
+	return
+    if len(fnames) > 1:
+	parser.error("several coverage files need aggregate mode (-A)")
+
+    if args.convert != None:
+	try:
+	    convert(fnames[0],args.convert,args.sequences)
+	except (IOError,ValueError) as e:
+	    parser.error("could not convert '%s': %s"%(fnames[0],e))
+	return
+    if args.region != None:
+	try:
+	    print_region(fnames[0],args.region)
+	except (IOError,ValueError,KeyError) as e:
+	    parser.error("could not read region '%s' of '%s': %s"%(args.region,fnames[0],e))
+	return
+
+    cov = coverageclass(fnames[0])
+    stats = get_statistics(cov)
+
+    if args.format == "json":
+	print_json(cov,stats)
+    else:
+	print_text(cov,stats)
+    if args.format == "plot":
+	plot(cov,args.plotfile)
 
     #for contig in c:
 	#print contig[0],contig[1],contig[2]
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# ***************************************************************** #
+# **         benchmark: parsing BLAST hits from XML (outfmt 5)   ** #
+# **         and tabular output (outfmt 6)                       ** #
+# ***************************************************************** #
+
+
+import argparse
+import os,sys
+import random
+import tempfile
+import time
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+from scroogeclasses import iter_blast_hits
+
+
+XMLHEADER = """<?xml version="1.0"?>
+<BlastOutput>
+  <BlastOutput_program>blastx</BlastOutput_program>
+  <BlastOutput_version>BLASTX 2.2.31+</BlastOutput_version>
+  <BlastOutput_reference>benchmark</BlastOutput_reference>
+  <BlastOutput_db>SCGdb</BlastOutput_db>
+  <BlastOutput_query-ID>Query_1</BlastOutput_query-ID>
+  <BlastOutput_query-def>contig0</BlastOutput_query-def>
+  <BlastOutput_query-len>1000</BlastOutput_query-len>
+  <BlastOutput_param><Parameters><Parameters_matrix>BLOSUM62</Parameters_matrix><Parameters_expect>10</Parameters_expect><Parameters_gap-open>11</Parameters_gap-open><Parameters_gap-extend>1</Parameters_gap-extend><Parameters_filter>L;</Parameters_filter></Parameters></BlastOutput_param>
+  <BlastOutput_iterations>
+"""
+
+XMLITERATION = """    <Iteration>
+      <Iteration_iter-num>%(num)d</Iteration_iter-num>
+      <Iteration_query-ID>Query_%(num)d</Iteration_query-ID>
+      <Iteration_query-def>%(qid)s some description</Iteration_query-def>
+      <Iteration_query-len>%(qlen)d</Iteration_query-len>
+      <Iteration_hits>
+        <Hit>
+          <Hit_num>1</Hit_num>
+          <Hit_id>%(sid)s</Hit_id>
+          <Hit_def>single copy gene %(sid)s</Hit_def>
+          <Hit_accession>%(sid)s</Hit_accession>
+          <Hit_len>%(slen)d</Hit_len>
+          <Hit_hsps>
+            <Hsp>
+              <Hsp_num>1</Hsp_num>
+              <Hsp_bit-score>250.5</Hsp_bit-score>
+              <Hsp_score>640</Hsp_score>
+              <Hsp_evalue>1e-70</Hsp_evalue>
+              <Hsp_query-from>%(qstart)d</Hsp_query-from>
+              <Hsp_query-to>%(qend)d</Hsp_query-to>
+              <Hsp_hit-from>1</Hsp_hit-from>
+              <Hsp_hit-to>%(slen)d</Hsp_hit-to>
+              <Hsp_query-frame>1</Hsp_query-frame>
+              <Hsp_hit-frame>0</Hsp_hit-frame>
+              <Hsp_identity>%(slen)d</Hsp_identity>
+              <Hsp_positive>%(slen)d</Hsp_positive>
+              <Hsp_gaps>0</Hsp_gaps>
+              <Hsp_align-len>%(slen)d</Hsp_align-len>
+              <Hsp_qseq>%(prot)s</Hsp_qseq>
+              <Hsp_hseq>%(prot)s</Hsp_hseq>
+              <Hsp_midline>%(prot)s</Hsp_midline>
+            </Hsp>
+          </Hit_hsps>
+        </Hit>
+      </Iteration_hits>
+      <Iteration_stat><Statistics><Statistics_db-num>1000</Statistics_db-num><Statistics_db-len>400000</Statistics_db-len><Statistics_hsp-len>0</Statistics_hsp-len><Statistics_eff-space>0</Statistics_eff-space><Statistics_kappa>0.041</Statistics_kappa><Statistics_lambda>0.267</Statistics_lambda><Statistics_entropy>0.14</Statistics_entropy></Statistics></Iteration_stat>
+    </Iteration>
+"""
+
+XMLFOOTER = """  </BlastOutput_iterations>
+</BlastOutput>
+"""
+
+TABULARFORMAT = "6 qseqid sseqid qstart qend evalue"
+
+
+def write_hits(nhits,xmlfile,tabularfile):
+    random.seed(nhits)
+    fx = open(xmlfile,"w")
+    ft = open(tabularfile,"w")
+    fx.write(XMLHEADER)
+    for i in range(nhits):
+        slen = random.randint(100,600)
+        qstart = random.randint(1,5000)
+        hit = {"num":i+1,"qid":"contig%d"%i,"qlen":qstart + 3*slen + 1000,"sid":"SCG%d"%random.randint(0,999),"slen":slen,
+               "qstart":qstart,"qend":qstart + 3*slen - 1,"prot":"".join([random.choice("ACDEFGHIKLMNPQRSTVWY") for j in range(slen)])}
+        fx.write(XMLITERATION%hit)
+        ft.write("%(qid)s\t%(sid)s\t%(qstart)d\t%(qend)d\t1e-70\n"%hit)
+    fx.write(XMLFOOTER)
+    fx.close()
+    ft.close()
+
+
+def time_parser(filename,outfmt,repeat):
+    best = None
+    for r in range(repeat):
+        t = time.time()
+        hits = list(iter_blast_hits(filename,outfmt))
+        t = time.time() - t
+        if best == None or t < best:
+            best = t
+    return best,hits
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n","--hits",type=int,default=20000)
+    parser.add_argument("-r","--repeat",type=int,default=3)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    xmlfile = os.path.join(tmpdir,"hits.xml")
+    tabularfile = os.path.join(tmpdir,"hits.tsv")
+    write_hits(args.hits,xmlfile,tabularfile)
+
+    txml,hxml = time_parser(xmlfile,"5",args.repeat)
+    ttab,htab = time_parser(tabularfile,TABULARFORMAT,args.repeat)
+    if hxml != htab:
+        print >> sys.stderr,"ERROR: parsers disagree"
+        exit(1)
+
+    print "hits                 : %d"%args.hits
+    print "XML      (outfmt 5)  : %8.3lfs  %10d bytes"%(txml,os.path.getsize(xmlfile))
+    print "tabular  (outfmt 6)  : %8.3lfs  %10d bytes"%(ttab,os.path.getsize(tabularfile))
+    print "speedup              : %8.1lfx"%(txml/ttab)
+
+    for f in [xmlfile,tabularfile]:
+        os.remove(f)
+    os.rmdir(tmpdir)
+
+
+if __name__ == "__main__":
+    main()
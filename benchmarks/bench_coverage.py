@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# ***************************************************************** #
+# **         micro-benchmarks of coverage counting, writing      ** #
+# **         and parsing of coverage files                       ** #
+# ***************************************************************** #
+
+
+import argparse
+import os,sys
+import shutil
+import tempfile
+
+import numpy as np
+
+BENCHDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.join(BENCHDIR,".."))
+from scroogeclasses import SequenceRecord,SingleCopyGeneList
+from benchutil import timeit,check_baselines
+
+
+def make_scg(nscg,length,seed):
+    rng = np.random.RandomState(seed)
+    scg = SingleCopyGeneList()
+    for i in range(nscg):
+        scg.add_sequence("SCG%d"%i,"".join(rng.choice(list("ACGT"),length)))
+    return scg
+
+
+def make_reads(nscg,length,nreads,readlength,seed):
+    rng = np.random.RandomState(seed)
+    tids = rng.randint(0,nscg,nreads)
+    starts = rng.randint(0,length-readlength,nreads)
+    return tids,starts,starts + readlength
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n","--scgs",type=int,default=1000)
+    parser.add_argument("-l","--length",type=int,default=1000)
+    parser.add_argument("-r","--reads",type=int,default=200000)
+    parser.add_argument("-L","--readlength",type=int,default=100)
+    parser.add_argument("-R","--repeat",type=int,default=3)
+    parser.add_argument("-b","--baseline",default=os.path.join(BENCHDIR,"baselines.json"))
+    parser.add_argument("-t","--tolerance",type=float,default=1.5)
+    parser.add_argument("-u","--update",default=False,action="store_true",
+                        help="store current timings as baseline")
+    args = parser.parse_args()
+
+    tids,starts,ends = make_reads(args.scgs,args.length,args.reads,args.readlength,1)
+    ids = ["SCG%d"%i for i in range(args.scgs)]
+    results = {}
+
+    def sequencerecord():
+        record = SequenceRecord("SCG0","A"*args.length)
+        for s,e in zip(starts,ends):
+            record.add_coverage(s,e)
+        return record
+    results["SequenceRecord.add_coverage"],r = timeit(sequencerecord,args.repeat)
+
+    def scglist():
+        scg = make_scg(args.scgs,args.length,1)
+        for t,s,e in zip(tids,starts,ends):
+            scg.add_coverage(ids[t],s,e)
+        return scg
+    results["SingleCopyGeneList.add_coverage"],scg = timeit(scglist,args.repeat)
+
+    def scglistarray():
+        scg = make_scg(args.scgs,args.length,1)
+        scg.set_references(ids)
+        scg.add_coverage_tids(tids,starts,ends)
+        return scg
+    results["SingleCopyGeneList.add_coverage_tids"],scgarray = timeit(scglistarray,args.repeat)
+    if not np.array_equal(scg.get_engine().get_depth(),scgarray.get_engine().get_depth()):
+        print >> sys.stderr,"ERROR: per-read and vectorized coverage differ"
+        exit(1)
+
+    tmpdir = tempfile.mkdtemp()
+    textfile = os.path.join(tmpdir,"coverage.txt")
+    binaryfile = os.path.join(tmpdir,"coverage.bin")
+    bedgraphfile = os.path.join(tmpdir,"coverage.bedgraph.gz")
+    results["write_coverage_file"],r = timeit(lambda:scg.write_coverage_file(textfile),args.repeat)
+    results["write_binary_coverage_file"],r = timeit(lambda:scg.write_binary_coverage_file(binaryfile),args.repeat)
+    results["write_bedgraph_coverage_file"],r = timeit(lambda:scg.write_bedgraph_coverage_file(bedgraphfile),args.repeat)
+
+    try:
+        from analyze_coverage import coverageclass
+    except ImportError as e:
+        print >> sys.stderr,"WARNING: could not import analyze_coverage (%s), skipping parser benchmarks"%e
+        coverageclass = None
+    if coverageclass != None:
+        results["coverageclass(text)"],r = timeit(lambda:coverageclass(textfile),args.repeat)
+        results["coverageclass(binary)"],r = timeit(lambda:coverageclass(binaryfile),args.repeat)
+        results["coverageclass(bedgraph)"],r = timeit(lambda:coverageclass(bedgraphfile),args.repeat)
+    shutil.rmtree(tmpdir,ignore_errors = True)
+
+    print "%d SCGs of length %d, %d reads of length %d"%(args.scgs,args.length,args.reads,args.readlength)
+    regressions = check_baselines(results,args.baseline,"coverage",args.tolerance,args.update)
+    if len(regressions) > 0:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# ***************************************************************** #
+# **         end-to-end timings of scrooge on a synthetic        ** #
+# **         genome, with stand-in executables for BLAST and     ** #
+# **         bowtie2 (runs offline)                              ** #
+# ***************************************************************** #
+
+
+import argparse
+import json
+import os,sys
+import re
+import shutil
+import subprocess
+
+BENCHDIR = os.path.dirname(os.path.abspath(__file__))
+SCROOGE = os.path.join(BENCHDIR,"..","scrooge.py")
+sys.path.insert(0,BENCHDIR)
+sys.path.insert(0,os.path.join(BENCHDIR,".."))
+from synthetic import generate
+from benchutil import timeit,check_baselines
+from scroogeclasses import BinaryCoverageFile
+
+
+# name -> additional command line options of scrooge
+MODES = [
+    ("default",    []),
+    ("stream",     ["--stream"]),
+    ("processes2", ["--processes","2"]),
+    ("adaptive",   ["--adaptive","0.02","--chunkreads","20000"]),
+    ("prefilter",  ["--prefilter"]),
+    ("kmer",       ["--kmercoverage"]),
+    ("searchshards",["--searchshards","4"]),
+    ]
+
+# sensitivity of these modes is measured relative to mapping all reads
+FILTERMODES = ["prefilter"]
+
+
+def run_scrooge(datadir,tmpdir,options):
+    truth = json.load(open(os.path.join(datadir,"truth.json")))
+    cmdline = [sys.executable,SCROOGE,"-V",
+               "-O",os.path.join(datadir,"config.xml"),
+               "-t",tmpdir,
+               "-D",os.path.join(datadir,"scgdb.fasta"),
+               "-q",os.path.join(datadir,"assembly.fasta"),
+               "-r",truth["readfile"],
+               "-c",os.path.join(tmpdir,"coverage.out")] + options
+    shutil.rmtree(tmpdir,ignore_errors = True)
+    p = subprocess.Popen(cmdline,stdout = subprocess.PIPE,stderr = subprocess.PIPE)
+    out,err = p.communicate()
+    if p.returncode != 0:
+        print >> sys.stderr,err
+        raise RuntimeError("scrooge failed: %s"%" ".join(cmdline))
+    m = re.search(r"GENOME SIZE: (\d+)",out)
+    if m == None:
+        return None
+    return int(m.group(1))
+
+
+def mapped_reads(datadir,mode):
+    """ reads counted on SCGs in the coverage file of a mode """
+    coverage = BinaryCoverageFile(os.path.join(datadir,"tmp." + mode,"coverage.out"))
+    return int(coverage.get_counts().sum())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d","--datadir",default=os.path.join(BENCHDIR,"data"),
+                        help="directory for synthetic data, generated if missing")
+    parser.add_argument("-g","--genomesize",type=int,default=2000000)
+    parser.add_argument("-c","--coverage",type=float,default=20.)
+    parser.add_argument("-m","--modes",default=",".join([m[0] for m in MODES]))
+    parser.add_argument("-R","--repeat",type=int,default=1)
+    parser.add_argument("-a","--accuracy",type=float,default=0.1,
+                        help="maximal relative error of genome size estimate")
+    parser.add_argument("-b","--baseline",default=os.path.join(BENCHDIR,"baselines.json"))
+    parser.add_argument("-t","--tolerance",type=float,default=1.5)
+    parser.add_argument("-u","--update",default=False,action="store_true",
+                        help="store current timings as baseline")
+    args = parser.parse_args()
+
+    truthfile = os.path.join(args.datadir,"truth.json")
+    truth = None
+    if os.path.isfile(truthfile):
+        truth = json.load(open(truthfile))
+    if truth == None or truth["genomesize"] != args.genomesize or abs(truth["coverage"] - args.coverage) > 1e-6:
+        print "generating synthetic data in '%s'"%args.datadir
+        truth = generate(args.datadir,genomesize = args.genomesize,coverage = args.coverage)
+
+    results = {}
+    failed = []
+    modes = dict(MODES)
+    for mode in args.modes.split(","):
+        tmpdir = os.path.join(args.datadir,"tmp." + mode)
+        t,estimate = timeit(lambda:run_scrooge(args.datadir,tmpdir,modes[mode]),args.repeat)
+        results[mode] = t
+        error = abs(estimate - truth["genomesize"])/float(truth["genomesize"]) if estimate != None else float("inf")
+        print "%-12s %8.2lfs  genome size %s (true %d, error %.3lf)"%(mode,t,estimate,truth["genomesize"],error)
+        if error > args.accuracy:
+            failed.append(mode)
+
+    for mode in FILTERMODES:
+        if results.has_key(mode) and results.has_key("default"):
+            reference = mapped_reads(args.datadir,"default")
+            print "%-12s sensitivity %.4lf (%d of %d reads on SCGs)"%(mode,mapped_reads(args.datadir,mode)/float(max(1,reference)),mapped_reads(args.datadir,mode),reference)
+
+    print "genome size %d, coverage %.1lf, %d SCGs"%(truth["genomesize"],truth["coverage"],truth["scgs"])
+    regressions = check_baselines(results,args.baseline,"pipeline",args.tolerance,args.update)
+    if len(failed) > 0:
+        print >> sys.stderr,"ERROR: inaccurate genome size in modes %s"%", ".join(failed)
+    if len(failed) + len(regressions) > 0:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
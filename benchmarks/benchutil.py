@@ -0,0 +1,46 @@
+# ***************************************************************** #
+# **         timing and comparison against stored baselines      ** #
+# ***************************************************************** #
+
+
+import json
+import os
+import time
+
+
+def timeit(func,repeat = 3):
+    """ best wall time of 'repeat' calls, and the result of the last call """
+    best = None
+    for r in range(repeat):
+        t = time.time()
+        result = func()
+        t = time.time() - t
+        if best == None or t < best:
+            best = t
+    return best,result
+
+
+def check_baselines(results,filename,section,tolerance = 1.5,update = False):
+    """ compare timings with stored values, a result is a regression if it
+    is more than 'tolerance' times slower; return list of regressions """
+    baselines = {}
+    if os.path.isfile(filename):
+        baselines = json.load(open(filename))
+    stored = baselines.get(section,{})
+    regressions = []
+    for name in sorted(results.keys()):
+        t = results[name]
+        if stored.has_key(name):
+            ratio = t/stored[name] if stored[name] > 0 else float("inf")
+            flag = "SLOWER" if ratio > tolerance else ""
+            print "  %-40s %10.4lfs  baseline %10.4lfs  %6.2lfx %s"%(name,t,stored[name],ratio,flag)
+            if ratio > tolerance:
+                regressions.append(name)
+        else:
+            print "  %-40s %10.4lfs  (no baseline)"%(name,t)
+    if update:
+        baselines[section] = results
+        f = open(filename,"w")
+        json.dump(baselines,f,indent = 2,sort_keys = True)
+        f.close()
+    return regressions
@@ -0,0 +1,69 @@
+# ***************************************************************** #
+# **         shared helpers of the stand-in executables          ** #
+# **         (work with python 2 and 3)                          ** #
+# ***************************************************************** #
+
+
+import gzip
+import os
+import sys
+
+
+def getoption(argv,name,default = None):
+    """ value following '-name' on the command line """
+    if "-" + name in argv:
+        i = argv.index("-" + name)
+        if i + 1 < len(argv):
+            return argv[i+1]
+    return default
+
+
+def open_text(filename,mode = "r"):
+    if filename == "-":
+        # buffered, also with PYTHONUNBUFFERED set
+        if mode == "r":
+            return os.fdopen(os.dup(sys.stdin.fileno()),"r",1<<16)
+        return sys.stdout
+    if filename.endswith(".gz"):
+        if sys.version_info[0] >= 3:
+            return gzip.open(filename,mode + "t")
+        return gzip.open(filename,mode)
+    return open(filename,mode)
+
+
+def iter_fasta(fp):
+    name = None
+    seq = []
+    for line in fp:
+        line = line.strip()
+        if line.startswith(">"):
+            if name != None:
+                yield name,"".join(seq)
+            name = line[1:].split()[0]
+            seq = []
+        elif line:
+            seq.append(line)
+    if name != None:
+        yield name,"".join(seq)
+
+
+def iter_reads(fp):
+    """ (name,sequence) of FASTA or FASTQ records """
+    line = fp.readline()
+    while line:
+        if line.startswith("@"):
+            seq = fp.readline().strip()
+            fp.readline()
+            fp.readline()
+            yield line[1:].split()[0],seq
+            line = fp.readline()
+        elif line.startswith(">"):
+            name = line[1:].split()[0]
+            seq = []
+            line = fp.readline()
+            while line and not line.startswith(">"):
+                seq.append(line.strip())
+                line = fp.readline()
+            yield name,"".join(seq)
+        else:
+            line = fp.readline()
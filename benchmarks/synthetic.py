@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# ***************************************************************** #
+# **         synthetic genome with known size and SCGs,          ** #
+# **         simulated reads and precomputed outputs for the     ** #
+# **         stand-in executables in 'stubs'                     ** #
+# ***************************************************************** #
+
+
+import argparse
+import bisect
+import gzip
+import json
+import os,sys
+import random
+import xml.etree.ElementTree as ET
+
+BENCHDIR = os.path.dirname(os.path.abspath(__file__))
+STUBDIR = os.path.join(BENCHDIR,"stubs")
+REPODIR = os.path.join(BENCHDIR,"..")
+
+STUBS = {"scgminingcreatedb":"makeblastdb","scgminingsearch":"blastx","generatehashfile":"bowtie2-build","mapping":"bowtie2"}
+
+
+def random_sequence(rng,n):
+    return "".join([rng.choice("ACGT") for i in range(n)])
+
+
+def write_fasta(filename,records,linewidth = 60):
+    f = open(filename,"w")
+    for name,seq in records:
+        f.write(">%s\n"%name)
+        for i in range(0,len(seq),linewidth):
+            f.write(seq[i:i+linewidth] + "\n")
+    f.close()
+
+
+def write_config(filename,outdir):
+    """ copy of the default option file with executables replaced by
+    stubs and options pointing to the precomputed outputs """
+    tree = ET.parse(os.path.join(REPODIR,"config.externalprograms.xml"))
+    for program in tree.getroot():
+        step = program.attrib.get("step")
+        if not STUBS.has_key(step):
+            continue
+        program.find("executable").text = os.path.join(STUBDIR,STUBS[step])
+        if step == "scgminingsearch":
+            ET.SubElement(program,"option",name = "precomputed").text = os.path.join(outdir,"hits.tsv")
+        elif step == "mapping":
+            ET.SubElement(program,"option",name = "precomputed").text = os.path.join(outdir,"alignments.tsv")
+    tree.write(filename)
+
+
+def generate(outdir,genomesize = 2000000,contigs = 200,scgs = 100,scglength = (600,1500),
+             readlength = 100,coverage = 20.,fastq = False,compress = False,seed = 1):
+    """ write assembly, database, reads, precomputed hits/alignments,
+    option file and 'truth.json' to 'outdir', return the truth """
+    rng = random.Random(seed)
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    # contig lengths summing up to genome size
+    cuts = sorted(rng.sample(range(1,genomesize),contigs-1))
+    lengths = [b-a for a,b in zip([0]+cuts,cuts+[genomesize])]
+    assembly = [("contig%d"%i,random_sequence(rng,l)) for i,l in enumerate(lengths)]
+    write_fasta(os.path.join(outdir,"assembly.fasta"),assembly)
+    write_fasta(os.path.join(outdir,"scgdb.fasta"),[("SCG%d"%i,"M"*100) for i in range(scgs)])
+
+    # one SCG on each of the longest contigs; scrooge cuts seq[qstart:qend]
+    regions = {}
+    hits = open(os.path.join(outdir,"hits.tsv"),"w")
+    for i in sorted(sorted(range(contigs),key = lambda i:-lengths[i])[:scgs]):
+        name,seq = assembly[i]
+        l = min(rng.randint(*scglength),len(seq)-2)
+        if l < scglength[0]:
+            continue
+        qstart = rng.randint(1,len(seq)-l)
+        qend = qstart + l
+        regions[name] = (name + "1",qstart,qend)
+        hits.write("%s\tSCG%d\t%d\t%d\t1e-50\n"%(name,len(regions)-1,qstart,qend))
+    hits.close()
+
+    # error free reads, uniformly from the genome; reads inside an SCG are aligned
+    nreads = int(coverage*genomesize/readlength)
+    ext = ".fastq" if fastq else ".fasta"
+    readfile = os.path.join(outdir,"reads" + ext + (".gz" if compress else ""))
+    fr = gzip.open(readfile,"w") if compress else open(readfile,"w")
+    fa = open(os.path.join(outdir,"alignments.tsv"),"w")
+    valid = [(name,seq) for name,seq in assembly if len(seq) >= readlength]
+    weights = [len(seq)-readlength+1 for name,seq in valid]
+    total = float(sum(weights))
+    cumulative = []
+    s = 0
+    for w in weights:
+        s += w
+        cumulative.append(s/total)
+    for r in range(nreads):
+        name,seq = valid[min(bisect.bisect(cumulative,rng.random()),len(valid)-1)]
+        p = rng.randint(0,len(seq)-readlength)
+        read = seq[p:p+readlength]
+        rname = "read%d"%r
+        if fastq:
+            fr.write("@%s\n%s\n+\n%s\n"%(rname,read,"I"*readlength))
+        else:
+            fr.write(">%s\n%s\n"%(rname,read))
+        if regions.has_key(name):
+            sid,qstart,qend = regions[name]
+            if p >= qstart and p+readlength <= qend:
+                fa.write("%s\t%s\t%d\t%dM\n"%(rname,sid,p-qstart+1,readlength))
+    fr.close()
+    fa.close()
+
+    write_config(os.path.join(outdir,"config.xml"),os.path.abspath(outdir))
+
+    truth = {"genomesize":genomesize,"contigs":contigs,"scgs":len(regions),"readlength":readlength,
+             "reads":nreads,"bases":nreads*readlength,"coverage":nreads*readlength/float(genomesize),
+             "readfile":readfile,"seed":seed}
+    f = open(os.path.join(outdir,"truth.json"),"w")
+    json.dump(truth,f,indent = 2,sort_keys = True)
+    f.close()
+    return truth
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "generate synthetic benchmark data for scrooge")
+    parser.add_argument("-o","--outdir",default="benchdata")
+    parser.add_argument("-g","--genomesize",type=int,default=2000000)
+    parser.add_argument("-n","--contigs",type=int,default=200)
+    parser.add_argument("-s","--scgs",type=int,default=100)
+    parser.add_argument("-l","--readlength",type=int,default=100)
+    parser.add_argument("-c","--coverage",type=float,default=20.)
+    parser.add_argument("-q","--fastq",default=False,action="store_true")
+    parser.add_argument("-z","--gzip",default=False,action="store_true")
+    parser.add_argument("-S","--seed",type=int,default=1)
+    args = parser.parse_args()
+
+    truth = generate(args.outdir,args.genomesize,args.contigs,args.scgs,readlength = args.readlength,coverage = args.coverage,
+                     fastq = args.fastq,compress = args.gzip,seed = args.seed)
+    print json.dumps(truth,indent = 2,sort_keys = True)
+
+
+if __name__ == "__main__":
+    main()
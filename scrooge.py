@@ -9,13 +9,13 @@
 
 
 
-from Bio.Blast import NCBIXML
-from Bio import SeqIO
 import argparse
 import sys
 import os.path
-import pysam
+import subprocess,threading,time,itertools,copy,re
+from math import ceil
 
+# pysam, NumPy and Biopython are only imported by the steps using them
 from scroogeclasses import *
 
 def print_error(errormsg):
@@ -23,9 +23,680 @@ def print_error(errormsg):
     parser.print_usage(sys.stderr)
     exit(1)
 
+# least query length per process of a sharded BLAST search
+SEARCH_SHARD_BASES = 1<<20
+
 def tmpfile(filename):
     return os.path.join(args.tmpdir,filename)
 
+def execute_cached(program,inputfiles,outputprefix):
+    """ run program, unless its output is found in the artifact cache;
+    output files are written under a temporary prefix and renamed once
+    the program succeeded, an interrupted run leaves no partial output """
+    key = None
+    if cache != None and inputfiles != None:
+	key = cache.key(program,inputfiles,outputprefix)
+	if cache.fetch(key,outputprefix):
+	    return None
+    partial = partial_prefix(outputprefix)
+    program.replace_value(outputprefix,partial)
+    try:
+	pid = program.execute()
+    finally:
+	program.replace_value(partial,outputprefix)
+    if pid != None and pid.returncode == 0:
+	rename_prefixed(partial,outputprefix)
+	if key != None:
+	    cache.store(key,outputprefix)
+    return pid
+
+def assign_threads(program):
+    """ set thread option of program to the processors of the current step """
+    threads = step_threads()
+    if threads != None:
+	program.set_threads(threads)
+
+def load_program(step):
+    try:
+	return externalprogram(config,step,not args.nonverbose)
+    except ValueError:
+	print_error("Could not find options for step '%s' in file '%s'"%(step,args.optionfile))
+    except:
+	print_error("weird error!")
+
+
+
+# ***************************************************************** #
+# **         pipeline steps, failures raise PipelineError        ** #
+# ***************************************************************** #
+def run_program(program,inputfiles = None,outputprefix = None):
+    if not program.check_existence():
+	raise PipelineError("could not find executable '%s'"%program.get_executable())
+    assign_threads(program)
+    if outputprefix != None:
+	pid = execute_cached(program,inputfiles,outputprefix)
+    else:
+	pid = program.execute()
+    if pid != None and pid.returncode != 0:
+	raise PipelineError("'%s' returned %d"%(program.get_executable(),pid.returncode))
+
+def run_search(blastsearch):
+    # check for db files
+    if not file_exists(blastsearch.get_files("db")):
+	raise PipelineError("check of database files failed for '%s'"%blastsearch.get_option("db"))
+    cpus = step_threads() or 1
+    names,lengths = fasta_lengths(blastsearch.get_option("query"))
+    shards = args.searchshards
+    if shards == 0:
+	# one process per processor, each with a share of the query long enough to be worth starting
+	shards = min(cpus,int(ceil(sum(lengths)/float(SEARCH_SHARD_BASES))))
+    # only tabular output without comment lines can be merged
+    if min(shards,len(names)) <= 1 or str(blastsearch.get_option("outfmt")).split()[0] not in ["6","10"]:
+	run_program(blastsearch,outputprefix = blastsearch.get_option("out"))
+    elif not run_sharded_search(blastsearch,names,lengths,shards,cpus):
+	print >> sys.stderr,"WARNING: query ids of BLAST output do not match the query file, repeating search in one process"
+	run_program(blastsearch,outputprefix = blastsearch.get_option("out"))
+
+def search_key(blastsearch):
+    """ options and stamps of all database files '<db>.*' of the search """
+    try:
+	files = prefixed_files(blastsearch.get_option("db"))
+    except OSError:
+	files = []
+    return [blastsearch.get_signature(),[file_stamp(f) for f in files]]
+
+def run_sharded_search(blastsearch,names,lengths,nshards,cpus):
+    """ search shards of the query with similar total length at the same time,
+    processors are split among them; return False if their output could not
+    be merged """
+    if not blastsearch.check_existence():
+	raise PipelineError("could not find executable '%s'"%blastsearch.get_executable())
+    shards = shard_references(lengths,nshards)
+    queries = split_fasta(blastsearch.get_option("query"),shards,tmpfile("query.shard"))
+    outputs = [tmpfile("blastsearch.shard.%d"%i) for i in range(len(shards))]
+    procs = []
+    for i in range(len(shards)):
+	program = copy.deepcopy(blastsearch)
+	program.set_option("query",queries[i])
+	program.set_option("out",outputs[i])
+	program.set_stderr(tmpfile("stderr.blastsearch.%d"%i))
+	program.set_stdout(tmpfile("stdout.blastsearch.%d"%i))
+	program.set_threads(max(1,cpus//len(shards) + (i < cpus%len(shards))))
+	procs.append((program,program.execute(wait=False)))
+    for program,pid in procs:
+	if pid == None:
+	    raise PipelineError("could not run '%s'"%program.get_executable())
+	if pid.wait() != 0:
+	    raise PipelineError("'%s' returned %d"%(program.get_executable(),pid.returncode))
+    out = blastsearch.get_option("out")
+    partial = partial_prefix(out)
+    merged = merge_blast_tabular(outputs,names,partial,blastsearch.get_option("outfmt"))
+    if merged:
+	os.rename(partial,out)
+    for f in queries + outputs:
+	os.remove(f)
+    return merged
+
+def check_reads(reads):
+    """ return list of read files and their common format """
+    if reads == None:
+	raise PipelineError("need read file")
+    try:
+	files = expand_read_files(reads)
+    except IOError as e:
+	raise PipelineError(str(e))
+    for f in files:
+	if not os.path.isfile(f):
+	    raise PipelineError("could not find read file '%s'"%f)
+    if len(files) == 0:
+	raise PipelineError("need read file")
+    formats = set([read_format(f) for f in files])
+    if len(formats) > 1:
+	raise PipelineError("read files mix FASTA and FASTQ format")
+    record_count("files",len(files))
+    return files,formats.pop()
+
+def set_read_format(bowtie,fileformat):
+    if fileformat == "fastq":
+	bowtie.del_option("f")
+	bowtie.set_option("q",None)
+    else:
+	bowtie.del_option("q")
+	bowtie.set_option("f",None)
+
+def start_feeder(bowtieproc,files,stats,readfilter = None):
+    """ decompress reads into stdin of the aligner in a separate thread,
+    with a prefilter only reads sharing k-mers with SCGs are passed on """
+    threads = max(1,min(len(files),(step_threads() or 1)//4))
+    if readfilter != None:
+	from scroogekmers import filter_reads
+	feeder = threading.Thread(target = filter_reads,args = (bowtieproc.stdin,files,readfilter,threads,stats))
+    else:
+	feeder = threading.Thread(target = feed_reads,args = (bowtieproc.stdin,files,threads,stats))
+    feeder.start()
+    return feeder
+
+def fed_reads(stats,name = None):
+    """ number of reads and bases, including reads dropped by the prefilter """
+    if stats.get("error") != None:
+	raise PipelineError("could not read reads: %s"%stats["error"])
+    record_count("reads",stats["reads"])
+    record_count("bases",stats["bases"])
+    if stats.has_key("kept"):
+	record_count("dropped",stats["reads"] - stats["kept"])
+	if not args.nonverbose:
+	    write_output("PREFILTER: %s%d of %d reads passed to aligner, %d dropped"%(name + ": " if name != None else "",stats["kept"],stats["reads"],stats["reads"] - stats["kept"]))
+    return stats["reads"],stats["bases"]
+
+def map_reads(bowtie,reads,name = None,readfilter = None):
+    """ run aligner on reads fed through its stdin, return number of reads and bases """
+    files,fileformat = reads
+    if not bowtie.check_existence():
+	raise PipelineError("could not find executable '%s'"%bowtie.get_executable())
+    set_read_format(bowtie,fileformat)
+    assign_threads(bowtie)
+    # alignments are renamed to their final name once the aligner succeeded
+    samfile = bowtie.get_option("S")
+    bowtie.replace_value(samfile,partial_prefix(samfile))
+    try:
+	bowtieproc = bowtie.execute(wait=False,stdin=subprocess.PIPE)
+    finally:
+	bowtie.replace_value(partial_prefix(samfile),samfile)
+    if bowtieproc == None:
+	raise PipelineError("could not run '%s'"%bowtie.get_executable())
+    stats = {}
+    feeder = start_feeder(bowtieproc,files,stats,readfilter)
+    feeder.join()
+    if bowtieproc.wait() != 0:
+	raise PipelineError("mapping failed, see '%s'"%tmpfile(library_file("stderr.bowtie",name)))
+    os.rename(partial_prefix(samfile),samfile)
+    return fed_reads(stats,name)
+
+
+def extract_scg(blastsearch,scgfile):
+    # ***************************************************************** #
+    # **         building list of single copy genes                  ** #
+    # **         by assigning correct identifiers for SCGs and       ** #
+    # **         introducing cutoff in length                        ** #
+    # ***************************************************************** #
+    # only the regions of SCGs are read from the assembly
+    indexfile = args.query + ".fai"
+    if not os.access(os.path.dirname(os.path.abspath(args.query)),os.W_OK):
+	indexfile = tmpfile(os.path.basename(args.query) + ".fai")
+    assembly = FastaIndex(args.query,indexfile)
+    # hits from tabular or XML output of blast
+    scg_blast_hits = iter_blast_hits(blastsearch.get_option("out"),blastsearch.get_option("outfmt"))
+
+    scg = new_scg_list()
+
+    lastqid = None
+    for qid,query_start,query_end in scg_blast_hits:
+	if qid != lastqid:
+	    n=1
+	    lastqid = qid
+	s = min(query_start,query_end)
+	e = max(query_start,query_end)
+	scg.add_sequence(qid+str(n),assembly.fetch(qid,s,e))
+	n+=1
+	record_count("hits",1)
+
+    assembly.close()
+    record_count("scgs",len(scg.get_ids()))
+    write_atomic(scgfile,scg.write_sequence_file)
+    return scg
+
+def new_scg_list():
+    return SingleCopyGeneList(scglength = args.cutofflength, readlength = args.readminlength,
+			      summarybins = args.histbins if args.summaryonly else None,
+			      fractions = args.rarefaction)
+
+def load_scg(scgfile):
+    """ SCGs written by 'extract_scg', if the extraction is skipped on resume """
+    scg = new_scg_list()
+    fp = open(scgfile)
+    for record,length in iter_reads(fp):
+	scg.add_sequence(record.split("\n",1)[0][1:].strip(),record_sequence(record))
+    fp.close()
+    return scg
+
+
+def get_coverage(scg,bowtie,reads = None,name = None,readfilter = None):
+    """ count coverage from alignments, in stream mode the aligner is run
+    here and the number of reads and bases is returned """
+    import pysam
+    cpus = step_threads() or args.threads
+    if args.stream:
+	files,fileformat = reads
+	set_read_format(bowtie,fileformat)
+	assign_threads(bowtie)
+	bowtieproc = bowtie.execute(pipe=True,stdin=subprocess.PIPE)
+	if bowtieproc == None:
+	    raise PipelineError("could not run '%s'"%bowtie.get_executable())
+	stats = {}
+	feeder = start_feeder(bowtieproc,files,stats,readfilter)
+	samfile = pysam.Samfile(bowtieproc.stdout,"r")
+    else:
+	samfile = pysam.Samfile(bowtie.get_option("S"),"r")
+
+    if args.bamfile != None:
+	# renamed when all alignments are written
+	outbamfile = partial_prefix(library_file(args.bamfile,name))
+    else:
+	outbamfile = None
+
+    if args.processes > 1 or args.summaryonly:
+	# sort and index alignments, then count shards of SCGs in separate processes,
+	# summaries of coverage need alignments in order of their position
+	if args.stream:
+	    unsortedfile = tmpfile(library_file("mapping.bam",name))
+	    bamfile = pysam.Samfile(unsortedfile,"wb",template=samfile)
+	    for alignment in tee_alignments(samfile.fetch(until_eof=True),bamfile):
+		pass
+	    bamfile.close()
+	else:
+	    unsortedfile = bowtie.get_option("S")
+	samfile.close()
+	if args.stream:
+	    feeder.join()
+	    if bowtieproc.wait() != 0:
+		raise PipelineError("mapping failed, see '%s'"%tmpfile(library_file("stderr.bowtie",name)))
+	if outbamfile != None:
+	    sortedfile = outbamfile
+	else:
+	    sortedfile = tmpfile(library_file("mapping.sorted.bam",name))
+	pysam.sort("-@",str(cpus),"-o",sortedfile,unsortedfile)
+	pysam.index(sortedfile)
+	count_coverage_parallel(scg,sortedfile,args.processes,threads = max(1,cpus//args.processes))
+    else:
+	scg.set_references(samfile.references)
+	alignments = samfile.fetch(until_eof=True)
+	if outbamfile != None:
+	    bamfile = pysam.Samfile(outbamfile,"wb",template=samfile)
+	    alignments = tee_alignments(alignments,bamfile)
+	count_coverage(scg,alignments)
+	samfile.close()
+	if outbamfile != None:
+	    bamfile.close()
+	if args.stream:
+	    feeder.join()
+	    if bowtieproc.wait() != 0:
+		raise PipelineError("mapping failed, see '%s'"%tmpfile(library_file("stderr.bowtie",name)))
+    if outbamfile != None:
+	rename_prefixed(outbamfile,library_file(args.bamfile,name))
+    if args.stream:
+	return fed_reads(stats,name)
+    return None
+
+
+def get_coverage_adaptive(scg,bowtie,reads,name = None,readfilter = None):
+    """ map reads in chunks of growing size with a single bowtie2 process,
+    after every chunk the genome size is estimated as for the result and
+    mapping stops once its confidence interval is narrower than
+    'args.adaptive' """
+    import pysam
+    files,fileformat = reads
+    set_read_format(bowtie,fileformat)
+    records = iter_read_files(files)
+    stats = {"reads":0,"bases":0}
+    if readfilter != None:
+	stats["kept"] = 0
+    # (reads passed to bowtie2,reads,bases,last chunk) at the end of every chunk,
+    # appended before the last reads of the chunk are written
+    boundaries = []
+    stop = threading.Event()
+    assign_threads(bowtie)
+
+    def feed(stdin):
+	# runs in its own thread and does not wait for the estimates,
+	# bowtie2 output is read at the same time
+	kept,reads,bases = 0,0,0
+	chunk = args.chunkreads
+	end = chunk
+	try:
+	    while not stop.is_set():
+		batch = list(itertools.islice(records,min(end - reads,10000)))
+		reads += len(batch)
+		bases += sum([length for record,length in batch])
+		last = (len(batch) == 0)
+		if readfilter != None and not last:
+		    keep = readfilter.select([record_sequence(record) for record,length in batch])
+		    batch = [b for b,k in zip(batch,keep) if k]
+		kept += len(batch)
+		if last or reads == end:
+		    boundaries.append((kept,reads,bases,last))
+		    chunk *= 2
+		    end += chunk
+		if last:
+		    break
+		stdin.write("".join([record for record,length in batch]))
+	    stdin.close()
+	except IOError:
+	    # bowtie2 was stopped
+	    pass
+
+    bowtieproc = bowtie.execute(pipe=True,stdin=subprocess.PIPE)
+    if bowtieproc == None:
+	raise PipelineError("could not run '%s'"%bowtie.get_executable())
+    feeder = threading.Thread(target = feed,args = (bowtieproc.stdin,))
+    feeder.start()
+    samfile = pysam.Samfile(bowtieproc.stdout,"r")
+    scg.set_references(samfile.references)
+    alignments = samfile.fetch(until_eof=True)
+    aligned = [0]
+
+    def chunk_alignments(i):
+	# alignments of the reads of the first i+1 chunks, one primary
+	# alignment per read passed to bowtie2
+	while len(boundaries) <= i or aligned[0] < boundaries[i][0]:
+	    alignment = next(alignments)
+	    if not (alignment.is_secondary or alignment.is_supplementary):
+		aligned[0] += 1
+	    yield alignment
+
+    i = 0
+    last = False
+    while True:
+	count_coverage(scg,chunk_alignments(i))
+	if len(boundaries) <= i:
+	    # bowtie2 ended before the chunk
+	    break
+	kept,stats["reads"],stats["bases"],last = boundaries[i]
+	if readfilter != None:
+	    stats["kept"] = kept
+	summary = genome_size_summary(scg,stats["bases"])
+	if summary["genomesize"] != None:
+	    width = (summary["upper"] - summary["lower"])/summary["genomesize"]
+	    if not args.nonverbose:
+		print "ADAPTIVE: %d reads, genome size %.0lf [%.0lf,%.0lf], width %.1lf%%"%(stats["reads"],summary["genomesize"],summary["lower"],summary["upper"],100*width)
+	else:
+	    width = float("inf")
+	    if not args.nonverbose:
+		print "ADAPTIVE: %d reads, no coverage yet"%stats["reads"]
+	if last or width < args.adaptive:
+	    break
+	i += 1
+
+    stop.set()
+    if not last:
+	# precise enough, the remaining reads are not mapped
+	bowtieproc.terminate()
+    samfile.close()
+    feeder.join()
+    if (bowtieproc.wait() != 0 and last) or len(boundaries) <= i:
+	raise PipelineError("mapping failed, see '%s'"%tmpfile(library_file("stderr.bowtie",name)))
+    fed_reads(stats,name)
+    return stats
+
+
+def get_kmer_coverage(scg,reads):
+    """ coverage of SCGs from reads placed by their k-mers, no alignment """
+    from scroogekmers import count_kmer_coverage
+    files,fileformat = reads
+    cpus = step_threads() or args.threads
+    readcount,bases = count_kmer_coverage(scg,files,args.kmersize,args.minkmers,processes = cpus,threads = max(1,min(len(files),cpus//4)))
+    record_count("reads",readcount)
+    record_count("bases",bases)
+    return readcount,bases
+
+
+def build_prefilter(scg):
+    from scroogekmers import ReadFilter
+    readfilter = ReadFilter(scg,args.kmersize,args.minkmers)
+    record_count("kmers",len(readfilter.get_kmers()))
+    return readfilter
+
+
+def write_coverage(scg,name = None):
+    if args.coverageformat == "summary" or scg.is_summary():
+	write_atomic(library_file(args.coveragefile,name),scg.write_coverage_summary_file)
+    elif args.coverageformat == "text":
+	write_atomic(library_file(args.coveragefile,name),scg.write_coverage_file)
+    elif args.coverageformat == "bedgraph":
+	# file and its index are renamed together
+	partial = partial_prefix(library_file(args.coveragefile,name))
+	scg.write_bedgraph_coverage_file(partial)
+	rename_prefixed(partial,library_file(args.coveragefile,name))
+    else:
+	write_atomic(library_file(args.coveragefile,name),scg.write_binary_coverage_file)
+
+
+def genome_size_summary(scg,bases,fraction = None):
+    """ genome size with bootstrap confidence interval, as set for the run """
+    from scroogeestimator import GenomeSizeEstimator
+    estimator = GenomeSizeEstimator(scg,bases,statistic = args.statistic,trim = args.trim,fraction = fraction)
+    return estimator.get_summary(level = args.confidence,samples = args.bootstrap,seed = args.seed)
+
+
+def estimate(scg,bases,name = None):
+    """ genome size with bootstrap confidence interval over SCGs """
+    summary = genome_size_summary(scg,bases)
+    if summary["genomesize"] == None:
+	# reported as an empty estimate, the run goes on
+	print >> sys.stderr,"WARNING: no coverage on single copy genes%s, genome size not estimated"%(" of library '%s'"%name if name != None else "")
+	if name == None:
+	    print "GENOME SIZE: NA (no coverage on %d SCGs)"%summary["scgs"]
+    elif name == None:
+	print "GENOME SIZE: %.0lf bp (%.0lf%% CI %.0lf - %.0lf, %s coverage %.2lf on %d SCGs)"%(summary["genomesize"],100*summary["level"],summary["lower"],summary["upper"],summary["statistic"],summary["coverage"],summary["scgs"])
+    return summary
+
+
+def rarefaction(scg,bases,name = None):
+    """ genome size at every fraction of the ladder, from the subsamples of
+    reads counted along with the coverage; bases of a subsample are the
+    same fraction of all bases, as reads are assigned by a uniform hash """
+    rows = []
+    for fraction in args.rarefaction:
+	summary = genome_size_summary(scg,fraction*bases,fraction)
+	summary["fraction"] = fraction
+	rows.append(summary)
+	if name == None:
+	    if summary["genomesize"] == None:
+		print "RAREFACTION: %5.1lf%% of reads: no coverage"%(100*fraction)
+	    else:
+		print "RAREFACTION: %5.1lf%% of reads: %.0lf bp (%.0lf%% CI %.0lf - %.0lf, width %.1lf%%)"%(100*fraction,summary["genomesize"],100*summary["level"],summary["lower"],summary["upper"],100*(summary["upper"] - summary["lower"])/summary["genomesize"])
+
+    def write(filename):
+	f = open(filename,"w")
+	print >> f,"#fraction\tbases\tscgs\tcoverage\tgenomesize\tlower\tupper\trelativewidth"
+	for r in rows:
+	    if r["genomesize"] == None:
+		print >> f,"%g\t%.0lf\t%d\t%.4lf\tNA\tNA\tNA\tNA"%(r["fraction"],r["bases"],r["scgs"],r["coverage"])
+	    else:
+		print >> f,"%g\t%.0lf\t%d\t%.4lf\t%.0lf\t%.0lf\t%.0lf\t%.4lf"%(r["fraction"],r["bases"],r["scgs"],r["coverage"],r["genomesize"],r["lower"],r["upper"],(r["upper"] - r["lower"])/r["genomesize"])
+	f.close()
+    write_atomic(library_file(args.rarefactionfile,name),write)
+    return rows
+
+
+def library_errors(pipeline,libraries):
+    """ error of every library that did not finish, None for the others """
+    failed = pipeline.get_failed()
+    errors = {}
+    for name,reads in libraries:
+	steps = [step for step in pipeline if step.name.partition(":")[2] == name]
+	own = [step for step in steps if step.status == "failed"]
+	errors[name] = None
+	if len(own) > 0:
+	    errors[name] = "step '%s' failed"%own[0].name + (": %s"%own[0].error if own[0].error else "")
+	elif any([step.status != "done" for step in steps]):
+	    errors[name] = "cancelled after step '%s' failed"%failed[0].name if len(failed) > 0 else "cancelled"
+    return errors
+
+def write_summary(filename,libraries,coverages,readstats,estimates,errors):
+    """ one line per library with the reads and bases counted, its coverage
+    statistics and genome size; libraries that failed get status 'failed'
+    and their error, values that are not known are written as NA """
+    def value(form,x):
+	if x == None or x != x:
+	    return "NA"
+	return form%x
+    f = open(partial_prefix(filename),"w")
+    print >> f,"#library\tstatus\treads\tbases\tscgs\tscgbases\tmappedreads\tmeancoverage\tstddevcoverage\tgenomesize\tlower\tupper\terror"
+    for name,reads in libraries:
+	counted = readstats.get(name) or (None,None)
+	fields = [name,"failed" if errors.get(name) else "done",value("%d",counted[0]),value("%d",counted[1])]
+	if errors.get(name) or not coverages.has_key(name):
+	    fields += ["NA"]*8 + [" ".join((errors.get(name) or "no coverage counted").split())]
+	else:
+	    summary = coverages[name].get_summary()
+	    e = estimates.get(name) or {}
+	    fields += ["%d"%summary["scgs"],"%d"%summary["bases"],"%d"%summary["reads"],value("%.4lf",summary["mean"]),value("%.4lf",summary["stddev"]),
+		       value("%.0lf",e.get("genomesize")),value("%.0lf",e.get("lower")),value("%.0lf",e.get("upper")),""]
+	print >> f,"\t".join(fields)
+    f.close()
+    os.rename(partial_prefix(filename),filename)
+
+
+# ***************************************************************** #
+# **         batch mode: several read libraries                  ** #
+# ***************************************************************** #
+def read_manifest(filename):
+    """ lines 'name<TAB>readfile' or only 'readfile', '#' at the start of
+    a line or after whitespace starts a comment (file names may contain '#') """
+    libraries = []
+    for line in open(filename):
+	line = re.split(r"(?:^|\s)#",line)[0].strip()
+	if line == "":
+	    continue
+	v = line.split("\t")
+	if len(v) >= 2:
+	    libraries.append((v[0].strip(),v[1].strip()))
+	else:
+	    libraries.append((os.path.basename(v[0]).split(".")[0],v[0]))
+    return libraries
+
+def library_file(filename,name):
+    """ prefix file name with library name in batch mode """
+    if name == None:
+	return filename
+    dirname,basename = os.path.split(filename)
+    return os.path.join(dirname,name + "." + basename)
+
+def library_step(step,name):
+    if name == None:
+	return step
+    return step + ":" + name
+
+
+# ***************************************************************** #
+# **         checkpoints: coverage and read counts of a library  ** #
+# **         are kept in tmpdir, to skip the step on resume      ** #
+# ***************************************************************** #
+def read_stamps(readfiles,name):
+    return [file_stamp(f) for f in readfiles[name][0]]
+
+def coverage_key():
+    """ options changing the coverage counted from the same alignments """
+    return [args.readminlength,args.summaryonly,args.histbins,args.rarefaction]
+
+def coverage_checkpoint(data,coverages,readstats,name,key,inputs = []):
+    checkpointfile = tmpfile(library_file("coverage.checkpoint",name))
+
+    def save():
+	write_atomic(checkpointfile,coverages[name].write_coverage_checkpoint)
+	saved = {"readstats":readstats.get(name)}
+	if args.rarefaction != None:
+	    # sums of depth of subsamples, in order of the SCGs
+	    order = [coverages[name][sid].get_index() for sid in coverages[name].get_ids()]
+	    saved["subsamples"] = coverages[name].get_subsample_sums(order).tolist()
+	return saved
+
+    def restore(saved):
+	if name == None:
+	    coverages[name] = data["scg"]
+	else:
+	    coverages[name] = data["scg"].copy_empty()
+	coverages[name].read_coverage_checkpoint(checkpointfile)
+	if saved.get("subsamples") != None:
+	    order = [coverages[name][sid].get_index() for sid in coverages[name].get_ids()]
+	    coverages[name].merge_subsample_sums(order,saved["subsamples"])
+	if saved["readstats"] != None:
+	    readstats[name] = tuple(saved["readstats"])
+
+    def outputs():
+	if args.bamfile != None and not args.kmercoverage:
+	    return [checkpointfile] + prefixed_files(library_file(args.bamfile,name))
+	return [checkpointfile]
+    return StepCheckpoint(key,outputs,save,restore)
+
+def add_library_steps(pipeline,data,coverages,readfiles,readstats,estimates,name,reads,bowtiebuild):
+    """ map one read library against the SCG index and count coverage;
+    'data' holds the SCGs and the prefilter shared by all libraries """
+    if args.kmercoverage:
+	return add_kmer_library_steps(pipeline,data,coverages,readfiles,readstats,estimates,name,reads)
+    bowtie = load_program("mapping")
+
+    bowtie.set_option("x",bowtiebuild.get_parameters()[1])
+    # reads are decompressed and counted here, and fed to the aligner
+    bowtie.set_option("U","-")
+    if not (args.stream or args.adaptive != None):
+	bowtie.set_option("S",tmpfile(library_file("mapping.sam",name)))
+
+    bowtie.set_stderr(tmpfile(library_file("stderr.bowtie",name)))
+    bowtie.set_stdout(tmpfile(library_file("stdout.bowtie",name)))
+
+    def coverage():
+	if name == None:
+	    coverages[name] = data["scg"]
+	else:
+	    coverages[name] = data["scg"].copy_empty()
+	if args.adaptive != None:
+	    stats = get_coverage_adaptive(coverages[name],bowtie,readfiles[name],name,data.get("readfilter"))
+	    readstats[name] = (stats["reads"],stats["bases"])
+	elif args.stream:
+	    readstats[name] = get_coverage(coverages[name],bowtie,readfiles[name],name,data.get("readfilter"))
+	else:
+	    get_coverage(coverages[name],bowtie,None,name)
+
+    def mapping_key():
+	return [bowtie.get_signature(),read_stamps(readfiles,name),args.prefilter,args.kmersize,args.minkmers]
+
+    def restore_readstats(saved):
+	readstats[name] = tuple(saved)
+
+    # reads and bases are counted while they are fed to the aligner, in adaptive mode only mapped reads count
+    pipeline.add_step(library_step("checkreads",name),lambda:readfiles.update({name:check_reads(reads)}))
+    maprequires = ["generatehashfile",library_step("checkreads",name)]
+    if args.prefilter:
+	maprequires.append("prefilterindex")
+    if args.stream or args.adaptive != None:
+	# SAM records are read from the pipe while bowtie2 is still mapping
+	pipeline.add_step(library_step("coverage",name),coverage,requires = maprequires,threads = args.threads,
+			  checkpoint = coverage_checkpoint(data,coverages,readstats,name,lambda:mapping_key() + coverage_key() + [args.adaptive,args.chunkreads]))
+    else:
+	pipeline.add_step(library_step("mapping",name),lambda:readstats.update({name:map_reads(bowtie,readfiles[name],name,data.get("readfilter"))}),
+			  requires = maprequires,threads = args.threads,
+			  checkpoint = StepCheckpoint(mapping_key,[bowtie.get_option("S")],lambda:readstats[name],restore_readstats))
+	pipeline.add_step(library_step("coverage",name),coverage,requires = [library_step("mapping",name)],inputs = [bowtie.get_option("S")],
+			  threads = args.threads if args.processes > 1 or args.summaryonly else 0,
+			  checkpoint = coverage_checkpoint(data,coverages,readstats,name,coverage_key))
+    return add_output_steps(pipeline,coverages,readstats,estimates,name)
+
+def add_kmer_library_steps(pipeline,data,coverages,readfiles,readstats,estimates,name,reads):
+    """ alignment-free coverage, neither bowtie2 index nor mapping are needed """
+    def coverage():
+	if name == None:
+	    coverages[name] = data["scg"]
+	else:
+	    coverages[name] = data["scg"].copy_empty()
+	readstats[name] = get_kmer_coverage(coverages[name],readfiles[name])
+
+    pipeline.add_step(library_step("checkreads",name),lambda:readfiles.update({name:check_reads(reads)}))
+    pipeline.add_step(library_step("coverage",name),coverage,requires = ["scgextraction",library_step("checkreads",name)],threads = args.threads,
+		      checkpoint = coverage_checkpoint(data,coverages,readstats,name,lambda:[read_stamps(readfiles,name),args.kmersize,args.minkmers] + coverage_key()))
+    return add_output_steps(pipeline,coverages,readstats,estimates,name)
+
+def add_output_steps(pipeline,coverages,readstats,estimates,name):
+    pipeline.add_step(library_step("writecoverage",name),lambda:write_coverage(coverages[name],name),requires = [library_step("coverage",name)])
+    pipeline.add_step(library_step("estimate",name),lambda:estimates.update({name:estimate(coverages[name],readstats[name][1],name)}),
+		      requires = [library_step("coverage",name)])
+    steps = [library_step("writecoverage",name),library_step("estimate",name)]
+    if args.rarefaction != None:
+	pipeline.add_step(library_step("rarefaction",name),lambda:rarefaction(coverages[name],readstats[name][1],name),
+			  requires = [library_step("estimate",name)])
+	steps.append(library_step("rarefaction",name))
+    return steps
+
 
 def main():
     
@@ -40,8 +711,16 @@ def main():
 			help="XML file containing default options for external programs\n(default: 'config.externalprograms.xml')")
     parser.add_argument("-t","--tmpdir",default="tmp",
 			help="Directory for temporary files\n(default: './tmp')")
+    parser.add_argument("-R","--resume",default=False,action="store_true",
+			help="Resume an interrupted run in the same temporary directory:\nsteps whose options and inputs did not change and whose\noutputs still exist are skipped (default: run all steps)")
     parser.add_argument("-T","--trashtmp",default=False,action="store_true",
 			help="Trash temporary files\n(default: keep them)")
+    parser.add_argument("-k","--cachedir",default=None,
+			help="Directory to keep BLAST databases and bowtie2 indices\nacross runs (default: no cache)")
+    parser.add_argument("-K","--cachesize",type=float,default=10000.,
+			help="Maximal size of cache in MB, least recently used\nentries are removed (default: 10000)")
+    parser.add_argument("-P","--profile",default=False,action="store_true",
+			help="Profile every pipeline step with cProfile, statistics\nare written to tmpdir/profile.<step>.prof (default: off)")
     parser.add_argument("-V","--nonverbose",action="store_true",default=False,
 			help="Do not write information about current step to screen\n(default: write info)")
 
@@ -62,59 +741,141 @@ def main():
     # datafiles for various stages of the algorithm
     parser.add_argument("-q","--query",default=None,
 			help="FASTA file with sequences of single copy genes")
-    parser.add_argument("-r","--reads",default=None,
-			help="Reads from sequencing run")
+    parser_reads = parser.add_mutually_exclusive_group()
+    parser_reads.add_argument("-r","--reads",default=None,nargs="+",
+			help="Reads from sequencing run, FASTA or FASTQ, plain or\ngzip/bgzip compressed; several files, comma separated\nlists and glob patterns are mapped together")
+    parser_reads.add_argument("-M","--manifest",default=None,
+			help="Batch mode: file with one read library per line,\n'name<TAB>readfiles' or 'readfiles'. Coverage files\nare prefixed with the library name")
+    parser.add_argument("--searchshards",type=int,default=0,
+			help="Split the query into this many shards of similar length\nand search them at the same time, tabular output only\n(default: 0, from processors and query length)")
+    parser.add_argument("-j","--threads",type=int,default=None,
+			help="Number of processors shared by all steps, thread options of\nexternal programs are set from it (default: processors\navailable, respecting CPU affinity and cgroup limits)")
+    parser.add_argument("-w","--workers",type=int,default=None,
+			help="Maximal number of pipeline steps running at the same time\n(default: no limit)")
+    parser.add_argument("-S","--summaryfile",default="summary.tsv",
+			help="Batch mode: table with coverage statistics of all libraries\n(default: 'summary.tsv')")
     parser.add_argument("-c","--coveragefile",default="coverage.out",
 			help="output file to write coverage depth")
+    parser.add_argument("-C","--coverageformat",choices=["binary","text","summary","bedgraph"],default="binary",
+			help="Format of coverage file: 'binary' (memory-mappable),\n'text' (one line per base), 'summary' (JSON with\nmoments and medians of SCGs) or 'bedgraph' (bgzipped\nruns of equal depth, index in FILE.tbi) (default: binary)")
+    parser.add_argument("-m","--summaryonly",default=False,action="store_true",
+			help="Keep only moments and depth histograms of coverage,\nmemory does not depend on length of SCGs; alignments\nare sorted first, coverage file is a summary\n(default: keep depth of every base)")
+    parser.add_argument("--histbins",type=int,default=256,
+			help="Summary mode: bins of depth histogram of every SCG,\nhigher depths share the last bin (default: 256)")
+    parser.add_argument("-s","--stream",default=False,action="store_true",
+			help="Count coverage directly from the output of the mapper\n(default: write SAM file to tmpdir first)")
+    parser.add_argument("-b","--bamfile",default=None,
+			help="Also write alignments to this BAM file\n(default: none)")
+    # estimation of genome size
+    parser.add_argument("-e","--statistic",choices=["mean","median","trimmed"],default="median",
+			help="Statistic over mean coverage of SCGs used as coverage depth\n(default: median)")
+    parser.add_argument("--trim",type=float,default=0.1,
+			help="Fraction of SCGs removed at each end for trimmed mean\n(default: 0.1)")
+    parser.add_argument("-B","--bootstrap",type=int,default=2000,
+			help="Number of bootstrap resamples of SCGs for confidence\ninterval (default: 2000)")
+    parser.add_argument("--seed",type=int,default=1,
+			help="Seed of the bootstrap resamples, runs with the same seed\nreport the same interval (default: 1)")
+    parser.add_argument("--confidence",type=float,default=0.95,
+			help="Level of confidence interval (default: 0.95)")
+    parser.add_argument("-a","--adaptive",type=float,default=None,
+			help="Map reads in growing chunks and stop once the confidence\ninterval of the genome size is narrower than this\nfraction (e.g. 0.05) (default: map all reads)")
+    parser.add_argument("--chunkreads",type=int,default=100000,
+			help="Adaptive mode: number of reads in first chunk,\ndoubled for every further chunk (default: 100000)")
+    parser.add_argument("-F","--prefilter",default=False,action="store_true",
+			help="Pass only reads sharing k-mers with SCGs to the aligner\n(default: map all reads)")
+    parser.add_argument("-X","--kmercoverage",default=False,action="store_true",
+			help="Alignment-free: place reads on SCGs by k-mers occurring\nonce in the SCGs, skips bowtie2 index and mapping\n(default: map reads with bowtie2)")
+    parser.add_argument("--kmersize",type=int,default=21,
+			help="Length of k-mers for prefilter and k-mer coverage,\nat most 31 (default: 21)")
+    parser.add_argument("--minkmers",type=int,default=2,
+			help="Minimal number of k-mers a read shares with SCGs to\nbe mapped or placed (default: 2)")
+    parser.add_argument("-p","--processes",type=int,default=1,
+			help="Count coverage in this many processes, from sorted\nand indexed alignments (default: 1)")
+    parser.add_argument("--rarefaction",nargs="?",const="0.01,0.02,0.05,0.1,0.2,0.3,0.5,0.7,1",default=None,
+			help="Estimate genome size also for subsamples of reads at this\nladder of fractions, counted in the same pass over the\nalignments; reads are assigned by a hash of their name\n(default: off, without list: 0.01,0.02,0.05,0.1,0.2,0.3,\n0.5,0.7,1)")
+    parser.add_argument("--rarefactionfile",default="rarefaction.tsv",
+			help="Genome size estimates of subsamples\n(default: 'rarefaction.tsv')")
 
     global args
     args = parser.parse_args()
+    if args.reads != None:
+	args.reads = ",".join(args.reads)
+    if args.threads == None:
+	args.threads = available_cpus()
+    elif args.threads < 1:
+	print_error("need at least one thread")
+    if args.searchshards < 0:
+	print_error("number of search shards must not be negative")
+    if args.kmersize < 1 or args.kmersize > 31:
+	print_error("k-mer size must be between 1 and 31")
+    if args.kmercoverage and (args.adaptive != None or args.bamfile != None):
+	print_error("k-mer coverage works without alignments, no adaptive mapping or BAM file")
+    if args.summaryonly and (args.adaptive != None or args.kmercoverage):
+	print_error("summary mode needs sorted alignments, no adaptive mapping or k-mer coverage")
+    if args.histbins < 2:
+	print_error("need at least two histogram bins")
+    if args.rarefaction != None:
+	if args.kmercoverage or args.adaptive != None:
+	    print_error("rarefaction needs names of aligned reads, no adaptive mapping or k-mer coverage")
+	try:
+	    args.rarefaction = parse_fractions(args.rarefaction)
+	except ValueError:
+	    print_error("rarefaction needs fractions in (0,1], e.g. '0.1,0.2,0.5,1'")
+
+    # options of all external programs are read and checked once, before any step runs
+    global config
+    try:
+	config = load_config(args.optionfile)
+    except IOError:
+	print_error("Could not find option file '%s'"%args.optionfile)
+    except ValueError as e:
+	print_error("invalid option file '%s': %s"%(args.optionfile,e))
 
 
     # ***************************************************************** #
     # **         create temporary data structure                     ** #
     # ***************************************************************** #
     if os.path.isdir(args.tmpdir):
-	print >> sys.stderr,"WARNING: temporary directory '%s' exists. Files will be overwritten!"%args.tmpdir
+	if not args.resume:
+	    print >> sys.stderr,"WARNING: temporary directory '%s' exists. Files will be overwritten!"%args.tmpdir
+	elif not os.path.exists(tmpfile("manifest.json")):
+	    print >> sys.stderr,"WARNING: no manifest in temporary directory '%s', running all steps"%args.tmpdir
     else:
 	os.mkdir(args.tmpdir)
+    # finished steps are recorded, to be skipped with --resume
+    manifest = RunManifest(tmpfile("manifest.json"),resume = args.resume)
+
+
+
+    global cache
+    if args.cachedir != None:
+	try:
+	    cache = ArtifactCache(args.cachedir,maxsize = int(args.cachesize*1e6),verbose = not args.nonverbose)
+	except IOError:
+	    print_error("could not create cache directory '%s'"%args.cachedir)
+    else:
+	cache = None
 
 
 
     # ***************************************************************** #
     # **         initialize blast search object                      ** #
     # ***************************************************************** #
-    try:
-	blastsearch = externalprogram(args.optionfile,"scgminingsearch",not args.nonverbose)
-    except IOError:
-	print_error("Could not find option file '%s'"%args.optionfile)
-    except ValueError:
-	print_error("Could not find options for step 'scgminingsearch' in file '%s'"%args.optionfile)
-    except:
-	print_error("weird error!")
+    blastsearch = load_program("scgminingsearch")
 
 
     # ***************************************************************** #
     # **         create blast db                                     ** #
     # ***************************************************************** #
     if args.dbseqfile != None:
-	try:
-	    blastdb = externalprogram(args.optionfile,"scgminingcreatedb",not args.nonverbose)
-	except IOError:
-	    print_error("Could not find option file '%s'"%args.optionfile)
-	except ValueError:
-	    print_error("Could not find options for step 'scgminingcreatedb' in file '%s'"%args.optionfile)
-	except:
-	    print_error("weird error!")
-	
+	blastdb = load_program("scgminingcreatedb")
+
 	if os.path.isfile(args.dbseqfile):
 	    blastdb.set_option("in",args.dbseqfile)
 	    blastdb.set_option("out",tmpfile("SCGdb"),outfile=True)
 	    blastsearch.set_option("db",tmpfile("SCGdb"))
 	    blastdb.set_stderr(tmpfile("stderr.blastdb"))
 	    blastdb.set_stdout(tmpfile("stdout.blastdb"))
-	    
-	    blastdb.execute()
 	else:
 	    print_error("could not find sequence file '%s' to create DB"%args.dbseqfile)
     # ***************************************************************** #
@@ -123,11 +884,6 @@ def main():
     elif args.dbfile != None:
 	blastsearch.set_option("db",args.dbfile)
 
-    # check for db files
-    if not file_exists(blastsearch.get_files("db")):
-	raise IOError
-	    #print_error("could not find files")
-
 
     if args.query != None:
 	if os.path.isfile(args.query):
@@ -140,21 +896,13 @@ def main():
     blastsearch.set_stderr(tmpfile("stderr.blastsearch"))
     blastsearch.set_stdout(tmpfile("stdout.blastsearch"))
     blastsearch.set_option("out",tmpfile(blastsearch.get_option("out")))
-    blastsearch.execute()
 
 
 
     # ***************************************************************** #
     # **         initialize building hashfild for bowtie mapping     ** #
     # ***************************************************************** #
-    try:
-	bowtiebuild = externalprogram(args.optionfile,"generatehashfile",not args.nonverbose)
-    except IOError:
-	print_error("Could not find option file '%s'"%args.optionfile)
-    except ValueError:
-	print_error("Could not find options for step 'generatehashfile' in file '%s'"%args.optionfile)
-    except:
-	print_error("weird error!")
+    bowtiebuild = load_program("generatehashfile")
 
     bowtiebuild.add_parameter(tmpfile("GenomeSCG.fasta"))
     bowtiebuild.add_parameter(tmpfile("GenomeSCG.idx"))
@@ -163,72 +911,77 @@ def main():
 
 
     # ***************************************************************** #
-    # **         building list of single copy genes                  ** #
-    # **         by assigning correct identifiers for SCGs and       ** #
-    # **         introducing cutoff in length                        ** #
-    # ***************************************************************** #
-    fa = open(args.query) # needed for correct names
-    fblastxml = open(blastsearch.get_option("out")) # XML output from blast
-
-    assembly_dict = SeqIO.to_dict(SeqIO.parse(fa,"fasta"))
-    scg_blast_records = NCBIXML.parse(fblastxml)
-
-    scg = SingleCopyGeneList(scglength = args.cutofflength, readlength = args.readminlength)
-
-    for record in scg_blast_records:
-	qid = record.query.split()[0]
-	n=1
-	for alignment in record.alignments:
-	    for hsp in alignment.hsps:
-		s = min(hsp.query_start,hsp.query_end)
-		e = max(hsp.query_start,hsp.query_end)
-		scg.add_sequence(qid+str(n),assembly_dict[qid].seq[s:e])
-		n+=1
-
-    fa.close()
-    fblastxml.close()
-    scg.write_sequence_file(bowtiebuild.get_parameters()[0])
-
-
-
-    # ***************************************************************** #
-    # **         generate hashfile for bowtie mapping                ** #
+    # **         read libraries to map                               ** #
     # ***************************************************************** #
+    if args.manifest != None:
+	try:
+	    libraries = read_manifest(args.manifest)
+	except IOError:
+	    print_error("could not read manifest '%s'"%args.manifest)
+	names = [name for name,reads in libraries]
+	if len(libraries) == 0:
+	    print_error("no read libraries in manifest '%s'"%args.manifest)
+	if len(set(names)) != len(names):
+	    print_error("library names in manifest '%s' are not unique"%args.manifest)
+    else:
+	libraries = [(None,args.reads)]
 
-    bowtiebuild.execute()
-
-    # ***************************************************************** #
-    # **         bowtie mapping                                      ** #
-    # ***************************************************************** #
-    try:
-	bowtie = externalprogram(args.optionfile,"mapping",not args.nonverbose)
-    except IOError:
-	print_error("Could not find option file '%s'"%args.optionfile)
-    except ValueError:
-	print_error("Could not find options for step 'generatehashfile' in file '%s'"%args.optionfile)
-    except:
-	print_error("weird error!")
-
-    bowtie.set_option("x",bowtiebuild.get_parameters()[1])
-    bowtie.set_option("U",args.reads)
-    bowtie.set_option("S",tmpfile("mapping.sam"))
-
-    bowtie.set_stderr(tmpfile("stderr.bowtie"))
-    bowtie.set_stdout(tmpfile("stdout.bowtie"))
-
-    bowtie.execute()
 
 
     # ***************************************************************** #
-    # **         get coverage                                        ** #
+    # **         declare pipeline steps with their dependencies      ** #
+    # **         and run them as soon as their inputs are ready      ** #
     # ***************************************************************** #
-    samfile = pysam.Samfile(bowtie.get_option("S"),"r")
-
-    for alignment in samfile.fetch():
-	if alignment.tid >= 0: # (id == -1) -> read not mapped
-	    scg[alignment.reference_name].add_coverage(alignment.reference_start,alignment.reference_end)
+    data = {}
+    pipeline = PipelineScheduler(verbose = not args.nonverbose,maxparallel = args.workers,logfile = tmpfile("pipeline.log"),
+				 profiledir = args.tmpdir if args.profile else None,cpus = args.threads,manifest = manifest)
 
-    scg.write_coverage_file(args.coveragefile)
+    searchrequires = []
+    if args.dbseqfile != None:
+	pipeline.add_step("scgminingcreatedb",lambda:run_program(blastdb,[args.dbseqfile],tmpfile("SCGdb")),
+			  inputs = [args.dbseqfile],
+			  checkpoint = StepCheckpoint(blastdb.get_signature,lambda:prefixed_files(tmpfile("SCGdb"))))
+	searchrequires.append("scgminingcreatedb")
+
+    # databases given with -d are not created here, their files are part of the fingerprint
+    pipeline.add_step("scgminingsearch",lambda:run_search(blastsearch),requires = searchrequires,inputs = [args.query],
+		      threads = args.threads,
+		      checkpoint = StepCheckpoint(lambda:search_key(blastsearch),[blastsearch.get_option("out")]))
+
+    def restore_scg(saved):
+	data["scg"] = load_scg(bowtiebuild.get_parameters()[0])
+    pipeline.add_step("scgextraction",lambda:data.update(scg = extract_scg(blastsearch,bowtiebuild.get_parameters()[0])),
+		      requires = ["scgminingsearch"],inputs = [blastsearch.get_option("out"),args.query],
+		      checkpoint = StepCheckpoint(lambda:[args.cutofflength],[bowtiebuild.get_parameters()[0]],restore = restore_scg))
+
+    if not args.kmercoverage:
+	pipeline.add_step("generatehashfile",lambda:run_program(bowtiebuild,[bowtiebuild.get_parameters()[0]],bowtiebuild.get_parameters()[1]),
+			  requires = ["scgextraction"],inputs = [bowtiebuild.get_parameters()[0]],threads = args.threads,
+			  checkpoint = StepCheckpoint(bowtiebuild.get_signature,lambda:prefixed_files(bowtiebuild.get_parameters()[1])))
+
+    if args.prefilter and not args.kmercoverage:
+	pipeline.add_step("prefilterindex",lambda:data.update(readfilter = build_prefilter(data["scg"])),requires = ["scgextraction"])
+
+    # the index is built once, all libraries are mapped against it
+    coverages = {}
+    readfiles = {}
+    readstats = {}
+    estimates = {}
+    outputsteps = []
+    for name,reads in libraries:
+	outputsteps += add_library_steps(pipeline,data,coverages,readfiles,readstats,estimates,name,reads,bowtiebuild)
+
+    if args.manifest != None:
+	# written also if libraries failed, they are reported in their rows
+	pipeline.add_step("summary",lambda:write_summary(args.summaryfile,libraries,coverages,readstats,estimates,library_errors(pipeline,libraries)),
+			  requires = outputsteps,always = True)
+
+    starttime = time.time()
+    success = pipeline.run()
+    pipeline.write_report(tmpfile("report.json"),{"arguments":vars(args),"start":starttime,"wall":time.time()-starttime,"success":success})
+    if not success:
+	step = pipeline.get_failed()[0]
+	print_error("step '%s' failed: %s"%(step.name,step.error))
 
 
 
@@ -244,5 +997,3 @@ def main():
 
 if __name__ == "__main__":
   main()
-
-
@@ -0,0 +1,513 @@
+# ************************************************************************* #
+# **         SCROOGE                                                     ** #
+# **         estimate genome size from single copy gene coverage         ** #
+# **                                                                     ** #
+# **         coverage as runs of equal depth in bedGraph format,         ** #
+# **         compressed in BGZF blocks (as written by 'bgzip') with an   ** #
+# **         index of regions (as written by 'tabix -p bed')             ** #
+# **                                                                     ** #
+# ************************************************************************* #
+
+
+import struct,zlib,itertools
+import numpy as np
+
+from scroogeclasses import run_length_encode,run_length_decode,write_text_coverage,BinaryCoverageFile
+
+
+
+# ***************************************************************** #
+# **         BGZF: concatenated gzip members of at most 64 kB,   ** #
+# **         positions are virtual offsets: (offset of block in  ** #
+# **         file) << 16 | (offset in uncompressed block)        ** #
+# ***************************************************************** #
+BGZF_BLOCKSIZE = 0xff00
+BGZF_HEADERSIZE = 18
+
+
+def bgzf_block(data,level = 6):
+    """ one gzip member with the 'BC' extra field holding its size """
+    c = zlib.compressobj(level,zlib.DEFLATED,-15)
+    cdata = c.compress(data) + c.flush()
+    header = struct.pack("<4BI2BH2BHH",31,139,8,4,0,0,255,6,66,67,2,len(cdata) + 25)
+    return header + cdata + struct.pack("<II",zlib.crc32(data) & 0xffffffff,len(data))
+
+
+BGZF_EOF = bgzf_block("")
+
+
+class BgzfWriter():
+    """ lines are never split between blocks, so every line can be read
+    from the virtual offset returned by 'tell' before writing it """
+    def __init__(self,filename,level = 6):
+        self.__fp = open(filename,"wb")
+        self.__level = level
+        self.__buffer = []
+        self.__size = 0
+        self.__offset = 0
+
+    def __flush(self):
+        if self.__size > 0:
+            block = bgzf_block("".join(self.__buffer),self.__level)
+            self.__fp.write(block)
+            self.__offset += len(block)
+            self.__buffer = []
+            self.__size = 0
+
+    def tell(self):
+        return (self.__offset << 16) | self.__size
+
+    def write_line(self,line):
+        if self.__size + len(line) > BGZF_BLOCKSIZE:
+            self.__flush()
+        self.__buffer.append(line)
+        self.__size += len(line)
+
+    def write_lines(self,lines):
+        """ write many lines, return virtual offsets of their starts and ends """
+        sizes = np.array([len(line) for line in lines],dtype=np.int64)
+        ends = np.cumsum(sizes)
+        starts = ends - sizes
+        vstarts = np.zeros(len(lines),dtype=np.int64)
+        i = 0
+        while i < len(lines):
+            # as many lines as fit into the current block
+            j = np.searchsorted(ends,starts[i] + BGZF_BLOCKSIZE - self.__size,side = "right")
+            if j == i and self.__size > 0:
+                self.__flush()
+                continue
+            j = max(j,i + 1)
+            vstarts[i:j] = self.tell() + starts[i:j] - starts[i]
+            self.__buffer.extend(lines[i:j])
+            self.__size += int(ends[j-1] - starts[i])
+            i = j
+        return vstarts,vstarts + sizes
+
+    def close(self):
+        self.__flush()
+        self.__fp.write(BGZF_EOF)
+        self.__fp.close()
+
+
+def write_bgzf(filename,data,level = 6):
+    """ compress all of 'data' into BGZF blocks """
+    f = open(filename,"wb")
+    for i in range(0,len(data),BGZF_BLOCKSIZE):
+        f.write(bgzf_block(data[i:i+BGZF_BLOCKSIZE],level))
+    f.write(BGZF_EOF)
+    f.close()
+
+
+class BgzfReader():
+    """ random access to blocks, blocks are decompressed one at a time """
+    def __init__(self,filename):
+        self.__fp = open(filename,"rb")
+
+    def read_block(self,offset):
+        """ uncompressed data of block at 'offset' and offset of next block """
+        self.__fp.seek(offset)
+        header = self.__fp.read(BGZF_HEADERSIZE)
+        if len(header) == 0:
+            return "",offset
+        if len(header) < BGZF_HEADERSIZE or header[:4] != "\x1f\x8b\x08\x04" or header[12:14] != "BC":
+            raise ValueError("not a BGZF block at offset %d"%offset)
+        size = struct.unpack("<H",header[16:18])[0] + 1
+        cdata = self.__fp.read(size - BGZF_HEADERSIZE)
+        return zlib.decompress(cdata[:-8],-15),offset + size
+
+    def iter_lines(self,voffset = 0):
+        """ yield (virtual offset,line) from 'voffset' to the end of file """
+        offset,skip = voffset >> 16,voffset & 0xffff
+        rest,reststart = "",voffset
+        while True:
+            data,nextoffset = self.read_block(offset)
+            if nextoffset == offset:
+                break
+            lines = (rest + data[skip:]).split("\n")
+            # a line continued from the previous block starts there
+            start,position = reststart,skip - len(rest)
+            for line in lines[:-1]:
+                yield start,line
+                position += len(line) + 1
+                start = (offset << 16) | position
+            rest,reststart = lines[-1],start
+            offset,skip = nextoffset,0
+        if rest != "":
+            yield reststart,rest
+
+    def iter_blocks(self,voffset = 0):
+        """ yield uncompressed blocks from 'voffset' to the end of file """
+        offset,skip = voffset >> 16,voffset & 0xffff
+        while True:
+            block,nextoffset = self.read_block(offset)
+            if nextoffset == offset:
+                return
+            yield block[skip:]
+            offset,skip = nextoffset,0
+
+    def read(self,voffset = 0):
+        """ uncompressed content from 'voffset' to the end of file """
+        return "".join(self.iter_blocks(voffset))
+
+    def close(self):
+        self.__fp.close()
+
+
+def is_bgzf_file(filename):
+    f = open(filename,"rb")
+    header = f.read(BGZF_HEADERSIZE)
+    f.close()
+    return len(header) == BGZF_HEADERSIZE and header[:4] == "\x1f\x8b\x08\x04" and header[12:14] == "BC"
+
+
+
+# ***************************************************************** #
+# **         index of regions, same layout as '.tbi' files:      ** #
+# **         hierarchical bins of 16 kB - 512 MB with chunks of  ** #
+# **         virtual offsets, and a linear index of the first    ** #
+# **         record overlapping every 16 kB window               ** #
+# ***************************************************************** #
+TABIX_MAGIC = "TBI\1"
+TABIX_BED = 0x10000     # zero-based, half-open coordinates
+TABIX_LEVELS = ((26,1),(23,9),(20,73),(17,585),(14,4681))
+
+
+def region_bin(start,end):
+    """ smallest bin containing [start,end), also for arrays of regions """
+    start = np.asarray(start,dtype=np.int64)
+    end = np.asarray(end,dtype=np.int64) - 1
+    b = np.zeros_like(start)
+    # finer levels override coarser ones
+    for shift,first in TABIX_LEVELS:
+        b = np.where(start >> shift == end >> shift,first + (start >> shift),b)
+    return b
+
+
+def region_bins(start,end):
+    """ all bins that can hold records overlapping [start,end) """
+    end -= 1
+    bins = [0]
+    for shift,first in TABIX_LEVELS:
+        bins.extend(range(first + (start >> shift),first + (end >> shift) + 1))
+    return bins
+
+
+class RegionIndex():
+    def __init__(self,names = []):
+        self.__names = list(names)
+        self.__tid = dict([(name,i) for i,name in enumerate(self.__names)])
+        self.__bins = [{} for name in self.__names]
+        self.__linear = [[] for name in self.__names]
+
+    def get_names(self):
+        return self.__names
+
+    def add(self,name,starts,ends,vstarts,vends):
+        """ records covering [starts,ends) of 'name', stored at [vstarts,vends);
+        records are sorted and do not overlap, like runs of equal depth """
+        if len(starts) == 0:
+            return
+        tid = self.__tid[name]
+        starts,ends = np.asarray(starts,dtype=np.int64),np.asarray(ends,dtype=np.int64)
+        # records of the same bin stored one after another form one chunk
+        bins = region_bin(starts,ends)
+        breaks = np.nonzero((bins[1:] != bins[:-1]) | (vstarts[1:] != vends[:-1]))[0] + 1
+        first = np.concatenate(([0],breaks))
+        last = np.append(breaks,len(starts)) - 1
+        for b,vstart,vend in zip(bins[first].tolist(),vstarts[first].tolist(),vends[last].tolist()):
+            chunks = self.__bins[tid].setdefault(b,[])
+            if len(chunks) > 0 and chunks[-1][1] == vstart:
+                chunks[-1][1] = vend
+            else:
+                chunks.append([vstart,vend])
+        # first record ending in or after every window, if it starts there
+        lastwindow = (ends - 1) >> 14
+        windows = np.arange(lastwindow[-1] + 1)
+        i = np.searchsorted(lastwindow,windows)
+        linear = self.__linear[tid]
+        linear.extend([None]*(len(windows) - len(linear)))
+        for w in np.nonzero((starts[i] >> 14) <= windows)[0].tolist():
+            if linear[w] is None:
+                linear[w] = int(vstarts[i[w]])
+
+    def find(self,name,start,end):
+        """ virtual offset before the first record overlapping [start,end), None if there is none """
+        if not self.__tid.has_key(name):
+            raise KeyError(name)
+        tid = self.__tid[name]
+        linear = self.__linear[tid]
+        minoffset = 0
+        if len(linear) > 0:
+            minoffset = linear[min(start >> 14,len(linear) - 1)] or 0
+        offsets = [c[0] for b in region_bins(start,end) for c in self.__bins[tid].get(b,[]) if c[1] > minoffset]
+        if len(offsets) == 0:
+            return None
+        return max(min(offsets),minoffset)
+
+    def write(self,filename):
+        data = [TABIX_MAGIC,struct.pack("<7i",len(self.__names),TABIX_BED,1,2,3,ord("#"),0)]
+        names = "".join([name + "\0" for name in self.__names])
+        data += [struct.pack("<i",len(names)),names]
+        for bins,linear in zip(self.__bins,self.__linear):
+            data.append(struct.pack("<i",len(bins)))
+            for b in sorted(bins):
+                data.append(struct.pack("<Ii",b,len(bins[b])))
+                data += [struct.pack("<QQ",vstart,vend) for vstart,vend in bins[b]]
+            # windows without records point to the previous record
+            filled = []
+            for offset in linear:
+                filled.append(offset if offset is not None else (filled[-1] if len(filled) > 0 else 0))
+            data.append(struct.pack("<i",len(filled)))
+            data.append(struct.pack("<%dQ"%len(filled),*filled))
+        write_bgzf(filename,"".join(data))
+
+    def read(self,filename):
+        reader = BgzfReader(filename)
+        data = reader.read()
+        reader.close()
+        if data[:4] != TABIX_MAGIC:
+            raise ValueError("%s is not a region index"%filename)
+        nref = struct.unpack("<i",data[4:8])[0]
+        lnames = struct.unpack("<i",data[32:36])[0]
+        self.__init__(data[36:36+lnames].split("\0")[:nref])
+        p = 36 + lnames
+        for tid in range(nref):
+            nbins = struct.unpack("<i",data[p:p+4])[0]
+            p += 4
+            for i in range(nbins):
+                b,nchunks = struct.unpack("<Ii",data[p:p+8])
+                p += 8
+                self.__bins[tid][b] = [list(struct.unpack("<QQ",data[p+16*j:p+16*j+16])) for j in range(nchunks)]
+                p += 16*nchunks
+            nwindows = struct.unpack("<i",data[p:p+4])[0]
+            self.__linear[tid] = list(struct.unpack("<%dQ"%nwindows,data[p+4:p+4+8*nwindows]))
+            p += 4 + 8*nwindows
+
+
+
+# ***************************************************************** #
+# **         bedGraph coverage file                              ** #
+# **                                                             ** #
+# **  header lines '#scg name length reads' for all SCGs, then   ** #
+# **  lines 'name start end depth' for runs of equal depth,      ** #
+# **  bases not in any run have depth 0; the index is written    ** #
+# **  to 'filename.tbi'                                          ** #
+# ***************************************************************** #
+BEDGRAPH_FORMAT = "#scrooge-coverage-bedgraph"
+
+
+def write_bedgraph(filename,names,lengths,counts,runs,indexfile = None):
+    """ 'runs' holds (starts,ends,depths) of every SCG, e.g. from 'run_length_encode' """
+    if indexfile is None:
+        indexfile = filename + ".tbi"
+    out = BgzfWriter(filename)
+    out.write_line(BEDGRAPH_FORMAT + "\n")
+    for name,length,count in zip(names,lengths,counts):
+        out.write_line("#scg\t%s\t%d\t%d\n"%(name,length,count))
+    index = RegionIndex(names)
+    for name,(starts,ends,depths) in zip(names,runs):
+        keep = np.asarray(depths) != 0
+        starts,ends,depths = np.asarray(starts)[keep],np.asarray(ends)[keep],np.asarray(depths)[keep]
+        line = name.replace("%","%%") + "\t%d\t%d\t%d\n"
+        lines = [line%run for run in zip(starts.tolist(),ends.tolist(),depths.tolist())]
+        vstarts,vends = out.write_lines(lines)
+        index.add(name,starts,ends,vstarts,vends)
+    out.close()
+    index.write(indexfile)
+
+
+def is_bedgraph_coverage_file(filename):
+    if not is_bgzf_file(filename):
+        return False
+    reader = BgzfReader(filename)
+    data = reader.read_block(0)[0]
+    reader.close()
+    return data.startswith(BEDGRAPH_FORMAT)
+
+
+class BedGraphCoverageFile():
+    """ runs of single SCGs are found via the index, if there is one,
+    without decompressing the rest of the file """
+    def __init__(self,filename,indexfile = None):
+        if not is_bedgraph_coverage_file(filename):
+            raise ValueError("%s is not a bedGraph coverage file"%filename)
+        self.__reader = BgzfReader(filename)
+        self.__names,self.__lengths,self.__counts = [],[],[]
+        # virtual offset of the first run, None if there are no runs
+        self.__dataoffset = None
+        for voffset,line in self.__reader.iter_lines():
+            if not line.startswith("#"):
+                self.__dataoffset = voffset
+                break
+            if line.startswith("#scg\t"):
+                name,length,count = line.split("\t")[1:4]
+                self.__names.append(name)
+                self.__lengths.append(int(length))
+                self.__counts.append(int(count))
+        self.__lengths = np.array(self.__lengths,dtype=np.int64)
+        self.__counts = np.array(self.__counts,dtype=np.int64)
+        self.__index = dict([(name,i) for i,name in enumerate(self.__names)])
+        if indexfile is None:
+            indexfile = filename + ".tbi"
+        self.__regions = None
+        try:
+            self.__regions = RegionIndex()
+            self.__regions.read(indexfile)
+        except (IOError,ValueError,struct.error):
+            self.__regions = None
+
+    def __len__(self):
+        return len(self.__names)
+
+    def __iter__(self):
+        """ (name,starts,ends,depths) of all SCGs in the order of the header,
+        reading the file once; runs are parsed block by block and only the
+        runs of one SCG are held at a time """
+        i = 0
+        current,parts = None,[]
+        for name,runs in itertools.chain(self.__iter_groups(),[(None,None)]):
+            if name == current:
+                parts.append(runs)
+                continue
+            if current is not None:
+                merged = np.concatenate(parts)
+                yield current,merged[:,0],merged[:,1],merged[:,2]
+            if name is None:
+                break
+            # SCGs without runs come before
+            while i < len(self.__names) and self.__names[i] != name:
+                yield (self.__names[i],) + self.__to_arrays([])
+                i += 1
+            if i == len(self.__names):
+                raise ValueError("runs of '%s' are not in the order of the SCGs"%name)
+            i += 1
+            current,parts = name,[runs]
+        for name in self.__names[i:]:
+            yield (name,) + self.__to_arrays([])
+
+    def __iter_groups(self):
+        # (name,runs) of consecutive records of one SCG in a block, the
+        # records of an SCG may span several blocks
+        if self.__dataoffset is None:
+            return
+        rest = ""
+        for data in itertools.chain(self.__reader.iter_blocks(self.__dataoffset),["\n"]):
+            data = rest + data
+            end = data.rfind("\n") + 1
+            fields,rest = data[:end].split(),data[end:]
+            names = fields[0::4]
+            del fields[0::4]
+            values = np.fromstring(" ".join(fields),dtype=np.int64,sep=" ").reshape((-1,3))
+            p = 0
+            for name,group in itertools.groupby(names):
+                n = len(list(group))
+                yield name,values[p:p + n]
+                p += n
+
+    def __to_arrays(self,fields):
+        a = np.array(fields,dtype=np.int64).reshape((-1,3))
+        return a[:,0],a[:,1],a[:,2]
+
+    def get_names(self):
+        return self.__names
+    def get_lengths(self):
+        return self.__lengths
+    def get_counts(self):
+        return self.__counts
+    def has_index(self):
+        return self.__regions is not None
+
+    def get_runs(self,name,start = 0,end = None):
+        """ (starts,ends,depths) of runs of SCG 'name' overlapping [start,end) """
+        length = self.__lengths[self.__index[name]]
+        if end is None or end > length:
+            end = length
+        if self.__regions is not None:
+            voffset = self.__regions.find(name,start,end) if end > start else None
+            if voffset is None:
+                return self.__to_arrays([])
+        else:
+            voffset = self.__dataoffset
+        if voffset is None:
+            return self.__to_arrays([])
+        fields = []
+        found = False
+        for v,line in self.__reader.iter_lines(voffset):
+            if line == "" or line.startswith("#"):
+                continue
+            run = line.split("\t")
+            if run[0] != name:
+                # records of an SCG are consecutive
+                if found or self.__regions is not None:
+                    break
+                continue
+            found = True
+            if int(run[1]) >= end:
+                break
+            if int(run[2]) > start:
+                fields.append(run[1:4])
+        return self.__to_arrays(fields)
+
+    def get_coverage(self,name):
+        """ per-base depth of SCG 'name' """
+        return run_length_decode(*self.get_runs(name),length = self.__lengths[self.__index[name]])
+
+    def close(self):
+        self.__reader.close()
+
+
+
+# ***************************************************************** #
+# **         converters between coverage formats                 ** #
+# ***************************************************************** #
+def iter_text_coverage(filename):
+    """ yield (name,reads,depth,sequence) of every SCG in a text coverage file """
+    fp = open(filename)
+    name,reads,lines = None,0,[]
+    for line in fp:
+        if line.startswith("#"):
+            header = line.split()
+            name,reads,lines = header[1],int(header[2]),[]
+        elif line.strip() == "":
+            if name is not None:
+                fields = [l.split() for l in lines]
+                yield name,reads,np.array([f[1] for f in fields],dtype=np.int64),"".join([f[2] if len(f) > 2 else "N" for f in fields])
+            name = None
+        else:
+            lines.append(line)
+    fp.close()
+
+
+def text_to_bedgraph(textfile,bedgraphfile):
+    """ convert a text coverage file (one line per base) """
+    names,lengths,counts,runs = [],[],[],[]
+    for name,reads,depth,sequence in iter_text_coverage(textfile):
+        names.append(name)
+        lengths.append(len(depth))
+        counts.append(reads)
+        runs.append(run_length_encode(depth))
+    write_bedgraph(bedgraphfile,names,lengths,counts,runs)
+
+
+def binary_to_bedgraph(binaryfile,bedgraphfile):
+    """ convert a binary coverage file """
+    covfile = BinaryCoverageFile(binaryfile)
+    write_bedgraph(bedgraphfile,covfile.get_names(),covfile.get_lengths(),covfile.get_counts(),
+                   (run_length_encode(c) for name,c in covfile))
+
+
+def bedgraph_to_text(bedgraphfile,textfile,sequences = None):
+    """ expand runs to one line per base; bases are taken from FastaIndex
+    'sequences' (e.g. of the SCGs written by scrooge), otherwise written as N """
+    covfile = BedGraphCoverageFile(bedgraphfile)
+    counts = dict(zip(covfile.get_names(),covfile.get_counts()))
+    lengths = dict(zip(covfile.get_names(),covfile.get_lengths()))
+    f = open(textfile,"w")
+    for name,starts,ends,depths in covfile:
+        depth = run_length_decode(starts,ends,depths,length = lengths[name])
+        sequence = "N"*len(depth)
+        if sequences is not None and name in sequences:
+            sequence = sequences.fetch(name)
+        write_text_coverage(f,name,counts[name],depth,sequence)
+    f.close()
+    covfile.close()
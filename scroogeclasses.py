@@ -12,21 +12,129 @@
 import xml.etree.ElementTree as ET
 import os,sys
 import subprocess
-from math import sqrt
+import hashlib,fcntl,shutil,tempfile,zlib
+import threading,time,gzip
+import resource,json,cProfile
+import glob,Queue,importlib
+import multiprocessing
+from math import sqrt,ceil
 
 
 
 # ***************************************************************** #
 # **         helper routines                                     ** #
 # ***************************************************************** #
+class lazy_module():
+    """ placeholder for a module that is only imported when one of its
+    attributes is used; the placeholder under 'alias' in 'namespace'
+    (the globals of the importing module) is then replaced by the module """
+    def __init__(self,name,namespace,alias):
+        self.__name = name
+        self.__namespace = namespace
+        self.__alias = alias
+
+    def __getattr__(self,attr):
+        module = importlib.import_module(self.__name)
+        self.__namespace[self.__alias] = module
+        return getattr(module,attr)
+
+# NumPy takes most of the startup time, '--help' and argument checks do not need it
+np = lazy_module("numpy",globals(),"np")
+
 
 
 def file_exists(filenames):
-  r = True
+  """ True if all files exist """
   for f in filenames:
-    if os.path.isfile(str(f).strip()):
-      r = False
-  return r
+    if not os.path.isfile(str(f).strip()):
+      return False
+  return True
+
+# lines of programs and steps running in parallel threads must not interleave
+_outputlock = threading.Lock()
+
+def write_output(line,stdout = True,logfile = None):
+    """ write one line to stdout and/or append it to 'logfile', holding
+    the output lock shared by all threads """
+    _outputlock.acquire()
+    try:
+        if stdout:
+            sys.stdout.write(line + "\n")
+            sys.stdout.flush()
+        if logfile != None:
+            f = open(logfile,"a")
+            f.write(line + "\n")
+            f.close()
+    finally:
+        _outputlock.release()
+
+# ***************************************************************** #
+# **         XML file with options of external programs,         ** #
+# **         parsed and checked once, shared by all programs     ** #
+# ***************************************************************** #
+PROGRAM_TAGS = ["executable","flag","option","parameter","filetype","threads"]
+
+class ProgramConfig():
+    """ <program step="..."> entries of an options file; IOError if the
+    file cannot be parsed, ValueError if an entry is invalid, unknown
+    elements are skipped with a warning """
+    def __init__(self,optionfile):
+        try:
+            root = ET.parse(optionfile).getroot()
+        except:
+            raise IOError
+        self.__filename = optionfile
+        self.__steps = []
+        self.__programs = {}
+        for program in root:
+            step = program.attrib.get("step")
+            if step == None:
+                raise ValueError("<%s> without step"%program.tag)
+            if self.__programs.has_key(step):
+                raise ValueError("step '%s' defined twice"%step)
+            if len(program.findall("executable")) != 1:
+                raise ValueError("step '%s' needs exactly one executable"%step)
+            for t in list(program):
+                if t.tag not in PROGRAM_TAGS:
+                    print >> sys.stderr,"WARNING: skipping unknown element <%s> in step '%s' of '%s'"%(t.tag,step,optionfile)
+                    program.remove(t)
+                    continue
+                if t.tag in ["flag","option","filetype"] and not t.attrib.has_key("name"):
+                    raise ValueError("<%s> without name in step '%s'"%(t.tag,step))
+                if t.tag == "threads" and not t.attrib.has_key("option"):
+                    raise ValueError("<threads> without option in step '%s'"%step)
+            self.__steps.append(step)
+            self.__programs[step] = program
+
+    def get_filename(self):
+        return self.__filename
+
+    def get_steps(self):
+        return self.__steps
+
+    def has_step(self,step):
+        return self.__programs.has_key(step)
+
+    def get_program(self,step):
+        """ XML element of 'step', ValueError if it is not defined """
+        if not self.__programs.has_key(step):
+            raise ValueError("no options for step '%s'"%step)
+        return self.__programs[step]
+
+
+_programconfigs = {}
+
+def load_config(optionfile):
+    """ ProgramConfig of 'optionfile', parsed again only if the file changed """
+    try:
+        key = (os.path.abspath(optionfile),os.path.getmtime(optionfile))
+    except OSError:
+        raise IOError
+    if not _programconfigs.has_key(key):
+        _programconfigs[key] = ProgramConfig(optionfile)
+    return _programconfigs[key]
+
+
 
 # ***************************************************************** #
 # **         class to load parameters from external XML file     ** #
@@ -34,11 +142,11 @@ def file_exists(filenames):
 # ***************************************************************** #
 class externalprogram:
     def __init__(self,optionfile,step,verbose=True):
-        try:
-            self.__options = ET.parse(optionfile)
-        except:
-            raise IOError
-        self.__xmlroot = self.__options.getroot()
+        """ 'optionfile' is a ProgramConfig or the name of an options file """
+        if isinstance(optionfile,ProgramConfig):
+            config = optionfile
+        else:
+            config = load_config(optionfile)
         self.__haveexecutable = False
         self.__executable = ""
         self.__parameters = []
@@ -48,10 +156,10 @@ class externalprogram:
         self.__fnamestderr = None
         self.__verbose = verbose
         self.__filetypes = {}
+        self.__threadoption = None
 
-        self.__hit = self.__xmlroot.findall("./*[@step='"+step+"']")
-        if len(self.__hit) >= 1:
-            for t in self.__hit[0].getchildren():
+        if config.has_step(step):
+            for t in config.get_program(step).getchildren():
                 if t.tag == "executable":
                     self.__executable = t.text
                     self.__haveexecutable = True
@@ -68,6 +176,9 @@ class externalprogram:
 			if not self.__filetypes.has_key(t.attrib['name']):
 			    self.__filetypes[t.attrib['name']] = []
 			self.__filetypes[t.attrib['name']].append(t.text)
+                elif t.tag == "threads":                       # option for number of threads, set by scheduler
+		    if t.attrib.has_key('option'):
+			self.__threadoption = t.attrib['option']
         else:
             raise ValueError
         
@@ -87,7 +198,7 @@ class externalprogram:
     def get_files(self,option):
 	if self.__kwargs.has_key(option):
 	    if self.get_filetypes(option) != None:
-		return [self.get_option(option) + ft for ft in self.get_filetypes(option)]
+		return [self.get_option(option) + "." + ft.lstrip(".") for ft in self.get_filetypes(option)]
 	    else:
 		return [self.get_option(option)]
 	else:
@@ -112,9 +223,15 @@ class externalprogram:
         else:
             return False
     
-    def execute(self,wait=True):
+    def execute(self,wait=True,pipe=False,stdin=None):
+        """ run program; with pipe=True its stdout is handed back as 'pid.stdout'
+        and the caller is responsible for reading it and waiting for the process,
+        'stdin' is passed on to Popen (e.g. subprocess.PIPE) """
         if self.check_existence():
-            if self.__fnamestdout == None:
+            if pipe:
+                self.__pso = subprocess.PIPE
+                wait = False
+            elif self.__fnamestdout == None:
                 self.__pso = sys.stdout
             else:
                 self.__pso = open(self.__fnamestdout,'w')
@@ -122,14 +239,13 @@ class externalprogram:
                 self.__pse = sys.stderr
             else:
                 self.__pse = open(self.__fnamestderr,'w')
-            if self.__verbose: print "EXECUTE: ",
-            if self.__verbose: print self
-            self.__pid = subprocess.Popen(self.cmdlineparameters(),stdout = self.__pso,stderr = self.__pse)
+            if self.__verbose: write_output("EXECUTE:  %s"%self)
+            self.__pid = subprocess.Popen(self.cmdlineparameters(),stdin = stdin,stdout = self.__pso,stderr = self.__pse)
             if wait:
                 self.__pid.wait()
             return self.__pid
         else:
-	    if self.__verbose: print "EXECUTABLE NOT FOUND"
+	    if self.__verbose: write_output("EXECUTABLE NOT FOUND")
             return None
 
     def __del__(self):
@@ -206,10 +322,1047 @@ class externalprogram:
     
     def get_parameters(self):
         return self.__parameters
+    def get_options(self):
+        return dict(self.__kwargs)
     def get_flags(self):
         return self.__flags
 
+    def get_threadoption(self):
+        return self.__threadoption
+    def set_threads(self,n):
+        """ set number of threads, if the program has an option for it """
+        if self.__threadoption != None:
+            self.__kwargs[self.__threadoption] = str(n)
+
+    def replace_value(self,old,new):
+        """ replace value of options and parameters, e.g. name of an output file """
+        for o in self.__kwargs.keys():
+            if self.__kwargs[o] == old:
+                self.__kwargs[o] = new
+        self.__parameters = [new if p == old else p for p in self.__parameters]
+
+    def get_signature(self,replace = {}):
+        """ executable, options, flags and parameters without the number of
+        threads, which does not change the output; values found in 'replace'
+        (e.g. names of input and output files) are substituted """
+        signature = [self.get_executable()]
+        for o in sorted(self.__kwargs.keys()):
+            if o == self.__threadoption:
+                continue
+            signature += ["-%s"%o,replace.get(self.__kwargs[o],self.__kwargs[o]) or ""]
+        signature += ["--%s"%f for f in self.__flags]
+        signature += [replace.get(p,p) for p in self.__parameters]
+        return signature
+
+# ***************************************************************** #
+# **         resource usage of pipeline steps                    ** #
+# **         counters of processes are global, for steps running ** #
+# **         at the same time they include each other's usage    ** #
+# ***************************************************************** #
+_current = threading.local()
+
+def record_count(item,n):
+    """ add 'n' to counter 'item' of the step running in this thread """
+    metrics = getattr(_current,"metrics",None)
+    if metrics != None:
+        metrics.add_count(item,n)
+
+
+def read_proc_io():
+    """ bytes read and written by this process (Linux only) """
+    io = {}
+    try:
+        for line in open("/proc/self/io"):
+            k,v = line.split(":")
+            io[k.strip()] = int(v)
+    except (IOError,ValueError):
+        pass
+    return io.get("rchar",0),io.get("wchar",0)
+
+
+class StepMetrics():
+    def __init__(self):
+        self.__counts = {}
+        self.__lock = threading.Lock()
+        self.__result = None
+        self.__wall = time.time()
+        self.__self = resource.getrusage(resource.RUSAGE_SELF)
+        self.__children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.__io = read_proc_io()
+
+    def add_count(self,item,n):
+        self.__lock.acquire()
+        self.__counts[item] = self.__counts.get(item,0) + n
+        self.__lock.release()
+
+    def stop(self):
+        wall = time.time() - self.__wall
+        ruself = resource.getrusage(resource.RUSAGE_SELF)
+        ruchildren = resource.getrusage(resource.RUSAGE_CHILDREN)
+        io = read_proc_io()
+        self.__result = {
+            "wall":               wall,
+            "cpu_user":           ruself.ru_utime - self.__self.ru_utime,
+            "cpu_system":         ruself.ru_stime - self.__self.ru_stime,
+            "children_cpu_user":  ruchildren.ru_utime - self.__children.ru_utime,
+            "children_cpu_system":ruchildren.ru_stime - self.__children.ru_stime,
+            "peak_rss_kb":        ruself.ru_maxrss,
+            "children_peak_rss_kb":ruchildren.ru_maxrss,
+            "bytes_read":         io[0] - self.__io[0],
+            "bytes_written":      io[1] - self.__io[1],
+            "children_bytes_read":512*(ruchildren.ru_inblock - self.__children.ru_inblock),
+            "children_bytes_written":512*(ruchildren.ru_oublock - self.__children.ru_oublock),
+            "counts":             dict(self.__counts),
+            "rates":              dict([(k + "_per_second",v/wall if wall > 0 else None) for k,v in self.__counts.items()]),
+            }
+        return self.__result
+
+    def get_result(self):
+        return self.__result
+
+
+
+# ***************************************************************** #
+# **         processors available to this process                ** #
+# **         (CPU affinity and cgroup quota of containers or     ** #
+# **         batch systems), shared among steps running at the   ** #
+# **         same time                                           ** #
+# ***************************************************************** #
+def parse_cpu_list(text):
+    """ number of processors in a list like '0-3,8,10-11' """
+    n = 0
+    for item in text.strip().split(","):
+        if "-" in item:
+            a,b = item.split("-")
+            n += int(b) - int(a) + 1
+        elif item != "":
+            n += 1
+    return n
+
+
+def cgroup_cpu_limit(root = "/sys/fs/cgroup",cgroupfile = "/proc/self/cgroup"):
+    """ smallest CPU quota (in processors) of the cgroups listed in
+    'cgroupfile' and their parents, None if there is no quota """
+    dirs = [root]
+    try:
+        for line in open(cgroupfile):
+            hid,controllers,path = line.rstrip("\n").split(":",2)
+            if hid == "0":
+                bases = [root]
+            elif "cpu" in controllers.split(","):
+                bases = [os.path.join(root,controllers),os.path.join(root,"cpu")]
+            else:
+                continue
+            for base in bases:
+                d = os.path.normpath(base + path)
+                while d.startswith(base):
+                    dirs.append(d)
+                    d = os.path.dirname(d)
+    except (IOError,ValueError):
+        pass
+    limits = []
+    for d in dirs:
+        try:
+            if os.path.isfile(os.path.join(d,"cpu.max")):
+                # cgroup v2: 'quota period' or 'max period'
+                v = open(os.path.join(d,"cpu.max")).read().split()
+                if v[0] != "max":
+                    limits.append(float(v[0])/float(v[1]))
+            elif os.path.isfile(os.path.join(d,"cpu.cfs_quota_us")):
+                # cgroup v1: quota is -1 without limit
+                quota = float(open(os.path.join(d,"cpu.cfs_quota_us")).read())
+                period = float(open(os.path.join(d,"cpu.cfs_period_us")).read())
+                if quota > 0:
+                    limits.append(quota/period)
+        except (IOError,ValueError,IndexError,ZeroDivisionError):
+            pass
+    if len(limits) == 0:
+        return None
+    return min(limits)
+
+
+def available_cpus():
+    """ processors this process may use: online processors, restricted
+    by CPU affinity and by the CPU quota of its cgroup """
+    try:
+        cpus = multiprocessing.cpu_count()
+    except NotImplementedError:
+        cpus = 1
+    if hasattr(os,"sched_getaffinity"):
+        cpus = min(cpus,len(os.sched_getaffinity(0)))
+    else:
+        try:
+            for line in open("/proc/self/status"):
+                if line.startswith("Cpus_allowed_list:"):
+                    cpus = min(cpus,parse_cpu_list(line.split(":")[1]))
+        except (IOError,ValueError):
+            pass
+    limit = cgroup_cpu_limit()
+    if limit != None:
+        cpus = min(cpus,int(ceil(limit)))
+    return max(1,cpus)
+
+
+def step_threads():
+    """ processors assigned to the step running in this thread, None
+    outside of the scheduler or for steps without threads """
+    return getattr(_current,"threads",None)
+
+
+class CpuBudget():
+    """ processors shared by the steps of a pipeline; every step using
+    threads gets at least one, even if that exceeds the budget """
+    def __init__(self,cpus):
+        self.__cpus = cpus
+        self.__used = 0
+        self.__lock = threading.Lock()
+
+    def get_cpus(self):
+        return self.__cpus
+
+    def get_free(self):
+        return max(0,self.__cpus - self.__used)
+
+    def acquire(self,wanted,waiting = 1):
+        """ reserve an equal share of the free processors for one of
+        'waiting' steps starting at the same time, at most 'wanted' """
+        self.__lock.acquire()
+        n = max(1,min(wanted,self.get_free()//max(1,waiting)))
+        self.__used += n
+        self.__lock.release()
+        return n
+
+    def release(self,n):
+        self.__lock.acquire()
+        self.__used -= n
+        self.__lock.release()
+
+
+
+# ***************************************************************** #
+# **         dependency graph of pipeline steps                  ** #
+# **         each step is started once its requirements are      ** #
+# **         done and its input files exist                      ** #
+# ***************************************************************** #
+class PipelineError(Exception):
+    pass
+
+
+class PipelineStep():
+    def __init__(self,name,action,requires = [],inputs = [],threads = 0,checkpoint = None,always = False):
+        self.name = name
+        self.action = action
+        self.requires = list(requires)
+        self.always = always
+        self.inputs = list(inputs)
+        self.threads = threads
+        self.checkpoint = checkpoint
+        self.key = None
+        self.fingerprint = None
+        self.outputs = []
+        self.skipped = False
+        self.cpus = None
+        self.status = "waiting"
+        self.error = None
+        self.starttime = None
+        self.endtime = None
+        self.metrics = None
+
+    def get_inputs(self):
+        # inputs may be given as callables, resolved when the step is ready
+        return [f() if callable(f) else f for f in self.inputs]
+
+    def missing_inputs(self):
+        return [f for f in self.get_inputs() if not os.path.exists(f)]
+
+
+class PipelineScheduler():
+    """ runs steps in threads as soon as they are ready; steps depending
+    on a failed step are cancelled, start and end times are logged;
+    with 'cpus' the processors are shared among steps using threads;
+    with a RunManifest finished steps are recorded, and steps with a
+    checkpoint are skipped if they finished before with the same
+    fingerprint """
+    def __init__(self,verbose = True,maxparallel = None,logfile = None,profiledir = None,cpus = None,manifest = None):
+        self.__profiledir = profiledir
+        self.__manifest = manifest
+        self.__budget = CpuBudget(cpus) if cpus != None else None
+        self.__steps = []
+        self.__names = {}
+        self.__verbose = verbose
+        self.__maxparallel = maxparallel
+        self.__logfile = logfile
+        self.__condition = threading.Condition()
+
+    def __getitem__(self,name):
+        return self.__names[name]
+
+    def __iter__(self):
+        for step in self.__steps:
+            yield step
+
+    def add_step(self,name,action,requires = [],inputs = [],threads = 0,checkpoint = None,always = False):
+        """ 'action' is called without arguments, it fails by raising
+        an exception or returning False; a step that can use up to
+        'threads' processors finds its share with step_threads();
+        'checkpoint' (a StepCheckpoint) makes the step resumable; with
+        'always' the step runs once the steps it requires have finished,
+        even if some of them failed or were cancelled """
+        if self.__names.has_key(name):
+            raise ValueError
+        step = PipelineStep(name,action,requires,inputs,threads,checkpoint,always)
+        self.__steps.append(step)
+        self.__names[name] = step
+        return step
+
+    def __log(self,msg):
+        write_output("%s %s"%(time.strftime("%Y-%m-%d %H:%M:%S"),msg),self.__verbose,self.__logfile)
+
+    def __check(self):
+        for step in self.__steps:
+            for r in step.requires:
+                if not self.__names.has_key(r):
+                    raise ValueError("step '%s' requires unknown step '%s'"%(step.name,r))
+        # topological sort, raises on cycles
+        done = set()
+        while len(done) < len(self.__steps):
+            ready = [s.name for s in self.__steps if s.name not in done and all([r in done for r in s.requires])]
+            if len(ready) == 0:
+                raise ValueError("dependency cycle between steps")
+            done.update(ready)
+
+    def __resume_step(self,step):
+        """ fingerprint of the step; True if its checkpoint is still valid
+        and its saved data could be restored """
+        step.key = step.checkpoint.get_key() if step.checkpoint != None else None
+        parents = [[self.__names[r].fingerprint,self.__names[r].outputs] for r in step.requires]
+        step.fingerprint = self.__manifest.fingerprint(step.name,step.key,step.get_inputs(),parents)
+        if step.checkpoint == None or not self.__manifest.is_done(step.name,step.fingerprint):
+            self.__manifest.forget(step.name)
+            return False
+        try:
+            if step.checkpoint.restore != None:
+                step.checkpoint.restore(self.__manifest.get_data(step.name))
+        except Exception as e:
+            self.__log("RERUN:   %s, could not restore checkpoint: %s"%(step.name,e))
+            self.__manifest.forget(step.name)
+            return False
+        step.outputs = self.__manifest.get_outputs(step.name)
+        return True
+
+    def __checkpoint_step(self,step):
+        """ record finished step in the manifest """
+        checkpoint = step.checkpoint
+        if checkpoint == None:
+            return
+        data = None
+        if checkpoint.save != None:
+            data = checkpoint.save()
+        self.__manifest.record(step.name,step.fingerprint,step.key,step.get_inputs(),checkpoint.get_outputs(),data)
+        step.outputs = self.__manifest.get_outputs(step.name)
+
+    def __run_step(self,step):
+        if self.__manifest != None and self.__resume_step(step):
+            step.skipped = True
+            self.__condition.acquire()
+            if step.cpus != None:
+                self.__budget.release(step.cpus)
+            step.endtime = time.time()
+            step.status = "done"
+            self.__log("SKIP:    %s (checkpoint)"%step.name)
+            self.__condition.notify_all()
+            self.__condition.release()
+            return
+        metrics = StepMetrics()
+        _current.metrics = metrics
+        _current.threads = step.cpus
+        if self.__profiledir != None:
+            profile = cProfile.Profile()
+            profile.enable()
+        try:
+            r = step.action()
+            status = "failed" if r is False else "done"
+            if status == "done" and self.__manifest != None:
+                self.__checkpoint_step(step)
+        except Exception as e:
+            status = "failed"
+            step.error = str(e)
+        if self.__profiledir != None:
+            profile.disable()
+            profile.dump_stats(os.path.join(self.__profiledir,"profile.%s.prof"%step.name.replace(":","_")))
+        _current.metrics = None
+        _current.threads = None
+        step.metrics = metrics.stop()
+        self.__condition.acquire()
+        if step.cpus != None:
+            self.__budget.release(step.cpus)
+        step.endtime = time.time()
+        step.status = status
+        # logged before waking up the scheduler, END precedes the START of dependent steps
+        if status == "done":
+            self.__log("END:     %s (%.2lfs)"%(step.name,step.endtime-step.starttime))
+        else:
+            self.__log("FAILED:  %s (%.2lfs) %s"%(step.name,step.endtime-step.starttime,step.error or ""))
+        self.__condition.notify_all()
+        self.__condition.release()
+
+    def run(self):
+        """ run all steps, return True if every step succeeded """
+        self.__check()
+        threads = []
+        self.__condition.acquire()
+        try:
+            while True:
+                running = 0
+                for step in self.__steps:
+                    if step.status != "waiting":
+                        running += (step.status == "running")
+                        continue
+                    states = [self.__names[r].status for r in step.requires]
+                    if not step.always and ("failed" in states or "cancelled" in states):
+                        step.status = "cancelled"
+                        self.__log("CANCEL:  %s"%step.name)
+                start = []
+                for step in self.__steps:
+                    if step.status != "waiting":
+                        continue
+                    if self.__maxparallel != None and running + len(start) >= self.__maxparallel:
+                        break
+                    finished = ["done","failed","cancelled"] if step.always else ["done"]
+                    if all([self.__names[r].status in finished for r in step.requires]):
+                        missing = step.missing_inputs()
+                        if len(missing) > 0:
+                            step.status = "failed"
+                            step.error = "missing input '%s'"%missing[0]
+                            self.__log("FAILED:  %s %s"%(step.name,step.error))
+                            continue
+                        start.append(step)
+                # free processors are split among the steps starting now
+                threaded = [step for step in start if step.threads > 0]
+                for i,step in enumerate(threaded):
+                    if self.__budget != None:
+                        step.cpus = self.__budget.acquire(step.threads,len(threaded) - i)
+                for step in start:
+                    step.status = "running"
+                    step.starttime = time.time()
+                    if step.cpus != None:
+                        self.__log("START:   %s (%d cpus)"%(step.name,step.cpus))
+                    else:
+                        self.__log("START:   %s"%step.name)
+                    t = threading.Thread(target = self.__run_step,args = (step,))
+                    t.daemon = True
+                    t.start()
+                    threads.append(t)
+                    running += 1
+                if running == 0 and all([s.status != "waiting" for s in self.__steps]):
+                    break
+                if running == 0:
+                    # a step failed without threads left, propagate cancellation
+                    continue
+                self.__condition.wait(1.)
+        finally:
+            self.__condition.release()
+        # steps are finished, their threads only have to return
+        for t in threads:
+            t.join()
+        return all([s.status == "done" for s in self.__steps])
+
+    def get_failed(self):
+        return [s for s in self.__steps if s.status == "failed"]
+
+    def write_report(self,filename,info = {}):
+        """ JSON file with status, times and metrics of all steps """
+        steps = []
+        for step in self.__steps:
+            steps.append({"name":step.name,"status":step.status,"error":step.error,"requires":step.requires,
+                          "start":step.starttime,"end":step.endtime,"cpus":step.cpus,"metrics":step.metrics,
+                          "skipped":step.skipped})
+        report = dict(info)
+        report["steps"] = steps
+        f = open(filename,"w")
+        json.dump(report,f,indent = 2,sort_keys = True)
+        f.close()
+
+
+
+# ***************************************************************** #
+# **         checkpoints: manifest of finished steps, fingerprint ** #
+# **         of their options and inputs and their outputs        ** #
+# ***************************************************************** #
+def file_stamp(filename):
+    """ [path,size,modification time] of a file, None if it does not exist """
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return [os.path.abspath(filename),st.st_size,st.st_mtime]
+
+
+class StepCheckpoint():
+    """ makes a step resumable: 'key' returns the options its result
+    depends on (anything JSON can store) and 'outputs' the files it
+    writes; data returned by 'save' is kept in the manifest and handed
+    to 'restore' when the step is skipped """
+    def __init__(self,key = None,outputs = [],save = None,restore = None):
+        self.key = key
+        self.outputs = outputs
+        self.save = save
+        self.restore = restore
+
+    def get_key(self):
+        if self.key is None:
+            return None
+        return self.key()
+
+    def get_outputs(self):
+        outputs = self.outputs() if callable(self.outputs) else self.outputs
+        return [f() if callable(f) else f for f in outputs]
+
+
+class RunManifest():
+    """ JSON file with fingerprint, options, inputs, outputs and saved data
+    of every finished step; it is rewritten under a temporary name and
+    renamed after each step, without 'resume' earlier entries are dropped """
+    def __init__(self,filename,resume = False):
+        self.__filename = filename
+        self.__lock = threading.Lock()
+        self.__steps = {}
+        if resume and os.path.exists(filename):
+            try:
+                f = open(filename)
+                self.__steps = json.load(f)["steps"]
+                f.close()
+            except (IOError,ValueError,KeyError):
+                self.__steps = {}
+        else:
+            self.__write()
+
+    def __len__(self):
+        return len(self.__steps)
+
+    def fingerprint(self,name,key,inputs,parents):
+        """ hash of step name, options, stamps of input files and the
+        fingerprints and outputs of the steps it requires """
+        h = hashlib.sha1()
+        h.update(json.dumps([name,key,[file_stamp(f) for f in inputs],parents],sort_keys = True))
+        return h.hexdigest()
+
+    def is_done(self,name,fingerprint):
+        """ step finished with this fingerprint and its outputs are unchanged """
+        entry = self.__steps.get(name)
+        if entry is None or entry["fingerprint"] != fingerprint:
+            return False
+        return all([file_stamp(f[0]) == f for f in entry["outputs"]])
+
+    def get_data(self,name):
+        return self.__steps[name]["data"]
+
+    def get_outputs(self,name):
+        return self.__steps[name]["outputs"]
+
+    def forget(self,name):
+        self.__lock.acquire()
+        try:
+            if self.__steps.pop(name,None) is not None:
+                self.__write()
+        finally:
+            self.__lock.release()
+
+    def record(self,name,fingerprint,key,inputs,outputs,data = None):
+        stamps = [file_stamp(f) for f in outputs]
+        if None in stamps:
+            raise IOError("output '%s' of step '%s' is missing"%(outputs[stamps.index(None)],name))
+        self.__lock.acquire()
+        try:
+            self.__steps[name] = {"fingerprint":fingerprint,"key":key,"inputs":[file_stamp(f) for f in inputs],
+                                  "outputs":stamps,"data":data,"end":time.time()}
+            self.__write()
+        finally:
+            self.__lock.release()
+
+    def __write(self):
+        # called with lock held
+        partial = partial_prefix(self.__filename)
+        f = open(partial,"w")
+        json.dump({"steps":self.__steps},f,indent = 2,sort_keys = True)
+        f.close()
+        os.rename(partial,self.__filename)
+
+
+
+# ***************************************************************** #
+# **         persistent cache for databases and index files      ** #
+# **         keyed by content of input files and options         ** #
+# ***************************************************************** #
+def hash_file(filename,h = None,blocksize = 1<<20):
+    if h is None:
+        h = hashlib.sha1()
+    f = open(filename,"rb")
+    block = f.read(blocksize)
+    while block:
+        h.update(block)
+        block = f.read(blocksize)
+    f.close()
+    return h
+
+
+def prefixed_files(prefix):
+    """ all files 'prefix' or 'prefix.*' (e.g. output of makeblastdb, bowtie2-build) """
+    dirname,basename = os.path.split(prefix)
+    if dirname == "":
+        dirname = "."
+    return sorted([os.path.join(dirname,f) for f in os.listdir(dirname) if (f == basename or f.startswith(basename+".")) and os.path.isfile(os.path.join(dirname,f))])
+
+
+def partial_prefix(prefix):
+    """ temporary name in the same directory, outputs are written there
+    and renamed with 'rename_prefixed' once they are complete """
+    dirname,basename = os.path.split(prefix)
+    return os.path.join(dirname,".part." + basename)
+
+
+def rename_prefixed(src,dst):
+    """ rename files 'src' and 'src.*' to 'dst' and 'dst.*' """
+    for f in prefixed_files(src):
+        os.rename(f,dst + os.path.basename(f)[len(os.path.basename(src)):])
+
+
+def write_atomic(filename,write):
+    """ call 'write' with a temporary file name, then rename the file """
+    partial = partial_prefix(filename)
+    write(partial)
+    os.rename(partial,filename)
+
+
+class ArtifactCache():
+    """ directory with one subdirectory per key, holding the output files
+    of a step; entries are created under a temporary name and renamed,
+    the least recently used entries are removed above 'maxsize' bytes """
+    def __init__(self,cachedir,maxsize = None,verbose = True):
+        self.__cachedir = cachedir
+        self.__maxsize = maxsize
+        self.__verbose = verbose
+        if not os.path.isdir(cachedir):
+            try:
+                os.makedirs(cachedir)
+            except OSError:
+                if not os.path.isdir(cachedir):
+                    raise IOError
+        self.__lockfile = os.path.join(cachedir,".lock")
+
+    def __lock(self,mode):
+        f = open(self.__lockfile,"a")
+        fcntl.flock(f,mode)
+        return f
+
+    def __unlock(self,f):
+        fcntl.flock(f,fcntl.LOCK_UN)
+        f.close()
+
+    def __entry(self,key):
+        return os.path.join(self.__cachedir,key)
+
+    def key(self,program,inputfiles,outputprefix):
+        """ hash of executable, all options (with input and output names
+        replaced by placeholders) and the content of the input files """
+        h = hashlib.sha1()
+        replace = dict([(f,"{input%d}"%i) for i,f in enumerate(inputfiles)])
+        replace[outputprefix] = "{output}"
+        for p in program.get_signature(replace):
+            h.update(p + "\0")
+        for f in inputfiles:
+            hash_file(f,h)
+        return h.hexdigest()
+
+    def fetch(self,key,outputprefix):
+        """ link cached files to 'outputprefix', return False if not cached """
+        lock = self.__lock(fcntl.LOCK_SH)
+        try:
+            entry = self.__entry(key)
+            if not os.path.isdir(entry):
+                return False
+            for f in os.listdir(entry):
+                if f.startswith("."):
+                    continue
+                target = outputprefix + f[len("artifact"):]
+                if os.path.exists(target):
+                    os.remove(target)
+                try:
+                    os.link(os.path.join(entry,f),target)
+                except OSError:
+                    shutil.copy2(os.path.join(entry,f),target)
+            os.utime(entry,None)
+        finally:
+            self.__unlock(lock)
+        if self.__verbose: write_output("CACHED:  %s"%outputprefix)
+        return True
+
+    def store(self,key,outputprefix):
+        """ copy files 'outputprefix*' into the cache """
+        entry = self.__entry(key)
+        if os.path.isdir(entry):
+            return
+        tmpentry = tempfile.mkdtemp(prefix = ".tmp.",dir = self.__cachedir)
+        for f in prefixed_files(outputprefix):
+            shutil.copy2(f,os.path.join(tmpentry,"artifact" + os.path.basename(f)[len(os.path.basename(outputprefix)):]))
+        lock = self.__lock(fcntl.LOCK_EX)
+        try:
+            if os.path.isdir(entry):
+                shutil.rmtree(tmpentry,ignore_errors = True)
+            else:
+                os.rename(tmpentry,entry)
+            self.__evict(keep = key)
+        finally:
+            self.__unlock(lock)
+
+    def __size(self,entry):
+        return sum([os.path.getsize(os.path.join(entry,f)) for f in os.listdir(entry)])
+
+    def __evict(self,keep = None):
+        # called with exclusive lock held
+        if self.__maxsize is None:
+            return
+        entries = []
+        for key in os.listdir(self.__cachedir):
+            entry = self.__entry(key)
+            if key.startswith(".") or not os.path.isdir(entry):
+                continue
+            entries.append((os.path.getmtime(entry),key,self.__size(entry)))
+        total = sum([e[2] for e in entries])
+        for mtime,key,size in sorted(entries):
+            if total <= self.__maxsize:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self.__entry(key),ignore_errors = True)
+            total -= size
+
+
+
+# ***************************************************************** #
+# **         runs of equal depth: depth is depths[i] on bases    ** #
+# **         [starts[i],ends[i]), runs cover all bases in order  ** #
+# ***************************************************************** #
+def run_length_encode(depth):
+    """ (starts,ends,depths) of runs of equal depth """
+    depth = np.asarray(depth)
+    if len(depth) == 0:
+        empty = np.zeros(0,dtype=np.int64)
+        return empty,empty,empty
+    starts = np.concatenate(([0],np.nonzero(depth[1:] != depth[:-1])[0] + 1))
+    ends = np.append(starts[1:],len(depth))
+    return starts,ends,np.asarray(depth[starts],dtype=np.int64)
+
+
+def run_length_decode(starts,ends,depths,length = None):
+    """ per-base depth, bases not in any run have depth 0 """
+    if length is None:
+        length = int(ends[-1]) if len(ends) > 0 else 0
+    events = np.zeros(length + 1,dtype=np.int64)
+    np.add.at(events,np.asarray(starts,dtype=np.int64),depths)
+    np.subtract.at(events,np.asarray(ends,dtype=np.int64),depths)
+    return np.cumsum(events[:-1])
+
+
+
+# ***************************************************************** #
+# **         coverage of all single copy genes                   ** #
+# **         in one flat buffer                                  ** #
+# ***************************************************************** #
+class CoverageEngine():
+    """ per-base read depth of many references in a single flat array
+
+    every read only records two events (+1 at its start, -1 at its end)
+    in a difference array; the depth of all bases is materialized with
+    one cumulative sum when it is requested """
+
+    def __init__(self):
+        self.__offsets = [0]
+        self.__events = None
+        self.__countreads = None
+        self.__depth = None
+
+    def __len__(self):
+        return len(self.__offsets) - 1
+
+    def add_reference(self,length):
+        """ append a reference of given length, return its index """
+        self.__offsets.append(self.__offsets[-1] + length)
+        self.__depth = None
+        return len(self.__offsets) - 2
+
+    def __buffers(self):
+        # allocate lazily, grow if references were added after counting started
+        n = self.__offsets[-1] + 1
+        if self.__events is None:
+            self.__events = np.zeros(n,dtype=np.int64)
+            self.__countreads = np.zeros(len(self),dtype=np.int64)
+        elif len(self.__events) < n:
+            self.__events = np.concatenate((self.__events,np.zeros(n - len(self.__events),dtype=np.int64)))
+            self.__countreads = np.concatenate((self.__countreads,np.zeros(len(self) - len(self.__countreads),dtype=np.int64)))
+        return self.__events,self.__countreads
+
+    def get_offset(self,index):
+        return self.__offsets[index]
+
+    def get_offsets(self):
+        return np.array(self.__offsets,dtype=np.int64)
+
+    def get_length(self,index):
+        return self.__offsets[index+1] - self.__offsets[index]
+
+    def get_lengths(self):
+        return np.diff(self.get_offsets())
+
+    def add(self,index,mi,ma):
+        """ single read covering [mi,ma) on reference 'index' """
+        events,countreads = self.__buffers()
+        o = self.__offsets[index]
+        events[o+mi] += 1
+        events[o+ma] -= 1
+        countreads[index] += 1
+        self.__depth = None
+
+    def add_many(self,index,mi,ma):
+        """ vectorized version of 'add' for arrays of reads """
+        index = np.asarray(index,dtype=np.int64)
+        if len(index) == 0:
+            return
+        events,countreads = self.__buffers()
+        o = self.get_offsets()[index]
+        events += np.bincount(o + np.asarray(mi,dtype=np.int64),minlength = len(events))
+        events -= np.bincount(o + np.asarray(ma,dtype=np.int64),minlength = len(events))
+        countreads += np.bincount(index,minlength = len(countreads))
+        self.__depth = None
+
+    def get_events(self,index):
+        """ difference array of one reference, including the end position;
+        rebuilt from the depth since the end position of a reference shares
+        its slot with the start of the next one """
+        return np.diff(np.concatenate(([0],np.asarray(self.get_coverage(index),dtype=np.int64),[0])))
+
+    def merge(self,indices,events,counts):
+        """ add difference arrays (as returned by 'get_events', concatenated)
+        and read counts of the references 'indices' """
+        buf,countreads = self.__buffers()
+        p = 0
+        for index,c in zip(indices,counts):
+            o,l = self.__offsets[index],self.get_length(index)
+            buf[o:o+l+1] += events[p:p+l+1]
+            countreads[index] += c
+            p += l+1
+        self.__depth = None
+
+    def get_depth(self):
+        """ per-base depth of all references, concatenated """
+        if self.__depth is None:
+            events = self.__buffers()[0]
+            self.__depth = np.cumsum(events[:-1])
+        return self.__depth
+
+    def get_coverage(self,index):
+        return self.get_depth()[self.__offsets[index]:self.__offsets[index+1]]
+
+    def get_runs(self,index):
+        """ runs of equal depth, see 'run_length_encode' """
+        return run_length_encode(self.get_coverage(index))
+
+    def get_count_reads(self,index):
+        return int(self.__buffers()[1][index])
+
+    def get_counts(self):
+        return self.__buffers()[1]
+
+    def get_moments(self,index):
+        """ number of bases, sum and sum of squares of their depth """
+        c = self.get_coverage(index)
+        return len(c),int(c.sum()),int(np.dot(c,c))
+
+    def get_median(self,index):
+        return float(np.median(self.get_coverage(index)))
+
+
+
+class CoverageSummary():
+    """ coverage of many references kept only as running moments and
+    bounded depth histograms, memory does not depend on their length
+
+    reads have to be added in order of their start on every reference
+    (e.g. from sorted alignments): bases before the start of the last read
+    cannot change anymore, their depth is only known at starts and ends of
+    reads and every run of equal depth is counted at once. Depths of at
+    least 'bins'-1 share the last bin of the per-reference histograms """
+
+    def __init__(self,bins = 256,globalbins = 1<<16):
+        self.__bins = bins
+        self.__globalbins = globalbins
+        self.__lengths = []
+        self.__arrays = None
+        self.__histograms = None
+        self.__globalhistogram = np.zeros(globalbins,dtype=np.int64)
+        self.__active = {}
+        self.__finished = True
+
+    def __len__(self):
+        return len(self.__lengths)
+
+    def add_reference(self,length):
+        """ append a reference of given length, return its index """
+        self.__lengths.append(length)
+        self.__finished = False
+        return len(self.__lengths) - 1
+
+    def __buffers(self):
+        # rows: position up to which bases are final, reads, sum and sum of squares of depth
+        n = len(self.__lengths)
+        if self.__arrays is None:
+            self.__arrays = np.zeros((4,n),dtype=np.int64)
+            self.__histograms = np.zeros((n,self.__bins),dtype=np.int64)
+        elif self.__arrays.shape[1] < n:
+            m = n - self.__arrays.shape[1]
+            self.__arrays = np.concatenate((self.__arrays,np.zeros((4,m),dtype=np.int64)),axis = 1)
+            self.__histograms = np.concatenate((self.__histograms,np.zeros((m,self.__bins),dtype=np.int64)))
+        return self.__arrays,self.__histograms
+
+    def get_length(self,index):
+        return self.__lengths[index]
+
+    def get_lengths(self):
+        return np.array(self.__lengths,dtype=np.int64)
 
+    def get_bins(self):
+        return self.__bins
+
+    def __advance(self,index,frontier,starts,ends):
+        arrays,histograms = self.__buffers()
+        pos = arrays[0,index]
+        active = self.__active.pop(index,np.zeros(0,dtype=np.int64))
+        allends = np.concatenate((active,ends))
+        opening = starts[starts < frontier]
+        closing = allends[allends < frontier]
+        positions = np.concatenate(([pos],opening,closing,[frontier]))
+        deltas = np.concatenate(([len(active)],np.ones(len(opening),dtype=np.int64),-np.ones(len(closing),dtype=np.int64),[0]))
+        order = np.argsort(positions,kind = "mergesort")
+        positions = positions[order]
+        depth = np.cumsum(deltas[order])[:-1]
+        runs = np.diff(positions)
+        arrays[2,index] += np.dot(depth,runs)
+        arrays[3,index] += np.dot(depth*depth,runs)
+        histograms[index] += np.bincount(np.minimum(depth,self.__bins-1),weights = runs,minlength = self.__bins).astype(np.int64)
+        self.__globalhistogram += np.bincount(np.minimum(depth,self.__globalbins-1),weights = runs,minlength = self.__globalbins).astype(np.int64)
+        arrays[0,index] = frontier
+        remaining = allends[allends > frontier]
+        if len(remaining) > 0:
+            self.__active[index] = remaining
+
+    def add_sorted(self,index,mi,ma):
+        """ reads covering [mi,ma) on reference 'index', sorted by 'mi'
+        and not starting before any read added earlier """
+        mi = np.asarray(mi,dtype=np.int64)
+        ma = np.asarray(ma,dtype=np.int64)
+        if len(mi) == 0:
+            return
+        arrays = self.__buffers()[0]
+        if mi[0] < arrays[0,index] or np.any(mi[1:] < mi[:-1]):
+            raise ValueError("summary coverage needs alignments sorted by position")
+        arrays[1,index] += len(mi)
+        self.__advance(index,mi[-1],mi,ma)
+        self.__finished = False
+
+    def add(self,index,mi,ma):
+        self.add_sorted(index,[mi],[ma])
+
+    def add_many(self,index,mi,ma):
+        """ reads of several references, sorted by start on each of them """
+        index = np.asarray(index,dtype=np.int64)
+        mi = np.asarray(mi,dtype=np.int64)
+        ma = np.asarray(ma,dtype=np.int64)
+        if len(index) == 0:
+            return
+        order = np.argsort(index,kind = "mergesort")
+        index,mi,ma = index[order],mi[order],ma[order]
+        bounds = np.nonzero(np.diff(index))[0] + 1
+        for a,b in zip(np.concatenate(([0],bounds)),np.concatenate((bounds,[len(index)]))):
+            self.add_sorted(index[a],mi[a:b],ma[a:b])
+
+    def finish(self):
+        """ count remaining bases of all references up to their end """
+        if self.__finished:
+            return
+        arrays = self.__buffers()[0]
+        empty = np.zeros(0,dtype=np.int64)
+        for index,length in enumerate(self.__lengths):
+            if arrays[0,index] < length:
+                self.__advance(index,length,empty,empty)
+        self.__finished = True
+
+    def get_state(self):
+        """ reads, sums, sums of squares and histograms, for 'merge' """
+        self.finish()
+        arrays,histograms = self.__buffers()
+        return arrays[1],arrays[2],arrays[3],histograms,self.__globalhistogram
+
+    def merge(self,indices,counts,sums,sums2,histograms,globalhistogram):
+        """ add finished summaries (as returned by 'get_state') of the
+        references 'indices' """
+        arrays,ownhistograms = self.__buffers()
+        indices = np.asarray(indices,dtype=np.int64)
+        arrays[0,indices] = self.get_lengths()[indices]
+        arrays[1,indices] += counts
+        arrays[2,indices] += sums
+        arrays[3,indices] += sums2
+        ownhistograms[indices] += histograms
+        n = min(len(globalhistogram),self.__globalbins)
+        self.__globalhistogram[:n] += globalhistogram[:n]
+        self.__globalhistogram[-1] += np.sum(globalhistogram[n:])
+
+    def get_count_reads(self,index):
+        return int(self.__buffers()[0][1,index])
+
+    def get_counts(self):
+        return self.__buffers()[0][1]
+
+    def get_moments(self,index):
+        """ number of bases, sum and sum of squares of their depth """
+        self.finish()
+        arrays = self.__buffers()[0]
+        return self.__lengths[index],int(arrays[2,index]),int(arrays[3,index])
+
+    def get_sums(self):
+        self.finish()
+        return self.__buffers()[0][2]
+
+    def get_sums2(self):
+        self.finish()
+        return self.__buffers()[0][3]
+
+    def get_histograms(self):
+        self.finish()
+        return self.__buffers()[1]
+
+    def get_global_histogram(self):
+        self.finish()
+        return self.__globalhistogram
+
+    def get_medians(self):
+        """ median depth of every reference, from its histogram """
+        histograms = self.get_histograms()
+        if len(histograms) == 0:
+            return np.zeros(0)
+        cumulative = np.cumsum(histograms,axis = 1)
+        n = self.get_lengths()
+        lower = np.argmax(cumulative > ((n-1)//2)[:,None],axis = 1)
+        upper = np.argmax(cumulative > (n//2)[:,None],axis = 1)
+        return 0.5*(lower + upper)
+
+    def get_median(self,index):
+        return float(self.get_medians()[index])
+
+    def get_coverage(self,index):
+        raise ValueError("per-base coverage is not kept in summary mode")
+
+    def get_runs(self,index):
+        raise ValueError("per-base coverage is not kept in summary mode")
 
 
 
@@ -219,12 +1372,14 @@ class externalprogram:
 # ***************************************************************** #
 class SequenceRecord():
     
-    def __init__(self,sid,sequence):
+    def __init__(self,sid,sequence,engine=None):
         self.__name = sid
         self.__sequence = sequence
         self.__length = len(sequence)
-        self.__coverage = [0 for i in range(self.__length)]
-        self.__countreads = 0
+        if engine is None:
+            engine = CoverageEngine()
+        self.__engine = engine
+        self.__index = engine.add_reference(self.__length)
     
     def __len__(self):
         return self.__length
@@ -235,43 +1390,66 @@ class SequenceRecord():
     def get_sequence(self):
         return self.__sequence
     
+    def get_index(self):
+        return self.__index
+    
     def add_coverage(self,mi,ma):
-        for i in range(mi,ma):
-            self.__coverage[i] += 1
-        self.__countreads += 1
+        self.__engine.add(self.__index,mi,ma)
 
     def get_count_reads(self):
-	return self.__countreads
+	return self.__engine.get_count_reads(self.__index)
 
     def get_coverage(self):
-	return self.__coverage
+	return self.__engine.get_coverage(self.__index)
+
+    def get_coverage_runs(self):
+        """ coverage as (starts,ends,depths) of runs of equal depth """
+        return self.__engine.get_runs(self.__index)
 
     def get_coverage_mean(self):
-        if self.__countreads > 0:
-            return float(sum(self.__coverage))/float(self.__length)
+        if self.get_count_reads() > 0:
+            n,c1,c2 = self.__engine.get_moments(self.__index)
+            return float(c1)/float(n)
         else:
             return None
     
     def get_coverage_stddev(self):
-        if self.__countreads > 0:
-            c2 = float(sum([ci**2 for ci in self.__coverage]))
-            c1 = float(sum(self.__coverage))
-            n = float(self.__length)
+        if self.get_count_reads() > 0:
+            n,c1,c2 = self.__engine.get_moments(self.__index)
+            n,c1,c2 = float(n),float(c1),float(c2)
             return sqrt(n*c2-c1*c1)/sqrt(n*n-n)
         else:
             return None
 
+    def get_coverage_median(self):
+        if self.get_count_reads() > 0:
+            return self.__engine.get_median(self.__index)
+        else:
+            return None
+
 
 
 # ***************************************************************** #
 # **         list of all single copy genes                       ** #
 # ***************************************************************** #
 class SingleCopyGeneList():
-    def __init__(self,scglength = None, readlength = None):
+    def __init__(self,scglength = None, readlength = None, summarybins = None, fractions = None):
+        """ with 'summarybins' only summaries of coverage are kept, see CoverageSummary;
+        with a ladder of 'fractions' the coverage of nested subsamples of reads is
+        counted as well, as sums of depth per subsample bucket and SCG """
         self.__seqid = []
         self.__seq = {}
+        self.__index = {}
+        self.__tidmap = None
+        self.__summarybins = summarybins
+        if summarybins != None:
+            self.__engine = CoverageSummary(summarybins)
+        else:
+            self.__engine = CoverageEngine()
         self.__readminlenght = readlength
         self.__scgminlength = scglength
+        self.__fractions = fractions
+        self.__bucketsums = None
     
     def __getitem__(self,sid):
         return self.__seq[sid]
@@ -285,22 +1463,140 @@ class SingleCopyGeneList():
 	    if self.__scgminlength > len(str(sequence)):
 		return None
         self.__seqid.append(sid)
-        self.__seq[sid] = SequenceRecord(sid,str(sequence))
+        self.__seq[sid] = SequenceRecord(sid,str(sequence),self.__engine)
+        self.__index[sid] = self.__seq[sid].get_index()
         
     def add_coverage(self,sid,start=None,end=None):
-        if sid in self.__seqid:
-            mi = min(start,end)
-            if mi<0:mi=0
-            ma = max(start,end)
-            if ma > len(self.__seq[sid]):ma = len(self.__seq[sid])
-            if self.__readminlenght:
-		if ma-mi > self.__readminlenght:
-		    self.__seq[sid].add_coverage(mi,ma)
-	    else:
-		self.__seq[sid].add_coverage(mi,ma)
+        if self.__index.has_key(sid):
+            self.add_coverage_index(self.__index[sid],start,end)
+        else:
+            print >> sys.stderr,"did not find sID"
+
+    def add_coverage_index(self,index,start,end):
+        mi = min(start,end)
+        if mi<0:mi=0
+        ma = max(start,end)
+        l = self.__engine.get_length(index)
+        if ma > l:ma = l
+        # reads outside of the SCG are counted, without depth
+        if mi > l:mi = l
+        if ma < mi:ma = mi
+        if self.__readminlenght:
+            if ma-mi > self.__readminlenght:
+                self.__engine.add(index,mi,ma)
+        else:
+            self.__engine.add(index,mi,ma)
+
+    def set_references(self,references):
+        """ map reference ids (pysam 'tid') of an alignment file to SCG indices """
+        self.__tidmap = np.array([self.__index.get(r,-1) for r in references],dtype=np.int64)
+
+    def add_coverage_tid(self,tid,start,end):
+        index = self.__tidmap[tid]
+        if index >= 0:
+            self.add_coverage_index(index,start,end)
         else:
             print >> sys.stderr,"did not find sID"
 
+    def add_coverage_tids(self,tids,starts,ends,names = None,cutoff = True):
+        """ vectorized 'add_coverage_tid' for arrays of alignments, read
+        'names' assign them to subsamples; with cutoff=False every read is
+        counted regardless of the read length cutoff """
+        index = self.__tidmap[np.asarray(tids,dtype=np.int64)]
+        starts = np.asarray(starts,dtype=np.int64)
+        ends = np.asarray(ends,dtype=np.int64)
+        known = index >= 0
+        if not np.all(known):
+            print >> sys.stderr,"did not find sID"
+        index = index[known]
+        mi,ma,keep = clip_reads(starts[known],ends[known],self.__engine.get_lengths()[index],self.__readminlenght if cutoff else None)
+        self.__engine.add_many(index[keep],mi[keep],ma[keep])
+        if self.__fractions != None and names is not None:
+            buckets = subsample_buckets(names,self.__fractions)[known]
+            self.add_subsample_coverage(index[keep],ma[keep] - mi[keep],buckets[keep])
+
+    def __subsample_sums(self):
+        # rows: buckets of the ladder of fractions, columns: SCGs in order of the engine
+        n = len(self.__engine)
+        if self.__bucketsums is None:
+            self.__bucketsums = np.zeros((len(self.__fractions),n),dtype=np.int64)
+        elif self.__bucketsums.shape[1] < n:
+            self.__bucketsums = np.concatenate((self.__bucketsums,np.zeros((len(self.__fractions),n - self.__bucketsums.shape[1]),dtype=np.int64)),axis = 1)
+        return self.__bucketsums
+
+    def add_subsample_coverage(self,index,bases,buckets):
+        """ add clipped lengths 'bases' of reads on SCGs 'index' to the sums of their subsample 'buckets' """
+        sums = self.__subsample_sums()
+        inside = np.asarray(buckets) < len(self.__fractions)
+        flat = np.asarray(buckets)[inside]*sums.shape[1] + np.asarray(index)[inside]
+        sums += np.bincount(flat,weights = np.asarray(bases)[inside],minlength = sums.size).astype(np.int64).reshape(sums.shape)
+
+    def get_subsample_sums(self,indices):
+        """ sums of depth per bucket of SCGs 'indices', for 'merge_subsample_sums' """
+        return self.__subsample_sums()[:,indices]
+
+    def merge_subsample_sums(self,indices,sums):
+        self.__subsample_sums()[:,indices] += np.asarray(sums,dtype=np.int64).reshape((len(self.__fractions),-1))
+
+    def get_fractions(self):
+        return self.__fractions
+
+    def copy_empty(self):
+        """ same SCGs without any coverage, e.g. for another read library """
+        scg = SingleCopyGeneList(scglength = self.__scgminlength, readlength = self.__readminlenght, summarybins = self.__summarybins, fractions = self.__fractions)
+        for sid in self.__seqid:
+            scg.add_sequence(sid,self.__seq[sid].get_sequence())
+        return scg
+
+    def get_coverage_means(self,fraction = None):
+        """ mean depth of every SCG, in order of 'get_ids', only from the
+        subsample of reads of 'fraction' (one of the ladder) if given """
+        order = np.array([self.__index[sid] for sid in self.__seqid],dtype=np.int64)
+        if len(order) == 0:
+            return np.zeros(0)
+        if fraction != None:
+            if self.__fractions is None or fraction not in self.__fractions:
+                raise ValueError("no subsample of fraction %g"%fraction)
+            # subsamples are nested, a fraction holds all buckets up to its own
+            sums = self.__subsample_sums()[:self.__fractions.index(fraction) + 1].sum(axis = 0)
+            return (sums.astype(np.float64)/np.maximum(self.__engine.get_lengths(),1))[order]
+        if self.is_summary():
+            return (self.__engine.get_sums().astype(np.float64)/np.maximum(self.__engine.get_lengths(),1))[order]
+        depth = self.__engine.get_depth()
+        offsets = self.__engine.get_offsets()
+        sums = np.add.reduceat(np.append(depth,0),offsets[:-1])
+        sums[offsets[1:] == offsets[:-1]] = 0
+        return (sums.astype(np.float64)/np.maximum(self.__engine.get_lengths(),1))[order]
+
+    def get_summary(self):
+        """ coverage statistics over all bases of all SCGs """
+        if self.is_summary():
+            bases = int(np.sum(self.__engine.get_lengths()))
+            summary = {"scgs":len(self.__seqid),"bases":bases,"reads":int(np.sum(self.__engine.get_counts()))}
+            if bases > 0:
+                summary["mean"] = float(np.sum(self.__engine.get_sums()))/bases
+                summary["stddev"] = sqrt(max(0.,float(np.sum(self.__engine.get_sums2()))/bases - summary["mean"]**2))
+            else:
+                summary["mean"] = summary["stddev"] = float("nan")
+            return summary
+        depth = self.__engine.get_depth()
+        summary = {"scgs":len(self.__seqid),"bases":len(depth),"reads":int(np.sum(self.__engine.get_counts()))}
+        if len(depth) > 0:
+            summary["mean"] = float(np.mean(depth))
+            summary["stddev"] = float(np.std(depth))
+        else:
+            summary["mean"] = summary["stddev"] = float("nan")
+        return summary
+
+    def get_engine(self):
+        return self.__engine
+
+    def is_summary(self):
+        return self.__summarybins != None
+
+    def get_readminlength(self):
+        return self.__readminlenght
+
     def get_ids(self):
         return self.__seqid
 
@@ -314,16 +1610,840 @@ class SingleCopyGeneList():
         f.close()
         del f
     
+    def write_binary_coverage_file(self,filename):
+        """ write in binary coverage format, see 'write_binary_coverage' """
+        order = [self.__index[sid] for sid in self.__seqid]
+        write_binary_coverage(filename,self.__seqid,
+                              self.__engine.get_lengths()[order],
+                              self.__engine.get_counts()[order],
+                              np.concatenate([self.__engine.get_coverage(i) for i in order] + [np.zeros(0,dtype=np.int64)]))
+
+    def write_coverage_summary_file(self,filename):
+        """ write summaries of coverage, see 'write_coverage_summary' """
+        order = [self.__index[sid] for sid in self.__seqid]
+        engine = self.__engine
+        if not self.is_summary():
+            # full coverage is reduced the same way
+            engine = CoverageSummary()
+            bins = engine.get_bins()
+            for j,i in enumerate(order):
+                engine.add_reference(self.__engine.get_length(i))
+                c = np.asarray(self.__engine.get_coverage(i),dtype=np.int64)
+                h = np.bincount(np.minimum(c,bins-1),minlength = bins)
+                engine.merge([j],[self.__engine.get_count_reads(i)],[c.sum()],[np.dot(c,c)],h[None,:],np.bincount(c))
+            order = range(len(order))
+        write_coverage_summary(filename,self.__seqid,engine,order)
+
+    def write_coverage_checkpoint(self,filename):
+        """ coverage exactly as kept in memory, to be restored with
+        'read_coverage_checkpoint': binary coverage file, or the state of
+        the summaries in NumPy format """
+        if not self.is_summary():
+            self.write_binary_coverage_file(filename)
+            return
+        order = [self.__index[sid] for sid in self.__seqid]
+        counts,sums,sums2,histograms,globalhistogram = self.__engine.get_state()
+        f = open(filename,"wb")
+        np.savez(f,names = np.array(self.__seqid),counts = counts[order],sums = sums[order],sums2 = sums2[order],
+                 histograms = histograms[order],globalhistogram = globalhistogram)
+        f.close()
+
+    def read_coverage_checkpoint(self,filename):
+        """ add coverage written by 'write_coverage_checkpoint' for the same SCGs """
+        order = [self.__index[sid] for sid in self.__seqid]
+        if self.is_summary():
+            state = np.load(filename)
+            if list(state["names"]) != self.__seqid:
+                raise ValueError("SCGs in '%s' do not match"%filename)
+            self.__engine.merge(order,state["counts"],state["sums"],state["sums2"],state["histograms"],state["globalhistogram"])
+            state.close()
+            return
+        covfile = BinaryCoverageFile(filename)
+        if list(covfile.get_names()) != self.__seqid:
+            raise ValueError("SCGs in '%s' do not match"%filename)
+        # depth back to difference arrays, including the end position
+        events = [np.diff(np.concatenate(([0],np.asarray(c,dtype=np.int64),[0]))) for name,c in covfile]
+        self.__engine.merge(order,np.concatenate(events + [np.zeros(0,dtype=np.int64)]),covfile.get_counts())
+
     def write_coverage_file(self,filename):
 	f = open(filename,"w")
 	for sid in self.__seqid:
-	    print >> f,"#",sid,self.__seq[sid].get_count_reads()
-	    c = self.__seq[sid].get_coverage()
-	    s = self.__seq[sid].get_sequence()
-	    for i in range(len(self.__seq[sid])):
-		print >>f,i,c[i],s[i]
-	    print >> f
+	    write_text_coverage(f,sid,self.__seq[sid].get_count_reads(),self.__seq[sid].get_coverage(),self.__seq[sid].get_sequence())
 	f.close()
+
+    def write_bedgraph_coverage_file(self,filename,indexfile = None):
+        """ runs of equal depth in bgzipped bedGraph format with an index
+        of regions in 'filename.tbi', see 'scroogebedgraph' """
+        from scroogebedgraph import write_bedgraph
+        order = [self.__index[sid] for sid in self.__seqid]
+        write_bedgraph(filename,self.__seqid,
+                       self.__engine.get_lengths()[order],
+                       self.__engine.get_counts()[order],
+                       (self.__engine.get_runs(i) for i in order),indexfile)
 	
 
 
+
+
+
+# ***************************************************************** #
+# **         text coverage file                                  ** #
+# **  '# name reads', then 'position depth base' for every base  ** #
+# **  and an empty line                                          ** #
+# ***************************************************************** #
+def write_text_coverage(f,name,reads,depth,sequence):
+    print >> f,"#",name,reads
+    f.writelines(["%d %d %s\n"%(i,d,b) for i,(d,b) in enumerate(zip(depth,sequence))])
+    print >> f
+
+
+
+# ***************************************************************** #
+# **         binary coverage file                                ** #
+# **                                                             ** #
+# **  magic (8 bytes), number of SCGs n and size of name block   ** #
+# **  (int64), then n lengths, n read counts, n offsets (int64), ** #
+# **  newline separated names padded to 8 bytes, and finally the ** #
+# **  depth of all SCGs as one contiguous uint32 array           ** #
+# ***************************************************************** #
+COVERAGE_MAGIC = "SCRGCOV1"
+
+def write_binary_coverage(filename,names,lengths,counts,depth):
+    lengths = np.asarray(lengths,dtype='<i8')
+    offsets = np.zeros(len(lengths),dtype='<i8')
+    offsets[1:] = np.cumsum(lengths)[:-1]
+    nameblock = "\n".join(names)
+    nameblock += "\0"*(-len(nameblock) % 8)
+    f = open(filename,"wb")
+    f.write(COVERAGE_MAGIC)
+    np.array([len(names),len(nameblock)],dtype='<i8').tofile(f)
+    lengths.tofile(f)
+    np.asarray(counts,dtype='<i8').tofile(f)
+    offsets.tofile(f)
+    f.write(nameblock)
+    np.asarray(depth,dtype='<u4').tofile(f)
+    f.close()
+
+
+def is_binary_coverage_file(filename):
+    f = open(filename,"rb")
+    magic = f.read(len(COVERAGE_MAGIC))
+    f.close()
+    return magic == COVERAGE_MAGIC
+
+
+class BinaryCoverageFile():
+    """ read-only access to a binary coverage file, the depth arrays are
+    memory-mapped and only loaded on access """
+    def __init__(self,filename):
+        f = open(filename,"rb")
+        if f.read(len(COVERAGE_MAGIC)) != COVERAGE_MAGIC:
+            f.close()
+            raise ValueError
+        n,nb = np.fromfile(f,dtype='<i8',count=2)
+        self.__lengths = np.fromfile(f,dtype='<i8',count=n)
+        self.__counts = np.fromfile(f,dtype='<i8',count=n)
+        self.__offsets = np.fromfile(f,dtype='<i8',count=n)
+        if n > 0:
+            self.__names = f.read(nb).rstrip("\0").split("\n")
+        else:
+            self.__names = []
+        dataoffset = f.tell()
+        f.close()
+        total = int(np.sum(self.__lengths))
+        if total > 0:
+            self.__depth = np.memmap(filename,dtype='<u4',mode='r',offset=dataoffset,shape=(total,))
+        else:
+            self.__depth = np.zeros(0,dtype='<u4')
+        self.__index = dict([(name,i) for i,name in enumerate(self.__names)])
+
+    def __len__(self):
+        return len(self.__names)
+
+    def __iter__(self):
+        for i in range(len(self.__names)):
+            yield self.__names[i],self.get_coverage(i)
+
+    def get_names(self):
+        return self.__names
+    def get_lengths(self):
+        return self.__lengths
+    def get_counts(self):
+        return self.__counts
+    def get_offsets(self):
+        return self.__offsets
+    def get_depth(self):
+        return self.__depth
+
+    def get_coverage(self,i):
+        if self.__index.has_key(i):
+            i = self.__index[i]
+        return self.__depth[self.__offsets[i]:self.__offsets[i]+self.__lengths[i]]
+
+
+
+# ***************************************************************** #
+# **         coverage summary file                               ** #
+# **                                                             ** #
+# **  JSON with read count, sum and sum of squares of depth,     ** #
+# **  mean, standard deviation and median of every SCG, and the  ** #
+# **  histogram of depth over all bases of all SCGs              ** #
+# ***************************************************************** #
+COVERAGE_SUMMARY_FORMAT = "scrooge-coverage-summary"
+
+def write_coverage_summary(filename,names,summary,order = None):
+    """ write CoverageSummary 'summary', 'order' maps names to its indices """
+    if order is None:
+        order = range(len(names))
+    lengths = summary.get_lengths()
+    counts = summary.get_counts()
+    sums = summary.get_sums()
+    sums2 = summary.get_sums2()
+    medians = summary.get_medians()
+    scgs = []
+    for name,i in zip(names,order):
+        n = max(int(lengths[i]),1)
+        mean = float(sums[i])/n
+        scgs.append({"name":name,"length":int(lengths[i]),"reads":int(counts[i]),
+                     "sum":int(sums[i]),"sum2":int(sums2[i]),"mean":mean,
+                     "stddev":sqrt(max(0.,float(sums2[i])/n - mean**2)),"median":float(medians[i])})
+    histogram = summary.get_global_histogram()
+    nonzero = np.nonzero(histogram)[0]
+    histogram = histogram[:nonzero[-1]+1] if len(nonzero) > 0 else histogram[:0]
+    f = open(filename,"w")
+    # format is written first, see 'is_coverage_summary_file'
+    f.write('{"format": "%s",'%COVERAGE_SUMMARY_FORMAT)
+    f.write(json.dumps({"bins":summary.get_bins(),"scgs":scgs,"histogram":[int(h) for h in histogram]},indent = 1)[1:])
+    f.close()
+
+
+def is_coverage_summary_file(filename):
+    f = open(filename,"rb")
+    head = f.read(64)
+    f.close()
+    return head.lstrip().startswith("{") and COVERAGE_SUMMARY_FORMAT in head
+
+
+def read_coverage_summary(filename):
+    """ dict as written by 'write_coverage_summary' """
+    f = open(filename)
+    summary = json.load(f)
+    f.close()
+    if summary.get("format") != COVERAGE_SUMMARY_FORMAT:
+        raise ValueError("%s is not a coverage summary file"%filename)
+    return summary
+
+
+
+# ***************************************************************** #
+# **         parse BLAST hits                                    ** #
+# **         only query id and query coordinates are needed      ** #
+# ***************************************************************** #
+BLAST_STD_FIELDS = ["qseqid","sseqid","pident","length","mismatch","gapopen","qstart","qend","sstart","send","evalue","bitscore"]
+
+def blast_format(outfmt):
+    """ 'xml' or 'tabular' from the value of option 'outfmt' """
+    v = str(outfmt).split()
+    if len(v) > 0 and v[0] in ["6","7","10"]:
+        return "tabular"
+    return "xml"
+
+
+def blast_fields(outfmt):
+    """ columns and separator of tabular output from the 'outfmt' specification """
+    v = str(outfmt).split()
+    fields = v[1:] if len(v) > 1 else BLAST_STD_FIELDS
+    if "std" in fields:
+        i = fields.index("std")
+        fields = fields[:i] + BLAST_STD_FIELDS + fields[i+1:]
+    return fields,"," if v[0] == "10" else "\t"
+
+
+def iter_blast_tabular(fp,outfmt = "6"):
+    """ yield (query id,query start,query end) for every line of
+    tabular output, columns are taken from the 'outfmt' specification """
+    fields,sep = blast_fields(outfmt)
+    iq,istart,iend = fields.index("qseqid"),fields.index("qstart"),fields.index("qend")
+    for line in fp:
+        if line[0] == "#" or line.strip() == "":
+            continue
+        c = line.rstrip("\n").split(sep)
+        yield c[iq],int(c[istart]),int(c[iend])
+
+
+def iter_blast_xml(fp):
+    """ same as 'iter_blast_tabular' for XML output (outfmt 5) """
+    from Bio.Blast import NCBIXML
+    for record in NCBIXML.parse(fp):
+        qid = record.query.split()[0]
+        for alignment in record.alignments:
+            for hsp in alignment.hsps:
+                yield qid,hsp.query_start,hsp.query_end
+
+
+def iter_blast_hits(filename,outfmt):
+    fp = open(filename)
+    if blast_format(outfmt) == "tabular":
+        hits = iter_blast_tabular(fp,outfmt)
+    else:
+        hits = iter_blast_xml(fp)
+    for hit in hits:
+        yield hit
+    fp.close()
+
+
+
+# ***************************************************************** #
+# **         sharded BLAST search: the query is split into       ** #
+# **         shards of similar total length, tabular outputs are ** #
+# **         merged back in order of the queries                 ** #
+# ***************************************************************** #
+def fasta_lengths(fastafile):
+    """ names (first word of header) and lengths of all sequences, in order """
+    names = []
+    lengths = []
+    fp = open(fastafile)
+    for record,length in iter_reads(fp):
+        names.append(record[1:].split(None,1)[0] if len(record) > 1 else "")
+        lengths.append(length)
+    fp.close()
+    return names,lengths
+
+
+def split_fasta(fastafile,shards,prefix):
+    """ write the sequences of every shard (sorted lists of their indices)
+    to 'prefix.<shard>', return the file names """
+    filenames = ["%s.%d"%(prefix,i) for i in range(len(shards))]
+    shardof = {}
+    for i,shard in enumerate(shards):
+        for index in shard:
+            shardof[index] = i
+    outfiles = [open(f,"w") for f in filenames]
+    fp = open(fastafile)
+    for index,(record,length) in enumerate(iter_reads(fp)):
+        outfiles[shardof[index]].write(record)
+    fp.close()
+    for f in outfiles:
+        f.close()
+    return filenames
+
+
+def merge_blast_tabular(filenames,names,outfile,outfmt = "6"):
+    """ write tabular output of the shards to 'outfile', grouped by query
+    in order of 'names', the same as the output of one search; False if
+    the query ids do not match the names """
+    fields,sep = blast_fields(outfmt)
+    iq = fields.index("qseqid")
+    blocks = {}
+    for filename in filenames:
+        last = None
+        for line in open(filename):
+            if line.strip() == "":
+                continue
+            qid = line.rstrip("\n").split(sep)[iq]
+            if qid != last:
+                if blocks.has_key(qid):
+                    # hits of a query are consecutive in the output of one shard
+                    return False
+                blocks[qid] = []
+                last = qid
+            blocks[qid].append(line)
+    if len(set(blocks.keys()) - set(names)) > 0:
+        return False
+    f = open(outfile,"w")
+    for name in names:
+        f.write("".join(blocks.get(name,[])))
+    f.close()
+    return True
+
+
+
+# ***************************************************************** #
+# **         random access to FASTA files via '.fai' index       ** #
+# **         (same format as 'samtools faidx')                   ** #
+# ***************************************************************** #
+def build_fasta_index(fastafile,indexfile):
+    """ one line per sequence: name, length, offset of first base,
+    bases per line, bytes per line """
+    fp = open(fastafile,"rb")
+    entries = []
+    name = None
+    offset = 0
+    for lineno,line in enumerate(fp):
+        if line.startswith(">"):
+            if name != None:
+                entries.append((name,length,seqoffset,linebases or 0,linewidth or 0))
+            if len(line[1:].split()) == 0:
+                fp.close()
+                raise ValueError("malformed FASTA file '%s': header without name in line %d"%(fastafile,lineno + 1))
+            name = line[1:].split()[0]
+            length,seqoffset,linebases,linewidth = 0,offset + len(line),None,None
+            short = False
+        elif name != None:
+            n = len(line.rstrip("\r\n"))
+            if n > 0:
+                if short or (linebases != None and n > linebases):
+                    fp.close()
+                    raise ValueError("different line lengths in sequence '%s'"%name)
+                if linebases == None:
+                    linebases,linewidth = n,len(line)
+                elif n < linebases:
+                    short = True
+                length += n
+        offset += len(line)
+    if name != None:
+        entries.append((name,length,seqoffset,linebases or 0,linewidth or 0))
+    fp.close()
+    f = open(indexfile,"w")
+    for entry in entries:
+        f.write("%s\t%d\t%d\t%d\t%d\n"%entry)
+    f.close()
+
+
+class FastaIndex():
+    """ fetch regions of sequences without loading the whole file, the
+    index is built once and reused as long as it is newer than the file """
+    def __init__(self,fastafile,indexfile = None):
+        if indexfile == None:
+            indexfile = fastafile + ".fai"
+        if not os.path.isfile(indexfile) or os.path.getmtime(indexfile) < os.path.getmtime(fastafile):
+            build_fasta_index(fastafile,indexfile)
+        self.__index = {}
+        for line in open(indexfile):
+            v = line.split("\t")
+            self.__index[v[0]] = tuple([int(x) for x in v[1:5]])
+        self.__fp = open(fastafile,"rb")
+
+    def __contains__(self,name):
+        return self.__index.has_key(name)
+
+    def __len__(self):
+        return len(self.__index)
+
+    def get_length(self,name):
+        return self.__index[name][0]
+
+    def fetch(self,name,start = 0,end = None):
+        """ sequence[start:end] (0-based, end exclusive) """
+        length,offset,linebases,linewidth = self.__index[name]
+        if end == None or end > length:
+            end = length
+        if start < 0:
+            start = 0
+        if start >= end:
+            return ""
+        first = offset + (start//linebases)*linewidth + start%linebases
+        last = offset + ((end-1)//linebases)*linewidth + (end-1)%linebases
+        self.__fp.seek(first)
+        return self.__fp.read(last - first + 1).replace("\n","").replace("\r","")
+
+    def close(self):
+        self.__fp.close()
+
+
+
+# ***************************************************************** #
+# **         reading sequencing reads (FASTA or FASTQ)           ** #
+# ***************************************************************** #
+def open_reads(filename):
+    """ plain or gzip/bgzip compressed file, detected by magic number """
+    fp = open(filename,"rb")
+    magic = fp.read(2)
+    fp.close()
+    if magic == "\x1f\x8b":
+        return gzip.open(filename,"rb")
+    return open(filename,"rb")
+
+
+def expand_read_files(spec):
+    """ list of read files from comma separated file names and glob patterns """
+    filenames = []
+    for item in spec.split(","):
+        item = item.strip()
+        if item == "":
+            continue
+        if glob.has_magic(item):
+            matches = sorted(glob.glob(item))
+            if len(matches) == 0:
+                raise IOError("no read files match '%s'"%item)
+            filenames += matches
+        else:
+            filenames.append(item)
+    return filenames
+
+
+def read_format(filename):
+    """ 'fasta' or 'fastq', from the first character of the file """
+    fp = open_reads(filename)
+    first = fp.read(1)
+    fp.close()
+    if first == "@":
+        return "fastq"
+    return "fasta"
+
+
+def iter_reads(fp):
+    """ yield (record,length) for all reads in an open file, 'record'
+    is the unparsed text of the read """
+    line = fp.readline()
+    if line.startswith("@"):
+        while line:
+            seq = fp.readline()
+            record = line + seq + fp.readline() + fp.readline()
+            yield record,len(seq.strip())
+            line = fp.readline()
+    else:
+        while line:
+            record = [line]
+            length = 0
+            line = fp.readline()
+            while line and not line.startswith(">"):
+                record.append(line)
+                length += len(line.strip())
+                line = fp.readline()
+            yield "".join(record),length
+
+
+def iter_read_files(filenames):
+    """ yield (record,length) for all reads of several files """
+    for filename in filenames:
+        fp = open_reads(filename)
+        for record in iter_reads(fp):
+            yield record
+        fp.close()
+
+
+class ReadCounter():
+    """ counts reads and bases in consecutive blocks of FASTA or FASTQ
+    text without splitting it into records """
+    def __init__(self,fileformat):
+        self.__fastq = (fileformat == "fastq")
+        self.__partial = ""
+        self.__line = 0
+        self.reads = 0
+        self.bases = 0
+
+    def __count(self,lines):
+        if self.__fastq:
+            # lines 0 and 1 of every four are header and sequence
+            self.reads += len(lines[(-self.__line)%4::4])
+            self.bases += sum(map(len,lines[(1-self.__line)%4::4]))
+            self.__line = (self.__line + len(lines))%4
+        else:
+            headers = [line for line in lines if line.startswith(">")]
+            self.reads += len(headers)
+            self.bases += sum(map(len,lines)) - sum(map(len,headers))
+
+    def add(self,block):
+        lines = (self.__partial + block).split("\n")
+        self.__partial = lines.pop()
+        self.__count(lines)
+
+    def close(self):
+        if self.__partial != "":
+            self.__count([self.__partial])
+            self.__partial = ""
+        return self.reads,self.bases
+
+
+def iter_read_blocks(filenames,threads = 1,blocksize = 1<<20,queuesize = 8):
+    """ yield (index of file,block) with the decompressed text of all files
+    in order; up to 'threads' files are read and decompressed at the same
+    time in background threads, each file ends with a newline """
+    queues = [Queue.Queue(queuesize) for f in filenames]
+    nextfile = [0]
+    lock = threading.Lock()
+
+    def worker():
+        # files are taken in order, the file read by the consumer always has a worker
+        while True:
+            lock.acquire()
+            i = nextfile[0]
+            nextfile[0] += 1
+            lock.release()
+            if i >= len(filenames):
+                return
+            try:
+                fp = open_reads(filenames[i])
+                last = "\n"
+                block = fp.read(blocksize)
+                while block:
+                    queues[i].put(block)
+                    last = block[-1]
+                    block = fp.read(blocksize)
+                fp.close()
+                if last != "\n":
+                    queues[i].put("\n")
+                queues[i].put(None)
+            except Exception as e:
+                queues[i].put(e)
+
+    for t in range(max(1,min(threads,len(filenames)))):
+        w = threading.Thread(target = worker)
+        w.daemon = True
+        w.start()
+    for i in range(len(filenames)):
+        while True:
+            block = queues[i].get()
+            if block is None:
+                break
+            if isinstance(block,Exception):
+                raise block
+            yield i,block
+
+
+def feed_reads(out,filenames,threads = 1,stats = None):
+    """ write reads of all files to 'out' (e.g. stdin of the aligner) and
+    close it; number of reads and bases, and an error message if reading
+    failed, are stored in dict 'stats' """
+    if stats is None:
+        stats = {}
+    stats.update(reads = 0,bases = 0,error = None)
+    counters = []
+    try:
+        counters = [ReadCounter(read_format(f)) for f in filenames]
+        for i,block in iter_read_blocks(filenames,threads):
+            counters[i].add(block)
+            out.write(block)
+    except Exception as e:
+        stats["error"] = str(e)
+    try:
+        out.close()
+    except IOError:
+        pass
+    for counter in counters:
+        reads,bases = counter.close()
+        stats["reads"] += reads
+        stats["bases"] += bases
+    return stats
+
+
+def record_sequence(record):
+    """ sequence of a FASTA or FASTQ record """
+    lines = record.split("\n")
+    if record.startswith("@"):
+        return lines[1].strip()
+    return "".join([line.strip() for line in lines[1:]])
+
+
+def split_records(text,fileformat):
+    """ split text into complete reads, return lists of records and
+    sequences and the remaining text of an incomplete read at the end;
+    at the end of a file the text ends with a newline and is complete """
+    if fileformat == "fastq":
+        lines = text.split("\n")
+        n = 4*((len(lines) - 1)//4)
+        records = ["\n".join(lines[j:j+4]) + "\n" for j in range(0,n,4)]
+        return records,lines[1:n:4],"\n".join(lines[n:])
+    parts = text.split("\n>")
+    last = parts.pop()
+    if len(parts) == 0:
+        return [],[],last
+    records = [parts[0] + "\n"] + [">" + p + "\n" for p in parts[1:]]
+    sequences = [r.split("\n",1)[1].replace("\n","") for r in records]
+    return records,sequences,">" + last
+
+
+def iter_read_batches(filenames,threads = 1):
+    """ yield (records,sequences) for batches of complete reads of all
+    files, from blocks decompressed in background threads """
+    formats = [read_format(f) for f in filenames]
+    current = 0
+    rest = ""
+    for i,block in iter_read_blocks(filenames,threads):
+        if i != current:
+            if rest.strip() != "" and formats[current] == "fasta":
+                # last read of previous file
+                yield [rest],[rest.split("\n",1)[1].replace("\n","")]
+            current = i
+            rest = ""
+        records,sequences,rest = split_records(rest + block,formats[i])
+        if len(records) > 0:
+            yield records,sequences
+    if rest.strip() != "" and formats[current] == "fasta":
+        yield [rest],[rest.split("\n",1)[1].replace("\n","")]
+
+
+
+# ***************************************************************** #
+# **         restrict reads to reference and apply length cutoff ** #
+# ***************************************************************** #
+def clip_reads(starts,ends,lengths,readminlength = None):
+    """ return clipped (start,end) and mask of reads that are counted;
+    reads outside of the reference are counted with start == end """
+    mi = np.minimum(np.maximum(np.minimum(starts,ends),0),lengths)
+    ma = np.maximum(np.minimum(np.maximum(starts,ends),lengths),mi)
+    if readminlength:
+        keep = ma - mi > readminlength
+    else:
+        keep = np.ones(len(mi),dtype=bool)
+    return mi,ma,keep
+
+
+
+# ***************************************************************** #
+# **         rarefaction: reads are put into nested subsamples   ** #
+# **         by a hash of their name, the same in every run and  ** #
+# **         for both mates of a pair                            ** #
+# ***************************************************************** #
+def parse_fractions(text):
+    """ sorted ladder of subsampling fractions from 'f1,f2,...' """
+    fractions = sorted(set([float(f) for f in text.split(",") if f.strip() != ""]))
+    if len(fractions) == 0 or fractions[0] <= 0 or fractions[-1] > 1:
+        raise ValueError("subsampling fractions must be in (0,1]")
+    return fractions
+
+
+def name_hashes(names):
+    """ values in [0,1) from read names, uniformly distributed """
+    h = np.array([zlib.crc32(name) & 0xffffffff for name in names],dtype=np.uint64)
+    # multiplicative hashing spreads similar names, the high bits are used
+    return ((h*np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(11)).astype(np.float64)/float(1 << 53)
+
+
+def subsample_buckets(names,fractions):
+    """ index of the smallest fraction whose subsample contains each read,
+    len(fractions) for reads in none of them """
+    return np.searchsorted(fractions,name_hashes(names),side = "right")
+
+
+
+# ***************************************************************** #
+# **         add alignments to coverage in chunks                ** #
+# ***************************************************************** #
+def tee_alignments(alignments,outfile):
+    """ pass alignments through while writing a copy to an open pysam file """
+    for alignment in alignments:
+        outfile.write(alignment)
+        yield alignment
+
+
+def count_coverage(scg,alignments,chunksize = 65536):
+    """ collect (tid,start,end) of mapped alignments in arrays and
+    hand them to the SCG list one chunk at a time, return number of reads;
+    read names are collected only for subsamples. Every mapped alignment
+    is counted, the read length cutoff is not applied """
+    tids = np.empty(chunksize,dtype=np.int64)
+    starts = np.empty(chunksize,dtype=np.int64)
+    ends = np.empty(chunksize,dtype=np.int64)
+    subsample = scg.get_fractions() != None
+    names = []
+    n = 0
+    total = 0
+    for alignment in alignments:
+        if alignment.tid >= 0: # (id == -1) -> read not mapped
+            tids[n] = alignment.tid
+            starts[n] = alignment.reference_start
+            ends[n] = alignment.reference_end
+            if subsample:
+                names.append(alignment.query_name)
+            n += 1
+            if n == chunksize:
+                scg.add_coverage_tids(tids,starts,ends,names if subsample else None,cutoff = False)
+                total += n
+                n = 0
+                names = []
+    scg.add_coverage_tids(tids[:n],starts[:n],ends[:n],names if subsample else None,cutoff = False)
+    record_count("alignments",total + n)
+    return total + n
+
+
+
+# ***************************************************************** #
+# **         count coverage in parallel, sharded by SCG          ** #
+# ***************************************************************** #
+def shard_references(lengths,nshards):
+    """ distribute reference indices on shards with similar total length """
+    shards = [[] for i in range(nshards)]
+    load = [0 for i in range(nshards)]
+    for index in sorted(range(len(lengths)),key = lambda i:-lengths[i]):
+        j = load.index(min(load))
+        shards[j].append(index)
+        load[j] += lengths[index]
+    return [sorted(shard) for shard in shards if len(shard) > 0]
+
+
+def open_alignments(filename,mode = "rb",threads = 1):
+    """ open alignment file with BGZF threads, if pysam supports them """
+    import pysam
+    if threads > 1:
+        try:
+            return pysam.AlignmentFile(filename,mode,threads = threads)
+        except TypeError:
+            pass
+    return pysam.AlignmentFile(filename,mode)
+
+
+def _count_shard(job):
+    """ depth events and read counts of the SCGs of one shard, or the
+    state of a CoverageSummary of them if 'bins' is given, and sums of
+    depth per subsample bucket if there is a ladder of 'fractions' """
+    filename,names,lengths,threads,bins,fractions = job
+    bam = open_alignments(filename,"rb",threads)
+    events = []
+    counts = []
+    summary = None
+    if bins != None:
+        summary = CoverageSummary(bins)
+        for length in lengths:
+            summary.add_reference(length)
+    bucketsums = None
+    if fractions != None:
+        bucketsums = np.zeros((len(fractions),len(names)),dtype=np.int64)
+    for j,(name,length) in enumerate(zip(names,lengths)):
+        starts = []
+        ends = []
+        readnames = []
+        for alignment in bam.fetch(name):
+            starts.append(alignment.reference_start)
+            ends.append(alignment.reference_end)
+            if bucketsums is not None:
+                readnames.append(alignment.query_name)
+        mi,ma,keep = clip_reads(np.array(starts,dtype=np.int64),np.array(ends,dtype=np.int64),length)
+        if bucketsums is not None:
+            buckets = subsample_buckets(readnames,fractions)[keep]
+            bucketsums[:,j] = np.bincount(buckets,weights = (ma - mi)[keep],minlength = len(fractions) + 1)[:len(fractions)]
+        if summary is not None:
+            summary.add_sorted(j,mi[keep],ma[keep])
+            continue
+        e = np.bincount(mi[keep],minlength = length+1) - np.bincount(ma[keep],minlength = length+1)
+        events.append(e.astype(np.int64))
+        counts.append(int(np.sum(keep)))
+    bam.close()
+    if summary is not None:
+        return summary.get_state(),bucketsums
+    if len(events) > 0:
+        return (np.concatenate(events),counts),bucketsums
+    return (np.zeros(0,dtype=np.int64),counts),bucketsums
+
+
+def count_coverage_parallel(scg,filename,processes,threads = 1):
+    """ count coverage from a sorted and indexed BAM file, each worker
+    process fetches the alignments of one shard of SCGs; shards are
+    counted in this process if 'processes' is 1 """
+    from multiprocessing import Pool
+    engine = scg.get_engine()
+    ids = scg.get_ids()
+    lengths = [len(scg[sid]) for sid in ids]
+    bins = None
+    if scg.is_summary():
+        bins = engine.get_bins()
+    shards = shard_references(lengths,4*max(processes,1))
+    jobs = [(filename,[ids[i] for i in shard],[lengths[i] for i in shard],threads,bins,scg.get_fractions()) for shard in shards]
+    pool = None
+    if processes > 1:
+        pool = Pool(processes)
+        results = pool.imap(_count_shard,jobs)
+    else:
+        results = (_count_shard(job) for job in jobs)
+    try:
+        for shard,(result,bucketsums) in zip(shards,results):
+            engine.merge(shard,*result)
+            if bucketsums is not None:
+                scg.merge_subsample_sums(shard,bucketsums)
+            record_count("reads",int(np.sum(result[0])) if bins != None else sum(result[1]))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return sum([int(c) for c in engine.get_counts()])
@@ -0,0 +1,105 @@
+# ************************************************************************* #
+# **         SCROOGE                                                     ** #
+# **         estimate genome size from single copy gene coverage         ** #
+# **                                                                     ** #
+# **         Genome size = (number reads) * (read length) / coverage     ** #
+# **         coverage is a robust statistic over per-SCG mean depths,    ** #
+# **         confidence intervals come from a bootstrap over SCGs        ** #
+# **                                                                     ** #
+# ************************************************************************* #
+
+
+import numpy as np
+
+
+
+# ***************************************************************** #
+# **         statistics over SCGs, rows of 'x' are samples       ** #
+# ***************************************************************** #
+def trimmed_mean(x,trim = 0.1,axis = -1):
+    """ mean after removing the fraction 'trim' of values at both ends """
+    x = np.sort(x,axis = axis)
+    n = x.shape[axis]
+    k = int(trim*n)
+    if 2*k >= n:
+        k = (n-1)//2
+    return np.mean(np.take(x,np.arange(k,n-k),axis = axis),axis = axis)
+
+
+STATISTICS = {
+    "mean":    lambda x,trim: np.mean(x,axis = -1),
+    "median":  lambda x,trim: np.median(x,axis = -1),
+    "trimmed": lambda x,trim: trimmed_mean(x,trim,axis = -1),
+    }
+
+# size of one array of resamples (resamples x SCGs, 8 bytes each) in the bootstrap
+BOOTSTRAP_CHUNKBYTES = 1<<25
+# resamples are drawn with a fixed seed, repeated runs report the same interval
+BOOTSTRAP_SEED = 1
+
+
+
+# ***************************************************************** #
+# **         genome size from in-memory SCG coverage             ** #
+# ***************************************************************** #
+class GenomeSizeEstimator():
+    def __init__(self,scg,bases,statistic = "median",trim = 0.1,fraction = None):
+        """ 'scg' is a SingleCopyGeneList with coverage, 'bases' the
+        total number of sequenced bases (reads * read length); with
+        'fraction' only the coverage of that subsample of reads is used
+        and 'bases' are those of the subsample """
+        if not STATISTICS.has_key(statistic):
+            raise ValueError
+        self.__coverage = scg.get_coverage_means(fraction)
+        self.__bases = float(bases)
+        self.__statistic = statistic
+        self.__trim = trim
+
+    def __len__(self):
+        return len(self.__coverage)
+
+    def get_scg_coverage(self):
+        return self.__coverage
+
+    def get_coverage(self):
+        if len(self.__coverage) == 0:
+            return 0.
+        return float(STATISTICS[self.__statistic](self.__coverage,self.__trim))
+
+    def get_genome_size(self):
+        c = self.get_coverage()
+        if c > 0:
+            return self.__bases/c
+        return None
+
+    def bootstrap(self,samples = 2000,seed = BOOTSTRAP_SEED,chunkbytes = BOOTSTRAP_CHUNKBYTES):
+        """ genome size for 'samples' resamples of SCGs with replacement,
+        all resamples of one chunk are evaluated in a single array operation;
+        a chunk holds as many resamples as fit into 'chunkbytes' """
+        n = len(self.__coverage)
+        if n == 0:
+            return np.zeros(0)
+        rng = np.random.RandomState(seed)
+        rows = max(1,min(samples,chunkbytes//(8*n)))
+        c = []
+        for i in range(0,samples,rows):
+            idx = rng.randint(0,n,size = (min(rows,samples-i),n))
+            c.append(STATISTICS[self.__statistic](self.__coverage[idx],self.__trim))
+        c = np.concatenate(c)
+        with np.errstate(divide = "ignore"):
+            return np.where(c > 0,self.__bases/c,np.inf)
+
+    def get_confidence_interval(self,level = 0.95,samples = 2000,seed = BOOTSTRAP_SEED):
+        g = self.bootstrap(samples,seed)
+        if len(g) == 0:
+            return None,None
+        a = 100.*(1.-level)/2.
+        return float(np.percentile(g,a)),float(np.percentile(g,100.-a))
+
+    def get_summary(self,level = 0.95,samples = 2000,seed = BOOTSTRAP_SEED):
+        lower,upper = None,None
+        if self.get_genome_size() != None:
+            lower,upper = self.get_confidence_interval(level,samples,seed)
+        return {"scgs":len(self),"bases":self.__bases,"statistic":self.__statistic,
+                "coverage":self.get_coverage(),"genomesize":self.get_genome_size(),
+                "lower":lower,"upper":upper,"level":level}
@@ -0,0 +1,277 @@
+# ************************************************************************* #
+# **         SCROOGE                                                     ** #
+# **         estimate genome size from single copy gene coverage         ** #
+# **                                                                     ** #
+# **         k-mers of single copy genes: canonical k-mers are 2-bit     ** #
+# **         encoded in 64 bit integers (k <= 31) and kept in a sorted   ** #
+# **         array, reads are hashed in batches with NumPy               ** #
+# **                                                                     ** #
+# ************************************************************************* #
+
+
+import collections
+import numpy as np
+
+from scroogeclasses import iter_read_batches
+
+
+
+# ***************************************************************** #
+# **         vectorized k-mer hashing                            ** #
+# ***************************************************************** #
+_CODES = np.full(256,4,dtype=np.uint8)
+for _i,_c in enumerate("ACGT"):
+    _CODES[ord(_c)] = _i
+    _CODES[ord(_c.lower())] = _i
+
+
+def encode_sequence(seq):
+    """ bases as codes 0-3, other characters as 4 """
+    return _CODES[np.frombuffer(seq,dtype=np.uint8)]
+
+
+def kmer_hashes(codes,k):
+    """ canonical k-mers starting at every position of 'codes', mask of
+    k-mers without ambiguous bases and mask of k-mers whose forward
+    orientation is canonical """
+    n = len(codes) - k + 1
+    if n <= 0:
+        return np.zeros(0,dtype=np.uint64),np.zeros(0,dtype=bool),np.zeros(0,dtype=bool)
+    # words of length m = 1,2,4,... are built by doubling and appended
+    # to the k-mer for every binary digit of k, in forward and reverse
+    # complement orientation
+    fw = (codes & 3).astype(np.uint64)
+    rv = np.uint64(3) - fw
+    forward,reverse,length = None,None,0
+    m = 1
+    while m <= k:
+        if k & m:
+            if forward is None:
+                forward,reverse = fw,rv
+            else:
+                l = len(forward) - m
+                forward = (forward[:l] << np.uint64(2*m)) | fw[length:length+l]
+                reverse = reverse[:l] | (rv[length:length+l] << np.uint64(2*length))
+            length += m
+        if 2*m <= k:
+            fw = (fw[:-m] << np.uint64(2*m)) | fw[m:]
+            rv = rv[:-m] | (rv[m:] << np.uint64(2*m))
+        m *= 2
+    forward = forward[:n]
+    reverse = reverse[:n]
+    bad = np.concatenate([[0],np.cumsum(codes > 3)])
+    valid = (bad[k:] - bad[:-k]) == 0
+    return np.minimum(forward,reverse),valid,forward <= reverse
+
+
+def sequence_kmers(sequences,k):
+    """ canonical k-mers of all sequences (joined with an ambiguous base
+    in between), with index of sequence, position and orientation """
+    lengths = np.array([len(s) for s in sequences],dtype=np.int64)
+    starts = np.zeros(len(sequences),dtype=np.int64)
+    starts[1:] = np.cumsum(lengths + 1)[:-1]
+    h,valid,forward = kmer_hashes(encode_sequence("N".join(sequences)),k)
+    positions = np.nonzero(valid)[0]
+    index = np.searchsorted(starts,positions,side = "right") - 1
+    return h[positions],index,positions - starts[index],forward[positions]
+
+
+
+# ***************************************************************** #
+# **         set of k-mers of the SCGs                           ** #
+# ***************************************************************** #
+class KmerSet():
+    """ exact set of k-mers, lookups go through a bitmap of hashed k-mers
+    first, only hits in the bitmap are searched in the sorted array; the
+    bitmap holds about 'bitsperkmer' bits per k-mer packed into 64 bit
+    words, at most 2^30 bits (128 MiB) """
+    def __init__(self,kmers,k = 21,bitsperkmer = 8):
+        if k < 1 or k > 31:
+            raise ValueError("k-mer size must be between 1 and 31")
+        self.__k = k
+        self.__kmers = np.unique(np.asarray(kmers,dtype=np.uint64))
+        self.__bits = 16
+        while (1 << self.__bits) < bitsperkmer*len(self.__kmers) and self.__bits < 30:
+            self.__bits += 1
+        self.__bitmap = np.zeros(1 << (self.__bits - 6),dtype=np.uint64)
+        slots = self.__slots(self.__kmers)
+        np.bitwise_or.at(self.__bitmap,slots >> np.uint64(6),np.uint64(1) << (slots & np.uint64(63)))
+
+    def __slots(self,hashes):
+        # multiplicative hashing, uses the high bits of the product
+        return (hashes*np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(64 - self.__bits)
+
+    def __in_bitmap(self,hashes):
+        slots = self.__slots(hashes)
+        return ((self.__bitmap[slots >> np.uint64(6)] >> (slots & np.uint64(63))) & np.uint64(1)).astype(bool)
+
+    def __len__(self):
+        return len(self.__kmers)
+
+    def get_k(self):
+        return self.__k
+
+    def find(self,hashes):
+        """ index of every hash in the sorted k-mers, -1 if not in the set """
+        found = np.zeros(len(hashes),dtype=np.int64) - 1
+        if len(self.__kmers) == 0:
+            return found
+        candidates = np.nonzero(self.__in_bitmap(hashes))[0]
+        i = np.searchsorted(self.__kmers,hashes[candidates])
+        i[i == len(self.__kmers)] = 0
+        hit = self.__kmers[i] == hashes[candidates]
+        found[candidates[hit]] = i[hit]
+        return found
+
+    def contains(self,hashes):
+        """ mask of hashes that are in the set """
+        return self.find(hashes) >= 0
+
+    def count_hits(self,sequences):
+        """ number of k-mers of every sequence found in the set """
+        if len(sequences) == 0:
+            return np.zeros(0,dtype=np.int64)
+        h,index,positions,forward = sequence_kmers(sequences,self.__k)
+        return np.bincount(index[self.contains(h)],minlength = len(sequences))
+
+
+
+# ***************************************************************** #
+# **         prefilter: pass only reads sharing k-mers with SCGs ** #
+# ***************************************************************** #
+class ReadFilter():
+    def __init__(self,scg,k = 21,minhits = 2):
+        h,index,positions,forward = sequence_kmers([scg[sid].get_sequence() for sid in scg.get_ids()],k)
+        self.__kmers = KmerSet(h,k)
+        self.__minhits = minhits
+
+    def get_kmers(self):
+        return self.__kmers
+
+    def select(self,sequences):
+        """ mask of reads with at least 'minhits' k-mers of an SCG """
+        return self.__kmers.count_hits(sequences) >= self.__minhits
+
+
+def filter_reads(out,filenames,readfilter,threads = 1,stats = None):
+    """ write reads passing the filter to 'out' and close it; all reads
+    and bases, the reads kept and an error message if reading failed are
+    stored in dict 'stats' """
+    if stats is None:
+        stats = {}
+    stats.update(reads = 0,bases = 0,kept = 0,error = None)
+    try:
+        for records,sequences in iter_read_batches(filenames,threads):
+            keep = readfilter.select(sequences)
+            stats["reads"] += len(records)
+            stats["bases"] += sum(map(len,sequences))
+            stats["kept"] += int(np.sum(keep))
+            out.write("".join([r for r,k in zip(records,keep) if k]))
+    except Exception as e:
+        stats["error"] = str(e)
+    try:
+        out.close()
+    except IOError:
+        pass
+    return stats
+
+
+
+# ***************************************************************** #
+# **         alignment-free coverage: reads are placed on SCGs   ** #
+# **         by k-mers that occur only once in all SCGs          ** #
+# ***************************************************************** #
+class KmerIndex():
+    def __init__(self,scg,k = 21,minhits = 2):
+        h,index,positions,forward = sequence_kmers([scg[sid].get_sequence() for sid in scg.get_ids()],k)
+        order = np.argsort(h,kind = "mergesort")
+        h = h[order]
+        # k-mers found more than once are ambiguous and dropped
+        unique = np.ones(len(h),dtype=bool)
+        if len(h) > 1:
+            repeated = h[1:] == h[:-1]
+            unique[1:] &= ~repeated
+            unique[:-1] &= ~repeated
+        self.__kmers = KmerSet(h[unique],k)
+        self.__tids = index[order][unique]
+        self.__positions = positions[order][unique]
+        self.__forward = forward[order][unique]
+        self.__k = k
+        self.__minhits = minhits
+
+    def __len__(self):
+        return len(self.__kmers)
+
+    def get_k(self):
+        return self.__k
+
+    def place_reads(self,sequences):
+        """ (tids,starts,ends) of reads with at least 'minhits' k-mers on
+        an SCG; every read is placed by its first k-mer found, like an
+        ungapped alignment of the whole read """
+        if len(sequences) == 0:
+            empty = np.zeros(0,dtype=np.int64)
+            return empty,empty,empty
+        lengths = np.array([len(s) for s in sequences],dtype=np.int64)
+        h,index,offsets,forward = sequence_kmers(sequences,self.__k)
+        i = self.__kmers.find(h)
+        hit = i >= 0
+        i,index,offsets,forward = i[hit],index[hit],offsets[hit],forward[hit]
+        # start of read on SCG, reads from the other strand are reversed
+        same = forward == self.__forward[i]
+        starts = np.where(same,self.__positions[i] - offsets,self.__positions[i] - (lengths[index] - offsets - self.__k))
+        hits = np.bincount(index,minlength = len(sequences))
+        reads,first = np.unique(index,return_index = True)
+        keep = hits[reads] >= self.__minhits
+        first = first[keep]
+        return self.__tids[i[first]],starts[first],starts[first] + lengths[index[first]]
+
+
+_kmerindex = None
+
+def _init_kmer_worker(kmerindex):
+    global _kmerindex
+    _kmerindex = kmerindex
+
+
+def _place_batch(sequences):
+    tids,starts,ends = _kmerindex.place_reads(sequences)
+    return tids,starts,ends,len(sequences),sum(map(len,sequences))
+
+
+def count_kmer_coverage(scg,filenames,k = 21,minhits = 2,processes = 1,threads = 1):
+    """ add reads placed by k-mers to the coverage of 'scg', batches of
+    reads are hashed in 'processes' worker processes; return number of
+    reads and bases """
+    from multiprocessing import Pool
+    kmerindex = KmerIndex(scg,k,minhits)
+    scg.set_references(scg.get_ids())
+    batches = (sequences for records,sequences in iter_read_batches(filenames,threads))
+    total = [0,0]
+
+    def add(result):
+        tids,starts,ends,n,b = result
+        scg.add_coverage_tids(tids,starts,ends,cutoff = False)
+        total[0] += n
+        total[1] += b
+
+    if processes <= 1:
+        _init_kmer_worker(kmerindex)
+        for sequences in batches:
+            add(_place_batch(sequences))
+        return total[0],total[1]
+    # at most two batches per process are in flight, reads are not
+    # loaded into memory faster than they are hashed
+    pool = Pool(processes,_init_kmer_worker,(kmerindex,))
+    pending = collections.deque()
+    try:
+        for sequences in batches:
+            pending.append(pool.apply_async(_place_batch,(sequences,)))
+            if len(pending) >= 2*processes:
+                add(pending.popleft().get())
+        while len(pending) > 0:
+            add(pending.popleft().get())
+    finally:
+        pool.close()
+        pool.join()
+    return total[0],total[1]
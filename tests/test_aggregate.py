@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# ***************************************************************** #
+# **         aggregate mode: store of many coverage samples      ** #
+# ***************************************************************** #
+
+
+import os,sys
+import shutil,tempfile,time
+import unittest
+import numpy as np
+
+TESTDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.join(TESTDIR,".."))
+from scroogeclasses import write_text_coverage
+from analyze_coverage import CoverageStore,STATISTICS,aggregate,coverageclass,get_statistics
+
+
+class CoverageStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.storefile = os.path.join(self.tmpdir,"store.npz")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def fill(self,store):
+        store.add("s1",[100,1.5],["SCG1","SCG2"],[[10,2.,5.],[20,1.,1.5]],[0,3,27],[1.,0.5,1.5,0.7])
+        store.add("s2",[200,2.5],["SCG2","SCG3","SCG4"],[[20,4.,17.],[5,0.,0.],[8,1.,1.]],[5,0,10,20],[2.,1.,1.7,1.6])
+        store.add("empty",[0,3.5],[],np.zeros((0,3)),[],[0.,0.,0.,0.])
+
+    def test_round_trip(self):
+        store = CoverageStore()
+        self.fill(store)
+        store.save(self.storefile)
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir,".part.store.npz")))
+        loaded = CoverageStore(self.storefile)
+        self.assertEqual(len(loaded),3)
+        self.assertEqual(list(loaded.get_samples()),["s1","s2","empty"])
+        for sample in store.get_samples():
+            self.assertEqual(list(loaded.get_contignames(sample)),store.get_contignames(sample))
+            self.assertTrue(np.array_equal(loaded.get_coverage(sample),store.get_coverage(sample)))
+            self.assertTrue(np.array_equal(loaded.get_histo(sample),store.get_histo(sample)))
+            self.assertEqual(loaded.get_statistics(sample),store.get_statistics(sample))
+        self.assertEqual(sorted(loaded.get_statistics("s1").keys()),sorted(STATISTICS))
+        self.assertEqual(loaded.get_coverage("empty").shape,(0,3))
+
+    def test_stamps(self):
+        store = CoverageStore()
+        self.fill(store)
+        store.save(self.storefile)
+        loaded = CoverageStore(self.storefile)
+        self.assertTrue(loaded.is_current("s1",[100,1.5]))
+        self.assertFalse(loaded.is_current("s1",[100,2.5]))
+        self.assertFalse(loaded.is_current("s3",[100,1.5]))
+        # a sample added again replaces the stored one
+        loaded.add("s1",[101,4.5],["SCG1"],[[10,3.,9.]],[0,0,0,10],[3.,0.,3.,0.])
+        self.assertEqual(len(loaded),3)
+        self.assertTrue(loaded.is_current("s1",[101,4.5]))
+        self.assertEqual(loaded.get_contignames("s1"),["SCG1"])
+
+    def test_contig(self):
+        store = CoverageStore()
+        self.fill(store)
+        rows = store.get_contig("SCG2")
+        self.assertEqual([sample for sample,row in rows],["s1","s2"])
+        self.assertEqual(list(rows[1][1]),[20.,4.,17.])
+        self.assertEqual(store.get_contig("SCG5"),[])
+
+    def test_empty_store(self):
+        CoverageStore().save(self.storefile)
+        self.assertEqual(len(CoverageStore(self.storefile)),0)
+        self.assertEqual(len(CoverageStore(os.path.join(self.tmpdir,"missing.npz"))),0)
+
+
+class AggregateTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.storefile = os.path.join(self.tmpdir,"store.npz")
+        rng = np.random.RandomState(5)
+        self.files = [self.write_sample("sample%d.txt"%i,rng) for i in range(3)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_sample(self,name,rng):
+        filename = os.path.join(self.tmpdir,name)
+        f = open(filename,"w")
+        for j,length in enumerate([40,75]):
+            depth = rng.poisson(rng.uniform(2,10),length)
+            write_text_coverage(f,"SCG%d"%j,int(depth.sum()),depth,"A"*length)
+        f.close()
+        return filename
+
+    def test_statistics(self):
+        store,samples,loaded = aggregate(self.files,self.storefile)
+        self.assertEqual(loaded,3)
+        self.assertEqual(samples,[os.path.abspath(f) for f in self.files])
+        for f in self.files:
+            cov = coverageclass(f)
+            expected = get_statistics(cov)
+            stats = store.get_statistics(os.path.abspath(f))
+            for s in STATISTICS:
+                self.assertAlmostEqual(stats[s],expected[s])
+            self.assertTrue(np.allclose(store.get_coverage(os.path.abspath(f)),cov.get_coverage()))
+
+    def test_unchanged_samples(self):
+        aggregate(self.files,self.storefile)
+        # the store itself may be matched by the pattern of coverage files
+        store,samples,loaded = aggregate(self.files + [self.storefile],self.storefile)
+        self.assertEqual((len(samples),loaded),(3,0))
+        self.write_sample("sample1.txt",np.random.RandomState(6))
+        later = time.time() + 10
+        os.utime(self.files[1],(later,later))
+        store,samples,loaded = aggregate(self.files,self.storefile)
+        self.assertEqual(loaded,1)
+        self.assertTrue(np.allclose(store.get_coverage(samples[1]),coverageclass(self.files[1]).get_coverage()))
+
+    def test_processes(self):
+        serial,samples,loaded = aggregate(self.files,self.storefile)
+        parallel,samples,loaded = aggregate(self.files,os.path.join(self.tmpdir,"parallel.npz"),processes = 2)
+        self.assertEqual(loaded,3)
+        for sample in samples:
+            self.assertEqual(parallel.get_statistics(sample),serial.get_statistics(sample))
+            self.assertTrue(np.array_equal(parallel.get_histo(sample),serial.get_histo(sample)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# ***************************************************************** #
+# **         BGZF, region index and bedGraph coverage files      ** #
+# ***************************************************************** #
+
+
+import os,sys
+import gzip,shutil,tempfile
+import unittest
+
+import numpy as np
+
+TESTDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.join(TESTDIR,".."))
+from scroogeclasses import run_length_encode,run_length_decode,write_text_coverage,write_binary_coverage
+from scroogebedgraph import (BgzfWriter,BgzfReader,write_bgzf,is_bgzf_file,RegionIndex,write_bedgraph,
+                             BedGraphCoverageFile,iter_text_coverage,text_to_bedgraph,binary_to_bedgraph,
+                             bedgraph_to_text)
+
+
+def random_depth(rng,length):
+    """ depth with long runs, as from reads """
+    depth = np.zeros(length,dtype=np.int64)
+    for i in range(length//20):
+        start = rng.randint(0,length)
+        depth[start:start + rng.randint(1,100)] += 1
+    return depth
+
+
+class TempdirTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def path(self,name):
+        return os.path.join(self.tmpdir,name)
+
+
+class RunLengthTest(unittest.TestCase):
+    def test_round_trip(self):
+        rng = np.random.RandomState(1)
+        for length in [0,1,7,1000]:
+            depth = random_depth(rng,length)
+            starts,ends,depths = run_length_encode(depth)
+            self.assertTrue(np.all(depths[1:] != depths[:-1]))
+            self.assertTrue(np.array_equal(run_length_decode(starts,ends,depths,length),depth))
+
+    def test_gaps(self):
+        self.assertEqual(list(run_length_decode([2,5],[4,6],[3,1],8)),[0,0,3,3,0,1,0,0])
+
+
+class BgzfTest(TempdirTest):
+    def test_gzip_compatible(self):
+        data = "".join(["line %d\n"%i for i in range(30000)])
+        write_bgzf(self.path("a.gz"),data)
+        self.assertTrue(is_bgzf_file(self.path("a.gz")))
+        self.assertEqual(gzip.open(self.path("a.gz")).read(),data)
+        self.assertEqual(BgzfReader(self.path("a.gz")).read(),data)
+
+    def test_virtual_offsets(self):
+        # every line can be read from the offset returned before writing it
+        out = BgzfWriter(self.path("b.gz"))
+        lines = ["%d %s\n"%(i,"x"*(i % 300)) for i in range(3000)]
+        offsets = []
+        for line in lines[:1000]:
+            offsets.append(out.tell())
+            out.write_line(line)
+        vstarts,vends = out.write_lines(lines[1000:])
+        offsets.extend(list(vstarts))
+        out.close()
+        self.assertEqual(gzip.open(self.path("b.gz")).read(),"".join(lines))
+        reader = BgzfReader(self.path("b.gz"))
+        self.assertEqual([l + "\n" for v,l in reader.iter_lines()],lines)
+        for i in [0,999,1000,1500,2999]:
+            self.assertEqual(reader.iter_lines(offsets[i]).next()[1] + "\n",lines[i])
+        # offsets yielded by the reader lead back to their lines, too
+        for v,l in list(reader.iter_lines())[::97]:
+            self.assertEqual(reader.iter_lines(v).next()[1],l)
+        reader.close()
+
+
+class RegionIndexTest(TempdirTest):
+    def test_find_against_scan(self):
+        # runs of two references far beyond the 16 kB windows of the linear index
+        rng = np.random.RandomState(2)
+        runs = {}
+        out = BgzfWriter(self.path("c.gz"))
+        index = RegionIndex(["a","b"])
+        for name in ["a","b"]:
+            bounds = np.unique(rng.randint(0,200000,400))
+            starts,ends = bounds[:-1:2],bounds[1::2]
+            lines = ["%s\t%d\t%d\n"%(name,s,e) for s,e in zip(starts,ends)]
+            vstarts,vends = out.write_lines(lines)
+            index.add(name,starts,ends,vstarts,vends)
+            runs[name] = zip(starts.tolist(),ends.tolist())
+        out.close()
+        index.write(self.path("c.gz.tbi"))
+        restored = RegionIndex()
+        restored.read(self.path("c.gz.tbi"))
+        reader = BgzfReader(self.path("c.gz"))
+        for name in ["a","b"]:
+            for start in rng.randint(0,200000,50).tolist() + [0]:
+                end = start + int(rng.randint(1,40000))
+                expected = [r for r in runs[name] if r[0] < end and r[1] > start]
+                for regions in [index,restored]:
+                    voffset = regions.find(name,start,end)
+                    if len(expected) == 0:
+                        if voffset is not None:
+                            found = [l.split("\t") for v,l in reader.iter_lines(voffset)]
+                            self.assertFalse(any([f[0] == name and int(f[1]) < end and int(f[2]) > start for f in found]))
+                        continue
+                    # the first overlapping run is at or after the offset
+                    found = [tuple(map(int,l.split("\t")[1:3])) for v,l in reader.iter_lines(voffset) if l.startswith(name + "\t")]
+                    self.assertTrue(expected[0] in found)
+        reader.close()
+
+
+class BedGraphTest(TempdirTest):
+    def write_text(self,rng):
+        self.depths = [random_depth(rng,l) for l in [500,1,300]]
+        self.depths.append(np.zeros(50,dtype=np.int64))
+        self.names = ["SCG%d"%i for i in range(len(self.depths))]
+        self.counts = [17,0,4,0]
+        f = open(self.path("cov.txt"),"w")
+        for name,c,d in zip(self.names,self.counts,self.depths):
+            write_text_coverage(f,name,c,d,"A"*len(d))
+        f.close()
+
+    def test_text_round_trip(self):
+        self.write_text(np.random.RandomState(3))
+        text_to_bedgraph(self.path("cov.txt"),self.path("cov.bg.gz"))
+        bedgraph_to_text(self.path("cov.bg.gz"),self.path("back.txt"))
+        for (name,reads,depth,seq),n,c,d in zip(iter_text_coverage(self.path("back.txt")),self.names,self.counts,self.depths):
+            self.assertEqual((name,reads),(n,c))
+            self.assertTrue(np.array_equal(depth,d))
+            self.assertEqual(seq,"N"*len(d))
+
+    def test_queries(self):
+        self.write_text(np.random.RandomState(4))
+        text_to_bedgraph(self.path("cov.txt"),self.path("cov.bg.gz"))
+        covfile = BedGraphCoverageFile(self.path("cov.bg.gz"))
+        self.assertTrue(covfile.has_index())
+        self.assertEqual(covfile.get_names(),self.names)
+        self.assertEqual(list(covfile.get_counts()),self.counts)
+        for name,d in zip(self.names,self.depths):
+            self.assertTrue(np.array_equal(covfile.get_coverage(name),d))
+            starts,ends,depths = covfile.get_runs(name,100,200)
+            expected = [(s,e,x) for s,e,x in zip(*run_length_encode(d)) if x != 0 and s < 200 and e > 100]
+            self.assertEqual(zip(starts,ends,depths),expected)
+        for name,starts,ends,depths in covfile:
+            self.assertTrue(np.array_equal(run_length_decode(starts,ends,depths,len(covfile.get_coverage(name))),covfile.get_coverage(name)))
+        covfile.close()
+
+    def test_without_index(self):
+        self.write_text(np.random.RandomState(5))
+        text_to_bedgraph(self.path("cov.txt"),self.path("cov.bg.gz"))
+        os.remove(self.path("cov.bg.gz.tbi"))
+        covfile = BedGraphCoverageFile(self.path("cov.bg.gz"))
+        self.assertFalse(covfile.has_index())
+        for name,d in zip(self.names,self.depths):
+            self.assertTrue(np.array_equal(covfile.get_coverage(name),d))
+        covfile.close()
+
+    def test_binary(self):
+        rng = np.random.RandomState(6)
+        depths = [random_depth(rng,l) for l in [400,0,250]]
+        write_binary_coverage(self.path("cov.bin"),["a","b","c"],[400,0,250],[3,0,8],np.concatenate(depths))
+        binary_to_bedgraph(self.path("cov.bin"),self.path("cov.bg.gz"))
+        covfile = BedGraphCoverageFile(self.path("cov.bg.gz"))
+        self.assertEqual(list(covfile.get_lengths()),[400,0,250])
+        self.assertEqual(list(covfile.get_counts()),[3,0,8])
+        for name,d in zip(["a","b","c"],depths):
+            self.assertTrue(np.array_equal(covfile.get_coverage(name),d))
+        covfile.close()
+
+    def test_iter_blocks(self):
+        # runs of SCGs span many BGZF blocks, some SCGs have no runs
+        rng = np.random.RandomState(7)
+        names = ["SCG%d"%i for i in range(8)]
+        coverage = [random_depth(rng,l) for l in [30000,0,500,20000,40,10000,1,30000]]
+        coverage[4][:] = 0
+        write_bedgraph(self.path("cov.bg.gz"),names,[len(d) for d in coverage],[1]*len(names),[run_length_encode(d) for d in coverage])
+        covfile = BedGraphCoverageFile(self.path("cov.bg.gz"))
+        reader = BgzfReader(self.path("cov.bg.gz"))
+        self.assertTrue(len(list(reader.iter_blocks())) > 2)
+        self.assertEqual("".join(reader.iter_blocks()),reader.read())
+        reader.close()
+        scgs = list(covfile)
+        self.assertEqual([scg[0] for scg in scgs],names)
+        for (name,starts,ends,depths),d in zip(scgs,coverage):
+            self.assertEqual(starts.dtype,np.int64)
+            self.assertTrue(np.array_equal(run_length_decode(starts,ends,depths,len(d)),d))
+            self.assertEqual(zip(starts,ends,depths),zip(*covfile.get_runs(name)))
+        covfile.close()
+        # lines split between blocks, as written by other tools
+        reader = BgzfReader(self.path("cov.bg.gz"))
+        write_bgzf(self.path("split.bg.gz"),reader.read())
+        reader.close()
+        covfile = BedGraphCoverageFile(self.path("split.bg.gz"))
+        for (name,starts,ends,depths),d in zip(covfile,coverage):
+            self.assertTrue(np.array_equal(run_length_decode(starts,ends,depths,len(d)),d))
+        covfile.close()
+
+    def test_empty(self):
+        write_bedgraph(self.path("empty.bg.gz"),["a"],[10],[0],[run_length_encode(np.zeros(10,dtype=np.int64))])
+        covfile = BedGraphCoverageFile(self.path("empty.bg.gz"))
+        self.assertEqual(list(covfile.get_coverage("a")),[0]*10)
+        self.assertEqual([len(r) for r in covfile.get_runs("a")],[0,0,0])
+        self.assertEqual([(name,len(starts)) for name,starts,ends,depths in covfile],[("a",0)])
+        covfile.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
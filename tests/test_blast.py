@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# ***************************************************************** #
+# **         merging tabular BLAST output of query shards        ** #
+# ***************************************************************** #
+
+
+import os,sys
+import shutil,tempfile
+import unittest
+
+TESTDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.join(TESTDIR,".."))
+from scroogeclasses import merge_blast_tabular,iter_blast_tabular
+
+
+def hit(qid,start,end,sep = "\t"):
+    # standard columns: qseqid sseqid pident length mismatch gapopen qstart qend sstart send evalue bitscore
+    return sep.join([qid,"BUSCO1","98.5","100","1","0",str(start),str(end),"1","100","1e-50","200"]) + "\n"
+
+
+class MergeBlastTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.outfile = os.path.join(self.tmpdir,"hits.tsv")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def shards(self,texts):
+        filenames = []
+        for i,text in enumerate(texts):
+            filenames.append(os.path.join(self.tmpdir,"shard.%d"%i))
+            f = open(filenames[-1],"w")
+            f.write(text)
+            f.close()
+        return filenames
+
+    def read(self):
+        f = open(self.outfile)
+        text = f.read()
+        f.close()
+        return text
+
+    def test_order_of_query(self):
+        names = ["contig1","contig2","contig3","contig4"]
+        # shards hold contigs 3 and 1, and 4; contig2 has no hits
+        files = self.shards([hit("contig3",5,50) + hit("contig3",70,20) + "\n" + hit("contig1",1,90),
+                             hit("contig4",3,30),
+                             ""])
+        self.assertTrue(merge_blast_tabular(files,names,self.outfile))
+        self.assertEqual(self.read(),hit("contig1",1,90) + hit("contig3",5,50) + hit("contig3",70,20) + hit("contig4",3,30))
+        f = open(self.outfile)
+        self.assertEqual(list(iter_blast_tabular(f)),[("contig1",1,90),("contig3",5,50),("contig3",70,20),("contig4",3,30)])
+        f.close()
+
+    def test_columns(self):
+        # comma separated, query id in another column
+        outfmt = "10 sseqid qseqid qstart qend"
+        files = self.shards(["BUSCO1,contig2,1,10\n","BUSCO2,contig1,5,9\nBUSCO3,contig1,12,40\n"])
+        self.assertTrue(merge_blast_tabular(files,["contig1","contig2"],self.outfile,outfmt))
+        self.assertEqual(self.read(),"BUSCO2,contig1,5,9\nBUSCO3,contig1,12,40\nBUSCO1,contig2,1,10\n")
+
+    def test_split_query(self):
+        # hits of one query in two shards or apart in one shard
+        files = self.shards([hit("contig1",1,10),hit("contig1",20,30)])
+        self.assertFalse(merge_blast_tabular(files,["contig1"],self.outfile))
+        files = self.shards([hit("contig1",1,10) + hit("contig2",1,10) + hit("contig1",20,30)])
+        self.assertFalse(merge_blast_tabular(files,["contig1","contig2"],self.outfile))
+        self.assertFalse(os.path.exists(self.outfile))
+
+    def test_unknown_query(self):
+        # query ids shortened by BLAST do not match the names of the query file
+        files = self.shards([hit("contig",1,10)])
+        self.assertFalse(merge_blast_tabular(files,["contig1 len=100"],self.outfile))
+        self.assertFalse(os.path.exists(self.outfile))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# ***************************************************************** #
+# **         cache of step outputs shared between runs           ** #
+# ***************************************************************** #
+
+
+import os,sys
+import shutil,tempfile,threading,time,fcntl
+import unittest
+
+TESTDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.join(TESTDIR,".."))
+from scroogeclasses import ArtifactCache
+
+
+class ArtifactCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cachedir = os.path.join(self.tmpdir,"cache")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self,filename,text):
+        f = open(filename,"w")
+        f.write(text)
+        f.close()
+
+    def read(self,filename):
+        f = open(filename)
+        text = f.read()
+        f.close()
+        return text
+
+    def output(self,name,size = 10):
+        # index of two files, as written by bowtie2-build
+        prefix = os.path.join(self.tmpdir,name)
+        self.write(prefix + ".1.bt2","1"*size)
+        self.write(prefix + ".2.bt2","2"*size)
+        return prefix
+
+    def entries(self):
+        return sorted([f for f in os.listdir(self.cachedir) if not f.startswith(".")])
+
+    def test_store_fetch(self):
+        cache = ArtifactCache(self.cachedir,verbose = False)
+        cache.store("a",self.output("index"))
+        self.assertEqual(self.entries(),["a"])
+        target = os.path.join(self.tmpdir,"other")
+        self.assertFalse(cache.fetch("b",target))
+        self.assertTrue(cache.fetch("a",target))
+        self.assertEqual(self.read(target + ".1.bt2"),"1"*10)
+        self.assertEqual(self.read(target + ".2.bt2"),"2"*10)
+        # hard links to the cached files
+        self.assertEqual(os.stat(target + ".1.bt2").st_ino,os.stat(os.path.join(self.cachedir,"a","artifact.1.bt2")).st_ino)
+        # no temporary entries are left behind
+        self.assertEqual([f for f in os.listdir(self.cachedir) if f.startswith(".tmp.")],[])
+
+    def test_copy_without_hardlinks(self):
+        cache = ArtifactCache(self.cachedir,verbose = False)
+        cache.store("a",self.output("index"))
+        target = os.path.join(self.tmpdir,"other")
+        self.write(target + ".1.bt2","stale")
+
+        def no_link(source,target):
+            raise OSError(18,"Invalid cross-device link")
+        link = os.link
+        os.link = no_link
+        try:
+            self.assertTrue(cache.fetch("a",target))
+        finally:
+            os.link = link
+        self.assertEqual(self.read(target + ".1.bt2"),"1"*10)
+        self.assertNotEqual(os.stat(target + ".1.bt2").st_ino,os.stat(os.path.join(self.cachedir,"a","artifact.1.bt2")).st_ino)
+
+    def test_lru_eviction(self):
+        # every entry has 20 bytes, room for two
+        cache = ArtifactCache(self.cachedir,maxsize = 45,verbose = False)
+        cache.store("a",self.output("a"))
+        cache.store("b",self.output("b"))
+        now = time.time()
+        os.utime(os.path.join(self.cachedir,"a"),(now - 100,now - 100))
+        os.utime(os.path.join(self.cachedir,"b"),(now - 50,now - 50))
+        # fetching 'a' makes 'b' the least recently used entry
+        self.assertTrue(cache.fetch("a",os.path.join(self.tmpdir,"fetched")))
+        cache.store("c",self.output("c"))
+        self.assertEqual(self.entries(),["a","c"])
+        # the new entry is kept, even if it alone exceeds the size
+        cache.store("d",self.output("d",size = 100))
+        self.assertEqual(self.entries(),["d"])
+
+    def test_unlimited(self):
+        cache = ArtifactCache(self.cachedir,verbose = False)
+        for key in ["a","b","c"]:
+            cache.store(key,self.output(key,size = 1000))
+        self.assertEqual(self.entries(),["a","b","c"])
+
+    def test_locking(self):
+        cache = ArtifactCache(self.cachedir,verbose = False)
+        cache.store("a",self.output("index"))
+        # another run holds the lock while it stores or evicts
+        lock = open(os.path.join(self.cachedir,".lock"),"a")
+        fcntl.flock(lock,fcntl.LOCK_EX)
+        fetched = []
+        reader = threading.Thread(target = lambda:fetched.append(cache.fetch("a",os.path.join(self.tmpdir,"other"))))
+        reader.start()
+        time.sleep(0.2)
+        self.assertEqual(fetched,[])
+        fcntl.flock(lock,fcntl.LOCK_UN)
+        lock.close()
+        reader.join()
+        self.assertEqual(fetched,[True])
+
+    def test_concurrent_store(self):
+        cache = ArtifactCache(self.cachedir,verbose = False)
+        prefix = self.output("index")
+        writers = [threading.Thread(target = cache.store,args = ("a",prefix)) for i in range(4)]
+        for t in writers:
+            t.start()
+        for t in writers:
+            t.join()
+        self.assertEqual(sorted(os.listdir(self.cachedir)),[".lock","a"])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.cachedir,"a"))),["artifact.1.bt2","artifact.2.bt2"])
+
+
+if __name__ == "__main__":
+    unittest.main()
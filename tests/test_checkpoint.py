@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# ***************************************************************** #
+# **         resume: steps re-run when their inputs change       ** #
+# ***************************************************************** #
+
+
+import os,sys
+import shutil,tempfile,time
+import unittest
+
+TESTDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.join(TESTDIR,".."))
+from scroogeclasses import ProgramConfig,externalprogram,file_exists,PipelineScheduler,RunManifest,StepCheckpoint
+from scrooge import search_key
+
+CONFIG = """<?xml version="1.0"?>
+<externalprograms>
+    <program step="scgminingsearch">
+        <executable>blastx</executable>
+        <option name="db">%s</option>
+        <option name="out">%s</option>
+        <filetype name="db">phr</filetype>
+        <filetype name="db">pin</filetype>
+        <filetype name="db">psq</filetype>
+    </program>
+</externalprograms>
+"""
+
+
+class SearchCheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = os.path.join(self.tmpdir,"BUSCO")
+        self.out = os.path.join(self.tmpdir,"hits.tsv")
+        f = open(os.path.join(self.tmpdir,"config.xml"),"w")
+        f.write(CONFIG%(self.db,self.out))
+        f.close()
+        self.search = externalprogram(ProgramConfig(os.path.join(self.tmpdir,"config.xml")),"scgminingsearch",False)
+        for ext in ["phr","pin","psq"]:
+            self.write(self.db + "." + ext,"db")
+        self.runs = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self,filename,text):
+        f = open(filename,"w")
+        f.write(text)
+        f.close()
+
+    def action(self):
+        self.runs += 1
+        self.write(self.out,"hits")
+
+    def run_search(self,resume):
+        manifest = RunManifest(os.path.join(self.tmpdir,"manifest.json"),resume)
+        scheduler = PipelineScheduler(verbose = False,manifest = manifest)
+        scheduler.add_step("scgminingsearch",self.action,checkpoint = StepCheckpoint(lambda:search_key(self.search),[self.out]))
+        self.assertTrue(scheduler.run())
+
+    def test_database_files(self):
+        files = self.search.get_files("db")
+        self.assertEqual(files,[self.db + ".phr",self.db + ".pin",self.db + ".psq"])
+        self.assertTrue(file_exists(files))
+        os.remove(self.db + ".pin")
+        self.assertFalse(file_exists(files))
+
+    def test_changed_database(self):
+        self.run_search(False)
+        self.run_search(True)
+        self.assertEqual(self.runs,1)
+        # rebuilt database
+        self.write(self.db + ".psq","other database")
+        self.run_search(True)
+        self.assertEqual(self.runs,2)
+        self.run_search(True)
+        self.assertEqual(self.runs,2)
+        # another volume of the database
+        self.write(self.db + ".00.phr","db")
+        self.run_search(True)
+        self.assertEqual(self.runs,3)
+
+    def test_missing_directory(self):
+        self.search.set_option("db",os.path.join(self.tmpdir,"none","BUSCO"))
+        self.assertEqual(search_key(self.search)[1],[])
+
+
+if __name__ == "__main__":
+    unittest.main()
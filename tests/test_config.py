@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# ***************************************************************** #
+# **         options file of the external programs               ** #
+# ***************************************************************** #
+
+
+import os,sys
+import shutil,tempfile
+import unittest
+from StringIO import StringIO
+
+TESTDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.join(TESTDIR,".."))
+from scroogeclasses import ProgramConfig,externalprogram
+
+CONFIG = """<?xml version="1.0"?>
+<externalprograms>
+    <program step="mapping">
+        <executable>bowtie2</executable>
+        <option name="x">index</option>
+        <flag name="local"/>
+        <threads option="p"/>
+        %s
+    </program>
+</externalprograms>
+"""
+
+
+class ProgramConfigTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.stderr = sys.stderr
+        sys.stderr = StringIO()
+
+    def tearDown(self):
+        sys.stderr = self.stderr
+        shutil.rmtree(self.tmpdir)
+
+    def load(self,extra):
+        filename = os.path.join(self.tmpdir,"config.xml")
+        f = open(filename,"w")
+        f.write(CONFIG%extra)
+        f.close()
+        return ProgramConfig(filename)
+
+    def test_unknown_element(self):
+        config = self.load("<comment>newer version</comment>")
+        self.assertIn("WARNING: skipping unknown element <comment> in step 'mapping'",sys.stderr.getvalue())
+        self.assertEqual([t.tag for t in config.get_program("mapping")],["executable","option","flag","threads"])
+        bowtie = externalprogram(config,"mapping",False)
+        self.assertEqual(bowtie.get_option("x"),"index")
+
+    def test_known_elements(self):
+        self.load("<parameter>extra</parameter>")
+        self.assertEqual(sys.stderr.getvalue(),"")
+
+    def test_invalid_element(self):
+        self.assertRaises(ValueError,self.load,"<option>without name</option>")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# ***************************************************************** #
+# **         coverage engines against a per-base reference       ** #
+# ***************************************************************** #
+
+
+import os,sys
+import unittest
+
+import numpy as np
+
+TESTDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.join(TESTDIR,".."))
+from scroogeclasses import (SingleCopyGeneList,CoverageEngine,CoverageSummary,count_coverage,
+                            parse_fractions,subsample_buckets)
+
+
+def random_reads(nscg,length,nreads,seed):
+    rng = np.random.RandomState(seed)
+    tids = rng.randint(0,nscg,nreads)
+    starts = rng.randint(-20,length,nreads)
+    ends = starts + rng.randint(0,150,nreads)
+    return tids,starts,ends
+
+
+def baseline_coverage(nscg,length,tids,starts,ends,readminlength = None):
+    """ per-base counting of SingleCopyGeneList.add_coverage before the
+    coverage engine, one read at a time """
+    coverage = [[0]*length for i in range(nscg)]
+    counts = [0]*nscg
+    for t,start,end in zip(tids,starts,ends):
+        mi = max(min(start,end),0)
+        ma = min(max(start,end),length)
+        if readminlength and not ma-mi > readminlength:
+            continue
+        for i in range(mi,ma):
+            coverage[t][i] += 1
+        counts[t] += 1
+    return coverage,counts
+
+
+class Alignment():
+    def __init__(self,tid,start,end,name):
+        self.tid = tid
+        self.reference_start = start
+        self.reference_end = end
+        self.query_name = name
+
+
+def scg_list(nscg,length,**kwargs):
+    scg = SingleCopyGeneList(**kwargs)
+    for i in range(nscg):
+        scg.add_sequence("SCG%d"%i,"A"*length)
+    scg.set_references(scg.get_ids())
+    return scg
+
+
+class BaselineTest(unittest.TestCase):
+    def check(self,scg,coverage,counts):
+        engine = scg.get_engine()
+        for i in range(len(counts)):
+            self.assertEqual(engine.get_count_reads(i),counts[i])
+            self.assertEqual(list(engine.get_coverage(i)),coverage[i])
+
+    def test_short_and_empty_reads(self):
+        # zero-length reads, reads outside of the SCG and reads with end before start
+        tids = [0,0,0,1,1,1,1,2,2]
+        starts = [10,50,-30,0,90,120,40,5,70]
+        ends = [10,52,-5,100,100,150,20,5,75]
+        for readminlength in [None,1,30]:
+            expected = baseline_coverage(3,100,tids,starts,ends,readminlength)
+            single = scg_list(3,100,readlength = readminlength)
+            for t,start,end in zip(tids,starts,ends):
+                single.add_coverage("SCG%d"%t,start,end)
+            self.check(single,*expected)
+            vectorized = scg_list(3,100,readlength = readminlength)
+            vectorized.add_coverage_tids(tids,starts,ends)
+            self.check(vectorized,*expected)
+
+    def test_random_reads(self):
+        tids,starts,ends = random_reads(5,500,2000,3)
+        for readminlength in [None,30]:
+            scg = scg_list(5,500,readlength = readminlength)
+            scg.add_coverage_tids(tids,starts,ends)
+            self.check(scg,*baseline_coverage(5,500,tids,starts,ends,readminlength))
+
+    def test_count_coverage(self):
+        # alignments are counted without the read length cutoff, as the
+        # streaming count always did
+        tids,starts,ends = random_reads(5,500,2000,4)
+        starts = np.maximum(starts,0)
+        ends = np.minimum(np.maximum(ends,starts),500)
+        alignments = [Alignment(t,s,e,"read%d"%i) for i,(t,s,e) in enumerate(zip(tids,starts,ends))]
+        alignments.append(Alignment(-1,0,0,"unmapped"))
+        expected = baseline_coverage(5,500,tids,starts,ends)
+        scg = scg_list(5,500,readlength = 30)
+        self.assertEqual(count_coverage(scg,alignments,chunksize = 300),2000)
+        self.check(scg,*expected)
+        summary = scg_list(5,500,readlength = 30,summarybins = 16)
+        order = np.lexsort((starts,tids))
+        count_coverage(summary,[alignments[i] for i in order])
+        self.assertEqual(list(summary.get_engine().get_counts()),expected[1])
+        self.assertTrue(np.allclose(summary.get_coverage_means(),[np.mean(c) for c in expected[0]]))
+
+
+class SummaryTest(unittest.TestCase):
+    def test_empty_batch(self):
+        scg = scg_list(3,200,summarybins = 16)
+        scg.add_coverage_tids([],[],[])
+        self.assertEqual(list(scg.get_engine().get_counts()),[0,0,0])
+        self.assertEqual(list(scg.get_coverage_means()),[0.,0.,0.])
+
+    def test_filtered_batch(self):
+        # all reads shorter than the cutoff or outside of the SCG
+        scg = scg_list(2,200,summarybins = 16,readlength = 50)
+        scg.add_coverage_tids([0,1,1],[10,300,-40],[20,400,-10])
+        self.assertEqual(list(scg.get_engine().get_counts()),[0,0])
+
+    def test_add_many_empty(self):
+        summary = CoverageSummary(16)
+        summary.add_reference(100)
+        summary.add_many([],[],[])
+        self.assertEqual(summary.get_moments(0),(100,0,0))
+
+    def test_against_engine(self):
+        # reads sorted by start, as from sorted alignments
+        tids,starts,ends = random_reads(5,500,3000,1)
+        order = np.lexsort((starts,tids))
+        tids,starts,ends = tids[order],starts[order],ends[order]
+        full = scg_list(5,500)
+        summary = scg_list(5,500,summarybins = 256)
+        full.add_coverage_tids(tids,starts,ends)
+        summary.add_coverage_tids(tids,starts,ends)
+        engine,moments = full.get_engine(),summary.get_engine()
+        self.assertTrue(np.allclose(full.get_coverage_means(),summary.get_coverage_means()))
+        for i in range(5):
+            c = engine.get_coverage(i)
+            self.assertEqual(engine.get_moments(i),moments.get_moments(i))
+            self.assertEqual(engine.get_count_reads(i),moments.get_count_reads(i))
+            self.assertEqual(np.median(c),moments.get_median(i))
+            self.assertEqual(list(np.bincount(np.minimum(c,255),minlength = 256)),list(moments.get_histograms()[i]))
+
+    def test_unsorted(self):
+        summary = CoverageSummary(16)
+        summary.add_reference(100)
+        self.assertRaises(ValueError,summary.add_sorted,0,[50,10],[60,20])
+
+    def test_batches(self):
+        # moments and medians do not depend on how sorted reads are split into batches
+        tids,starts,ends = random_reads(3,400,1500,5)
+        order = np.lexsort((starts,tids))
+        tids,starts,ends = tids[order],starts[order],ends[order]
+        whole = scg_list(3,400,summarybins = 64)
+        whole.add_coverage_tids(tids,starts,ends)
+        batched = scg_list(3,400,summarybins = 64)
+        for a in range(0,1500,37):
+            batched.add_coverage_tids(tids[a:a+37],starts[a:a+37],ends[a:a+37])
+        for i in range(3):
+            self.assertEqual(whole.get_engine().get_moments(i),batched.get_engine().get_moments(i))
+        self.assertEqual(list(whole.get_engine().get_medians()),list(batched.get_engine().get_medians()))
+
+    def test_median(self):
+        summary = CoverageSummary(8)
+        summary.add_reference(10)
+        summary.add_reference(5)
+        summary.add_sorted(0,[0,2,2],[6,4,9])
+        summary.add_sorted(1,[1],[3])
+        # depths 1 1 3 3 2 2 1 1 1 0 and 0 1 1 0 0
+        self.assertEqual(list(summary.get_medians()),[1.,0.])
+        self.assertEqual(summary.get_moments(0),(10,15,31))
+
+
+class RarefactionTest(unittest.TestCase):
+    def test_parse_fractions(self):
+        self.assertEqual(parse_fractions("0.5,0.1,,1,0.5"),[0.1,0.5,1.])
+        for text in ["","0,0.5","0.5,1.5"]:
+            self.assertRaises(ValueError,parse_fractions,text)
+
+    def test_buckets(self):
+        names = ["read%d/%d"%(i,i % 2) for i in range(20000)]
+        fractions = [0.1,0.25,0.5]
+        buckets = subsample_buckets(names,fractions)
+        self.assertTrue(np.array_equal(buckets,subsample_buckets(names,fractions)))
+        # nested: the subsample of a smaller ladder is the same
+        self.assertTrue(np.array_equal(np.minimum(buckets,2),np.minimum(subsample_buckets(names,[0.1,0.25]),2)))
+        for i,f in enumerate(fractions):
+            self.assertTrue(abs(np.mean(buckets <= i) - f) < 0.02)
+        self.assertTrue(np.all(subsample_buckets(names,[1.]) == 0))
+
+    def test_subsample_coverage(self):
+        tids,starts,ends = random_reads(4,300,3000,6)
+        names = ["read%d"%i for i in range(3000)]
+        fractions = [0.2,0.5,1.]
+        scg = scg_list(4,300,fractions = fractions)
+        for a in range(0,3000,1000):
+            scg.add_coverage_tids(tids[a:a+1000],starts[a:a+1000],ends[a:a+1000],names[a:a+1000])
+        self.assertTrue(np.allclose(scg.get_coverage_means(1.),scg.get_coverage_means()))
+        buckets = subsample_buckets(names,fractions)
+        for i,f in enumerate(fractions[:-1]):
+            sub = buckets <= i
+            expected = baseline_coverage(4,300,tids[sub],starts[sub],ends[sub])[0]
+            self.assertTrue(np.allclose(scg.get_coverage_means(f),[np.mean(c) for c in expected]))
+        self.assertRaises(ValueError,scg.get_coverage_means,0.3)
+
+
+class EngineTest(unittest.TestCase):
+    def test_merge(self):
+        # difference arrays of single references add up to the same depth
+        tids,starts,ends = random_reads(4,300,1000,2)
+        whole = scg_list(4,300)
+        whole.add_coverage_tids(tids,starts,ends)
+        merged = CoverageEngine()
+        for i in range(4):
+            merged.add_reference(300)
+        for i in [2,0,3,1]:
+            merged.merge([i],whole.get_engine().get_events(i),[whole.get_engine().get_count_reads(i)])
+        self.assertTrue(np.array_equal(merged.get_depth(),whole.get_engine().get_depth()))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# ***************************************************************** #
+# **         processors: cgroup quotas and the shared budget     ** #
+# ***************************************************************** #
+
+
+import os,sys
+import shutil,tempfile
+import unittest
+
+TESTDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.join(TESTDIR,".."))
+from scroogeclasses import parse_cpu_list,cgroup_cpu_limit,available_cpus,CpuBudget
+
+
+class CgroupTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmpdir,"cgroup")
+        os.mkdir(self.root)
+        self.cgroupfile = os.path.join(self.tmpdir,"self.cgroup")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self,path,text):
+        filename = os.path.join(self.root,path)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        f = open(filename,"w")
+        f.write(text)
+        f.close()
+
+    def membership(self,text):
+        f = open(self.cgroupfile,"w")
+        f.write(text)
+        f.close()
+
+    def limit(self):
+        return cgroup_cpu_limit(self.root,self.cgroupfile)
+
+    def test_v1_quota(self):
+        self.membership("5:memory:/docker/abc\n4:cpu,cpuacct:/docker/abc\n")
+        self.write("cpu,cpuacct/docker/abc/cpu.cfs_quota_us","150000\n")
+        self.write("cpu,cpuacct/docker/abc/cpu.cfs_period_us","100000\n")
+        self.write("cpu,cpuacct/cpu.cfs_quota_us","-1\n")
+        self.write("cpu,cpuacct/cpu.cfs_period_us","100000\n")
+        self.assertAlmostEqual(self.limit(),1.5)
+
+    def test_v1_unlimited(self):
+        self.membership("4:cpu,cpuacct:/docker/abc\n")
+        self.write("cpu,cpuacct/docker/abc/cpu.cfs_quota_us","-1\n")
+        self.write("cpu,cpuacct/docker/abc/cpu.cfs_period_us","100000\n")
+        self.assertEqual(self.limit(),None)
+
+    def test_v2_cpu_max(self):
+        self.membership("0::/user.slice/job\n")
+        self.write("user.slice/job/cpu.max","200000 100000\n")
+        self.assertAlmostEqual(self.limit(),2.)
+
+    def test_v2_max(self):
+        self.membership("0::/user.slice/job\n")
+        self.write("user.slice/job/cpu.max","max 100000\n")
+        self.write("user.slice/cpu.max","max 100000\n")
+        self.assertEqual(self.limit(),None)
+
+    def test_v2_parent_limit(self):
+        # the smallest quota on the path to the root applies
+        self.membership("0::/user.slice/job\n")
+        self.write("user.slice/job/cpu.max","max 100000\n")
+        self.write("user.slice/cpu.max","50000 100000\n")
+        self.assertAlmostEqual(self.limit(),0.5)
+
+    def test_no_cgroups(self):
+        self.assertEqual(self.limit(),None)
+        self.write("cpu.max","malformed\n")
+        self.assertEqual(self.limit(),None)
+
+    def test_cpu_list(self):
+        self.assertEqual(parse_cpu_list("0-3,8,10-11\n"),7)
+        self.assertEqual(parse_cpu_list("5"),1)
+
+    def test_available(self):
+        self.assertTrue(available_cpus() >= 1)
+
+
+class CpuBudgetTest(unittest.TestCase):
+    def test_acquire_release(self):
+        budget = CpuBudget(8)
+        self.assertEqual(budget.acquire(4),4)
+        self.assertEqual(budget.get_free(),4)
+        # equal share for steps starting together
+        self.assertEqual(budget.acquire(8,waiting = 2),2)
+        self.assertEqual(budget.acquire(8,waiting = 1),2)
+        self.assertEqual(budget.get_free(),0)
+        # every step gets at least one processor
+        self.assertEqual(budget.acquire(4),1)
+        self.assertEqual(budget.get_free(),0)
+        budget.release(1)
+        budget.release(2)
+        self.assertEqual(budget.get_free(),2)
+        budget.release(2)
+        budget.release(4)
+        self.assertEqual(budget.get_free(),budget.get_cpus())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# ***************************************************************** #
+# **         genome size estimate and bootstrap                  ** #
+# ***************************************************************** #
+
+
+import os,sys
+import unittest
+
+import numpy as np
+
+TESTDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.join(TESTDIR,".."))
+from scroogeestimator import trimmed_mean,GenomeSizeEstimator
+
+
+class Coverage():
+    """ SCG list with given mean depths """
+    def __init__(self,means):
+        self.means = np.asarray(means,dtype=np.float64)
+
+    def get_coverage_means(self,fraction = None):
+        return self.means
+
+
+class TrimmedMeanTest(unittest.TestCase):
+    def test_against_naive(self):
+        rng = np.random.RandomState(1)
+        for n in [1,2,5,10,33]:
+            x = rng.rand(4,n)
+            for trim in [0.,0.1,0.25,0.5]:
+                k = min(int(trim*n),(n-1)//2)
+                expected = [np.mean(sorted(row)[k:n-k]) for row in x]
+                self.assertTrue(np.allclose(trimmed_mean(x,trim),expected))
+
+
+class EstimatorTest(unittest.TestCase):
+    def test_genome_size(self):
+        means = [10.,12.,30.,11.,9.]
+        self.assertEqual(GenomeSizeEstimator(Coverage(means),1100.).get_genome_size(),100.)
+        self.assertEqual(GenomeSizeEstimator(Coverage(means),1440.,"mean").get_genome_size(),100.)
+        self.assertEqual(GenomeSizeEstimator(Coverage([0.,0.]),1000.).get_genome_size(),None)
+        self.assertEqual(GenomeSizeEstimator(Coverage([]),1000.).get_genome_size(),None)
+        self.assertRaises(ValueError,GenomeSizeEstimator,Coverage(means),1000.,"mode")
+
+    def test_bootstrap_against_naive(self):
+        # resamples are drawn one after another from the same generator
+        means = np.random.RandomState(2).gamma(20.,1.,40)
+        for statistic in ["mean","median","trimmed"]:
+            estimator = GenomeSizeEstimator(Coverage(means),1e6,statistic)
+            rng = np.random.RandomState(7)
+            expected = []
+            for i in range(300):
+                sample = means[rng.randint(0,40,size = 40)]
+                c = {"mean":np.mean,"median":np.median,"trimmed":lambda x: trimmed_mean(x,0.1)}[statistic](sample)
+                expected.append(1e6/c)
+            self.assertTrue(np.allclose(estimator.bootstrap(300,seed = 7),expected))
+
+    def test_no_coverage(self):
+        summary = GenomeSizeEstimator(Coverage([0.,0.,0.]),1e6).get_summary()
+        self.assertEqual((summary["genomesize"],summary["lower"],summary["upper"]),(None,None,None))
+        self.assertEqual(summary["scgs"],3)
+
+    def test_chunks(self):
+        # resamples do not depend on the size of chunks, which is bounded
+        means = np.random.RandomState(4).gamma(20.,1.,25)
+        estimator = GenomeSizeEstimator(Coverage(means),1e6)
+        g = estimator.bootstrap(500,seed = 3)
+        for chunkbytes in [1,8*25,8*25*7,1<<30]:
+            self.assertTrue(np.array_equal(estimator.bootstrap(500,seed = 3,chunkbytes = chunkbytes),g))
+
+    def test_confidence_interval(self):
+        means = np.random.RandomState(3).gamma(20.,1.,30)
+        estimator = GenomeSizeEstimator(Coverage(means),1e6)
+        lower,upper = estimator.get_confidence_interval(0.95,1000,seed = 1)
+        self.assertTrue(lower < estimator.get_genome_size() < upper)
+        self.assertEqual((lower,upper),estimator.get_confidence_interval(0.95,1000,seed = 1))
+        self.assertEqual(GenomeSizeEstimator(Coverage([]),1e6).get_confidence_interval(),(None,None))
+        # the default seed is fixed
+        self.assertEqual(estimator.get_confidence_interval(),GenomeSizeEstimator(Coverage(means),1e6).get_confidence_interval())
+        # resamples without coverage give an infinite genome size
+        g = GenomeSizeEstimator(Coverage([0.,0.,0.,5.]),100.,"median").bootstrap(200,seed = 1)
+        self.assertTrue(np.any(np.isinf(g)) and np.all(g > 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
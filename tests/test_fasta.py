@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# ***************************************************************** #
+# **         regions of sequences from an indexed FASTA file     ** #
+# ***************************************************************** #
+
+
+import os,sys
+import shutil,tempfile,time
+import unittest
+
+TESTDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.join(TESTDIR,".."))
+from scroogeclasses import FastaIndex,build_fasta_index
+
+SEQ1 = "ACGTACGTAC" "GGGGCCCCAA" "TTT"
+SEQ2 = "CATCATCATC" "ATCA"
+
+
+def wrap(seq,width,newline = "\n"):
+    return "".join([seq[i:i+width] + newline for i in range(0,len(seq),width)])
+
+
+class FastaIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fastafile = os.path.join(self.tmpdir,"asm.fa")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self,text):
+        f = open(self.fastafile,"wb")
+        f.write(text)
+        f.close()
+
+    def test_fetch(self):
+        for newline in ["\n","\r\n"]:
+            self.write(">contig1 first\n".replace("\n",newline) + wrap(SEQ1,10,newline) + ">contig2\n".replace("\n",newline) + wrap(SEQ2,10,newline) + ">empty\n".replace("\n",newline))
+            if os.path.exists(self.fastafile + ".fai"):
+                os.remove(self.fastafile + ".fai")
+            index = FastaIndex(self.fastafile)
+            self.assertEqual(len(index),3)
+            self.assertTrue("contig1" in index)
+            self.assertFalse("contig1 first" in index)
+            self.assertEqual(index.get_length("contig1"),len(SEQ1))
+            self.assertEqual(index.get_length("empty"),0)
+            for name,seq in [("contig1",SEQ1),("contig2",SEQ2)]:
+                for start in range(len(seq) + 1):
+                    for end in range(start,len(seq) + 1):
+                        self.assertEqual(index.fetch(name,start,end),seq[start:end])
+            self.assertEqual(index.fetch("contig1"),SEQ1)
+            # regions are clipped to the sequence
+            self.assertEqual(index.fetch("contig2",-5,100),SEQ2)
+            self.assertEqual(index.fetch("contig2",10,5),"")
+            self.assertEqual(index.fetch("empty"),"")
+            index.close()
+
+    def test_index_reused(self):
+        self.write(">contig1\n" + wrap(SEQ1,10))
+        FastaIndex(self.fastafile).close()
+        # an index newer than the file is not built again
+        f = open(self.fastafile + ".fai","a")
+        f.write("marker\t1\t0\t1\t2\n")
+        f.close()
+        self.assertTrue("marker" in FastaIndex(self.fastafile))
+        # a changed file is indexed again
+        self.write(">contig2\n" + wrap(SEQ2,10))
+        past = time.time() - 100
+        os.utime(self.fastafile + ".fai",(past,past))
+        index = FastaIndex(self.fastafile)
+        self.assertEqual(len(index),1)
+        self.assertEqual(index.fetch("contig2",3,13),SEQ2[3:13])
+
+    def test_index_file(self):
+        self.write(">contig1\n" + wrap(SEQ1,10))
+        indexfile = os.path.join(self.tmpdir,"other.fai")
+        index = FastaIndex(self.fastafile,indexfile)
+        self.assertTrue(os.path.isfile(indexfile))
+        self.assertFalse(os.path.exists(self.fastafile + ".fai"))
+        self.assertEqual(index.fetch("contig1",8,12),SEQ1[8:12])
+
+    def test_line_lengths(self):
+        self.write(">contig1\nACGT\nACGTAC\n")
+        self.assertRaises(ValueError,build_fasta_index,self.fastafile,self.fastafile + ".fai")
+        self.write(">contig1\nACGT\nAC\nACGT\n")
+        self.assertRaises(ValueError,build_fasta_index,self.fastafile,self.fastafile + ".fai")
+
+    def test_empty_header(self):
+        for header in [">\n",">   \n"]:
+            self.write(">contig1\nACGT\n" + header + "ACGT\n")
+            try:
+                build_fasta_index(self.fastafile,self.fastafile + ".fai")
+            except ValueError as e:
+                self.assertIn("malformed FASTA file",str(e))
+                self.assertIn("line 3",str(e))
+            else:
+                self.fail("no error for an empty header")
+        self.assertRaises(ValueError,FastaIndex,self.fastafile)
+
+
+if __name__ == "__main__":
+    unittest.main()
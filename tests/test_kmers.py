@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# ***************************************************************** #
+# **         k-mer hashing against a naive implementation        ** #
+# ***************************************************************** #
+
+
+import os,sys
+import unittest
+
+import numpy as np
+
+TESTDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.join(TESTDIR,".."))
+from scroogekmers import encode_sequence,kmer_hashes,sequence_kmers,KmerSet,KmerIndex
+from scroogeclasses import SingleCopyGeneList
+
+COMPLEMENT = {"A":"T","C":"G","G":"C","T":"A"}
+
+
+def naive_kmers(seq,k):
+    """ canonical k-mer (as integer), or None if ambiguous, and whether
+    the forward k-mer is canonical, at every position """
+    result = []
+    for i in range(len(seq) - k + 1):
+        word = seq[i:i+k].upper()
+        if any([b not in COMPLEMENT for b in word]):
+            result.append((None,None))
+            continue
+        reverse = "".join([COMPLEMENT[b] for b in reversed(word)])
+        f = int("".join(["%d"%"ACGT".index(b) for b in word]),4)
+        r = int("".join(["%d"%"ACGT".index(b) for b in reverse]),4)
+        result.append((min(f,r),f <= r))
+    return result
+
+
+def random_sequence(rng,length,ambiguous = 0.):
+    seq = "".join(rng.choice(list("ACGTacgt"),length))
+    if ambiguous > 0:
+        seq = "".join([b if rng.rand() >= ambiguous else "N" for b in seq])
+    return seq
+
+
+class KmerHashTest(unittest.TestCase):
+    def test_against_naive(self):
+        rng = np.random.RandomState(1)
+        for k in [1,2,3,5,8,13,16,21,31]:
+            seq = random_sequence(rng,120,0.02)
+            h,valid,forward = kmer_hashes(encode_sequence(seq),k)
+            expected = naive_kmers(seq,k)
+            self.assertEqual(len(h),len(expected))
+            for i,(e,f) in enumerate(expected):
+                self.assertEqual(bool(valid[i]),e is not None)
+                if e is not None:
+                    self.assertEqual(int(h[i]),e)
+                    self.assertEqual(bool(forward[i]),f)
+
+    def test_reverse_complement(self):
+        rng = np.random.RandomState(2)
+        seq = random_sequence(rng,200).upper()
+        reverse = "".join([COMPLEMENT[b] for b in reversed(seq)])
+        h = kmer_hashes(encode_sequence(seq),21)[0]
+        r = kmer_hashes(encode_sequence(reverse),21)[0]
+        self.assertTrue(np.array_equal(h,r[::-1]))
+
+    def test_short_sequence(self):
+        h,valid,forward = kmer_hashes(encode_sequence("ACGT"),5)
+        self.assertEqual(len(h),0)
+
+    def test_sequence_kmers(self):
+        # k-mers do not span two sequences
+        h,index,positions,forward = sequence_kmers(["ACGTA","CC","GGTTAC"],3)
+        self.assertEqual(list(index),[0,0,0,2,2,2,2])
+        self.assertEqual(list(positions),[0,1,2,0,1,2,3])
+
+
+class KmerSetTest(unittest.TestCase):
+    def test_find(self):
+        rng = np.random.RandomState(3)
+        kmers = rng.randint(0,1 << 40,5000).astype(np.uint64)
+        others = rng.randint(0,1 << 40,5000).astype(np.uint64)
+        kmerset = KmerSet(kmers,k = 21)
+        members = set(kmers.tolist())
+        self.assertTrue(np.all(kmerset.contains(kmers)))
+        self.assertEqual(list(kmerset.contains(others)),[x in members for x in others.tolist()])
+        self.assertEqual(len(KmerSet([],k = 21).find(others)),len(others))
+
+    def test_packed_bitmap(self):
+        kmers = np.array([0,1,63,64,(1 << 62) - 1],dtype=np.uint64)
+        kmerset = KmerSet(kmers,k = 31)
+        self.assertTrue(np.all(kmerset.contains(kmers)))
+        self.assertFalse(np.any(kmerset.contains(kmers + np.uint64(2))))
+        # one bit per slot, 2^16 slots at least
+        self.assertEqual(kmerset._KmerSet__bitmap.nbytes,(1 << 16)//8)
+
+    def test_count_hits(self):
+        kmerset = KmerSet(sequence_kmers(["ACGTTGCAAG"],4)[0],k = 4)
+        self.assertEqual(list(kmerset.count_hits(["ACGTTG","TTTTTT","CTTGCAACGT"])),[3,0,7])
+
+
+class KmerIndexTest(unittest.TestCase):
+    def test_place_reads(self):
+        rng = np.random.RandomState(4)
+        scg = SingleCopyGeneList()
+        for i in range(3):
+            scg.add_sequence("SCG%d"%i,random_sequence(rng,300).upper())
+        index = KmerIndex(scg,k = 15)
+        seq = scg["SCG1"].get_sequence()
+        reverse = "".join([COMPLEMENT[b] for b in reversed(seq[100:180])])
+        tids,starts,ends = index.place_reads([seq[40:140],reverse,"A"*100])
+        self.assertEqual(list(tids),[1,1])
+        self.assertEqual(list(starts),[40,100])
+        self.assertEqual(list(ends),[140,180])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# ***************************************************************** #
+# **         manifest of read libraries                          ** #
+# ***************************************************************** #
+
+
+import os,sys
+import shutil,tempfile
+import unittest
+
+TESTDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.join(TESTDIR,".."))
+from scrooge import read_manifest,write_summary,library_errors
+from scroogeclasses import SingleCopyGeneList,PipelineScheduler
+
+
+class ManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def read(self,text):
+        filename = os.path.join(self.tmpdir,"manifest")
+        f = open(filename,"w")
+        f.write(text)
+        f.close()
+        return read_manifest(filename)
+
+    def test_comments(self):
+        text = "# libraries\n\nlibA\treads/a.fq.gz\t# first run\n  # indented comment\n/data/b.fa #x\n"
+        self.assertEqual(self.read(text),[("libA","reads/a.fq.gz"),("b","/data/b.fa")])
+
+    def test_hash_in_file_name(self):
+        text = "run#1\t/data/run#1.fq\n/data/lib#2.fa\n"
+        self.assertEqual(self.read(text),[("run#1","/data/run#1.fq"),("lib#2","/data/lib#2.fa")])
+
+
+
+class SummaryTest(ManifestTest):
+    def test_failed_library(self):
+        libraries = [("a","a.fa"),("b","b.fa"),("c","c.fa")]
+        scheduler = PipelineScheduler(verbose = False)
+        for name,reads in libraries:
+            scheduler.add_step("checkreads:" + name,lambda name = name: name != "b")
+            scheduler.add_step("coverage:" + name,lambda: None,requires = ["checkreads:" + name])
+        scheduler.run()
+        scg = SingleCopyGeneList()
+        scg.add_sequence("SCG0","A"*100)
+        scg.add_coverage("SCG0",0,50)
+        filename = os.path.join(self.tmpdir,"summary.tsv")
+        write_summary(filename,libraries,{"a":scg,"c":scg},{"a":(10,1000),"b":(7,700),"c":(5,500)},
+                      {"a":{"genomesize":2000.,"lower":1500.,"upper":2500.},"c":{"genomesize":None,"lower":None,"upper":None}},
+                      library_errors(scheduler,libraries))
+        rows = [line.rstrip("\n").split("\t") for line in open(filename)]
+        self.assertEqual(rows[0][:4],["#library","status","reads","bases"])
+        self.assertEqual(rows[1],["a","done","10","1000","1","100","1","0.5000","0.5000","2000","1500","2500",""])
+        self.assertEqual(rows[2][:4] + rows[2][-1:],["b","failed","7","700","step 'checkreads:b' failed"])
+        self.assertEqual(rows[2][4:-1],["NA"]*8)
+        self.assertEqual(rows[3][9:],["NA","NA","NA",""])
+
+
+if __name__ == "__main__":
+    unittest.main()
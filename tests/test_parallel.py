@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# ***************************************************************** #
+# **         sharded coverage counting against the serial path   ** #
+# ***************************************************************** #
+
+
+import os,sys
+import shutil,tempfile
+import unittest
+
+import numpy as np
+import pysam
+
+TESTDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.join(TESTDIR,".."))
+from scroogeclasses import SingleCopyGeneList,count_coverage,count_coverage_parallel
+
+# SCG 2 has no reads, SCG 5 only reads covering all of it
+LENGTHS = [300,1000,150,700,40,500,800,260]
+
+
+def write_bam(filename,seed):
+    """ sorted and indexed BAM with reads at the ends of the references
+    and reads covering them completely; references in the header are in
+    a different order than the SCGs """
+    rng = np.random.RandomState(seed)
+    order = rng.permutation(len(LENGTHS))
+    header = {"HD":{"VN":"1.0","SO":"coordinate"},
+              "SQ":[{"SN":"SCG%d"%i,"LN":LENGTHS[i]} for i in order]}
+    bam = pysam.AlignmentFile(filename,"wb",header = header)
+    for tid,i in enumerate(order):
+        length = LENGTHS[i]
+        reads = []
+        if i == 5:
+            reads = [(0,length)]*3
+        elif i != 2:
+            starts = rng.randint(0,length,length//5)
+            ends = np.minimum(starts + rng.randint(1,120,len(starts)),length)
+            reads = zip(starts.tolist(),ends.tolist()) + [(0,min(50,length)),(length - 30,length),(0,length)]
+        for j,(start,end) in enumerate(sorted(reads)):
+            a = pysam.AlignedSegment()
+            a.query_name = "r%d_%d"%(i,j)
+            a.query_sequence = "A"*(end - start)
+            a.flag = 0
+            a.reference_id = tid
+            a.reference_start = start
+            a.mapping_quality = 40
+            a.cigartuples = [(0,end - start)]
+            bam.write(a)
+    bam.close()
+    pysam.index(filename)
+
+
+def scg_list(**kwargs):
+    scg = SingleCopyGeneList(readlength = 30,**kwargs)
+    for i,length in enumerate(LENGTHS):
+        scg.add_sequence("SCG%d"%i,"A"*length)
+    return scg
+
+
+class ParallelTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.bam = os.path.join(self.tmpdir,"reads.bam")
+        write_bam(self.bam,1)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def serial(self,**kwargs):
+        scg = scg_list(**kwargs)
+        bam = pysam.AlignmentFile(self.bam,"rb")
+        scg.set_references(bam.references)
+        n = count_coverage(scg,bam.fetch())
+        bam.close()
+        return scg,n
+
+    def test_full(self):
+        serial,n = self.serial()
+        for processes in [1,3]:
+            parallel = scg_list()
+            self.assertEqual(count_coverage_parallel(parallel,self.bam,processes),n)
+            self.assertTrue(np.array_equal(parallel.get_engine().get_depth(),serial.get_engine().get_depth()))
+            self.assertTrue(np.array_equal(parallel.get_engine().get_counts(),serial.get_engine().get_counts()))
+        self.assertEqual(serial.get_engine().get_count_reads(serial["SCG2"].get_index()),0)
+
+    def test_summary(self):
+        serial,n = self.serial(summarybins = 64)
+        parallel = scg_list(summarybins = 64)
+        count_coverage_parallel(parallel,self.bam,2)
+        a,b = serial.get_engine(),parallel.get_engine()
+        self.assertTrue(np.array_equal(a.get_counts(),b.get_counts()))
+        self.assertTrue(np.array_equal(a.get_sums(),b.get_sums()))
+        self.assertTrue(np.array_equal(a.get_sums2(),b.get_sums2()))
+        self.assertTrue(np.array_equal(a.get_histograms(),b.get_histograms()))
+
+    def test_subsamples(self):
+        serial,n = self.serial(fractions = [0.3,1.])
+        parallel = scg_list(fractions = [0.3,1.])
+        count_coverage_parallel(parallel,self.bam,2)
+        for f in [0.3,1.]:
+            self.assertTrue(np.array_equal(serial.get_coverage_means(f),parallel.get_coverage_means(f)))
+
+
+if __name__ == "__main__":
+    unittest.main()
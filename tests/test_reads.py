@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# ***************************************************************** #
+# **         counting reads fed to the aligner                   ** #
+# ***************************************************************** #
+
+
+import os,sys
+import shutil,tempfile,gzip
+import unittest
+
+TESTDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.join(TESTDIR,".."))
+from scroogeclasses import ReadCounter,iter_read_blocks,feed_reads
+
+FASTQ = "@r1\nACGTA\n+\nIIIII\n@r2 second\nAC\n+\n@@\n@r3\nGGGTTTC\n+\nIIIIIII\n"
+FASTA = ">r1\nACGTA\nCC\n>r2\nA\n>r3 third\nGGGGGGGG\nTT\nA\n"
+
+
+class Output():
+    """ stdin of the aligner, keeps what was written """
+    def __init__(self):
+        self.text = []
+        self.closed = False
+
+    def write(self,text):
+        self.text.append(text)
+
+    def close(self):
+        self.closed = True
+
+
+class ReadCounterTest(unittest.TestCase):
+    def count(self,fileformat,blocks):
+        counter = ReadCounter(fileformat)
+        for block in blocks:
+            counter.add(block)
+        return counter.close()
+
+    def test_blocks(self):
+        # reads and bases do not depend on where the text is split into blocks
+        for fileformat,text,expected in [("fastq",FASTQ,(3,14)),("fasta",FASTA,(3,19))]:
+            self.assertEqual(self.count(fileformat,[text]),expected)
+            self.assertEqual(self.count(fileformat,list(text)),expected)
+            for i in range(len(text) + 1):
+                for j in range(i,len(text) + 1,3):
+                    self.assertEqual(self.count(fileformat,[text[:i],text[i:j],text[j:]]),expected)
+
+    def test_no_final_newline(self):
+        self.assertEqual(self.count("fastq",[FASTQ[:-1]]),(3,14))
+        self.assertEqual(self.count("fasta",[FASTA[:-1]]),(3,19))
+
+    def test_empty(self):
+        self.assertEqual(self.count("fastq",[]),(0,0))
+        self.assertEqual(self.count("fasta",[""]),(0,0))
+
+
+class FeedReadsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self,name,text,compressed = False):
+        filename = os.path.join(self.tmpdir,name)
+        if compressed:
+            f = gzip.open(filename,"wb")
+        else:
+            f = open(filename,"wb")
+        f.write(text)
+        f.close()
+        return filename
+
+    def test_blocks_in_order(self):
+        files = [self.write("r%d.fq"%i,FASTQ.replace("@r","@f%dr"%i)) for i in range(5)]
+        for threads in [1,3,8]:
+            blocks = list(iter_read_blocks(files,threads,blocksize = 7,queuesize = 2))
+            self.assertEqual([i for i,block in blocks],sorted([i for i,block in blocks]))
+            self.assertEqual("".join([block for i,block in blocks]),"".join([FASTQ.replace("@r","@f%dr"%i) for i in range(5)]))
+
+    def test_feed(self):
+        files = [self.write("a.fq.gz",FASTQ,True),self.write("b.fq",FASTQ[:-1]),self.write("c.fa",FASTA)]
+        for threads in [1,2]:
+            out = Output()
+            stats = feed_reads(out,files,threads)
+            self.assertTrue(out.closed)
+            self.assertEqual(stats,{"reads":9,"bases":47,"error":None})
+            # a missing newline at the end of a file is added
+            self.assertEqual("".join(out.text),FASTQ + FASTQ + FASTA)
+
+    def test_missing_file(self):
+        out = Output()
+        stats = {}
+        feed_reads(out,[self.write("a.fq",FASTQ),os.path.join(self.tmpdir,"missing.fq")],stats = stats)
+        # the aligner is not left waiting for more reads
+        self.assertTrue(out.closed)
+        self.assertIn("missing.fq",stats["error"])
+
+
+if __name__ == "__main__":
+    unittest.main()
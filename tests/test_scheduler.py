@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# ***************************************************************** #
+# **         pipeline scheduler: order of log lines, threads     ** #
+# ***************************************************************** #
+
+
+import os,sys
+import shutil,tempfile,threading,time
+import unittest
+
+TESTDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.join(TESTDIR,".."))
+from scroogeclasses import PipelineScheduler
+
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.logfile = os.path.join(self.tmpdir,"log")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def log(self):
+        return [line.split()[2:4] for line in open(self.logfile)]
+
+    def test_end_before_dependent_start(self):
+        # races show up only now and then, run the chain repeatedly
+        for i in range(50):
+            os.remove(self.logfile) if os.path.exists(self.logfile) else None
+            scheduler = PipelineScheduler(verbose = False,logfile = self.logfile)
+            scheduler.add_step("a",lambda: None)
+            scheduler.add_step("b",lambda: None,requires = ["a"])
+            scheduler.add_step("c",lambda: False,requires = ["b"])
+            scheduler.add_step("d",lambda: None,requires = ["c"])
+            self.assertFalse(scheduler.run())
+            self.assertEqual(self.log(),[["START:","a"],["END:","a"],["START:","b"],["END:","b"],
+                                         ["START:","c"],["FAILED:","c"],["CANCEL:","d"]])
+
+    def test_always(self):
+        # a step with 'always' runs after its requirements, failed or not
+        scheduler = PipelineScheduler(verbose = False,logfile = self.logfile)
+        scheduler.add_step("a",lambda: False)
+        scheduler.add_step("b",lambda: None,requires = ["a"])
+        scheduler.add_step("c",lambda: None)
+        scheduler.add_step("summary",lambda: None,requires = ["b","c"],always = True)
+        self.assertFalse(scheduler.run())
+        self.assertEqual([(s.name,s.status) for s in scheduler],
+                         [("a","failed"),("b","cancelled"),("c","done"),("summary","done")])
+
+    def test_threads_joined(self):
+        before = threading.active_count()
+        for i in range(50):
+            scheduler = PipelineScheduler(verbose = False)
+            for j in range(4):
+                scheduler.add_step("s%d"%j,lambda: None)
+            self.assertTrue(scheduler.run())
+            self.assertEqual(threading.active_count(),before)
+
+
+if __name__ == "__main__":
+    unittest.main()